@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Measures peak memory of hashing frame keys the way Video.render does,
+where every key holds an entire LaTeX document.
+
+Usage::
+
+    $ python bench/hash_memo_rss.py --frames 2000
+"""
+import os
+import sys
+import resource
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+
+from leyline.assets import AssetsCache
+from leyline.video import HEADER, FOOTER
+
+
+def peak_rss():
+    """Peak resident set size [MiB] of this process."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kibibytes elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+
+def main(args=None):
+    p = ArgumentParser('hash_memo_rss')
+    p.add_argument('--frames', default=2000, type=int)
+    p.add_argument('--body-size', default=20000, type=int,
+                   help='number of characters in each frame body')
+    ns = p.parse_args(args=args)
+    with tempfile.TemporaryDirectory() as d:
+        srcfile = os.path.join(d, 'lecture.ley')
+        with open(srcfile, 'w') as f:
+            f.write('lecture')
+        assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+        rss0 = peak_rss()
+        tracemalloc.start()
+        for i in range(ns.frames):
+            body = str(i) * (ns.body_size // len(str(i)))
+            key = ('frame', HEADER + body + FOOTER)
+            # Frame.render checks, looks up, and hashes each key
+            key in assets
+            assets.hash(key)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('frames:            {0}'.format(ns.frames))
+        print('memoized hashes:   {0}'.format(len(assets._hashes)))
+        print('traced peak [MiB]: {0:.1f}'.format(peak / (1 << 20)))
+        print('traced live [MiB]: {0:.1f}'.format(current / (1 << 20)))
+        print('peak RSS [MiB]:    {0:.1f} (from {1:.1f})'.format(peak_rss(), rss0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
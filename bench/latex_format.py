@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Compares pdflatex time per frame with and without a precompiled format
+of the beamer preamble, on a synthetic deck. Requires a TeX installation
+with the mylatexformat package.
+
+Usage::
+
+    $ python bench/latex_format.py --frames 100
+"""
+import os
+import sys
+import time
+import tempfile
+from argparse import ArgumentParser
+
+from leyline import tools, texformat
+from leyline.assets import AssetsCache
+from leyline.video import HEADER, FOOTER
+
+
+def make_frame(i):
+    return (HEADER + '\\frametitle{{Frame {0}}}\n'
+            '\\begin{{itemize}}\n\\item point {0}\n\\item $x^{0}$\n'
+            '\\end{{itemize}}\n'.format(i) + FOOTER)
+
+
+def compile_deck(d, nframes, assets=None):
+    """Compiles each frame in its own directory, returning the wall time."""
+    t0 = time.monotonic()
+    for i in range(nframes):
+        framedir = os.path.join(d, 'frame{0}'.format(i))
+        os.makedirs(framedir)
+        texname = os.path.join(framedir, 'frame.tex')
+        texformat.pdflatex(texname, make_frame(i), cwd=framedir,
+                           name='frame{0}'.format(i), assets=assets,
+                           assets_dir=d)
+    return time.monotonic() - t0
+
+
+def main(args=None):
+    p = ArgumentParser('latex_format')
+    p.add_argument('--frames', default=100, type=int)
+    ns = p.parse_args(args=args)
+    with tempfile.TemporaryDirectory(prefix='leyline-bench-') as d:
+        tools.log_dir = os.path.join(d, 'logs')
+        plain = compile_deck(os.path.join(d, 'plain'), ns.frames)
+        srcfile = os.path.join(d, 'deck.ley')
+        with open(srcfile, 'w') as f:
+            f.write('deck')
+        fmtdir = os.path.join(d, 'fmt')
+        os.makedirs(fmtdir)
+        assets = AssetsCache(os.path.join(fmtdir, 'assets.json'), srcfile)
+        t0 = time.monotonic()
+        texformat.format_for(make_frame(0).partition('\\begin{document}')[0],
+                             assets, fmtdir)
+        build = time.monotonic() - t0
+        fmt = compile_deck(fmtdir, ns.frames, assets=assets)
+    print('{0} frames'.format(ns.frames))
+    print('full preamble: {0:.2f} s, {1:.3f} s/frame'.format(
+          plain, plain / ns.frames))
+    print('format build:  {0:.2f} s (once per preamble)'.format(build))
+    print('with format:   {0:.2f} s, {1:.3f} s/frame'.format(
+          fmt, fmt / ns.frames))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""Compares encode wall time and output size of the video encoding presets
+on a synthetic lecture of static slides.
+
+Usage::
+
+    $ python bench/slide_encoding.py --slides 40 --seconds 20
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+from leyline.video import ENCODING_PRESETS, encoding_args, make_ffconcat
+
+
+def make_lecture(d, nslides, seconds):
+    """Writes slide images and a silent audio track, returning the
+    [frame, duration] entries and the audio filename.
+    """
+    entries = []
+    for i in range(nslides):
+        frame = os.path.join(d, 'slide{0:03d}.jpg'.format(i))
+        subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-f',
+                               'lavfi', '-i', 'testsrc=size=1920x1080:'
+                               'rate=1:duration=1', '-vf',
+                               "select='eq(n,0)',hue=h={0}".format(i * 9),
+                               '-frames:v', '1', frame])
+        entries.append([frame, float(seconds)])
+    oggfile = os.path.join(d, 'audio.ogg')
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi',
+                           '-i', 'anullsrc=r=44100:cl=stereo', '-t',
+                           str(nslides * seconds), '-c:a', 'libvorbis', oggfile])
+    return entries, oggfile
+
+
+def encode(d, entries, oggfile, preset):
+    """Encodes the lecture, returning the wall time and output size."""
+    ffconcat = os.path.join(d, 'lecture.ffconcat')
+    with open(ffconcat, 'w') as f:
+        f.write(make_ffconcat(entries))
+    mp4file = os.path.join(d, preset + '.mp4')
+    t0 = time.monotonic()
+    subprocess.check_call(['ffmpeg', '-loglevel', 'error', '-y', '-i', ffconcat,
+                           '-i', oggfile] + encoding_args(entries, preset) +
+                          ['-shortest', mp4file])
+    return time.monotonic() - t0, os.path.getsize(mp4file)
+
+
+def main(args=None):
+    p = ArgumentParser('slide_encoding')
+    p.add_argument('--slides', default=40, type=int)
+    p.add_argument('--seconds', default=20, type=int,
+                   help='how long each slide is shown')
+    p.add_argument('--presets', default=','.join(sorted(ENCODING_PRESETS)))
+    ns = p.parse_args(args=args)
+    with tempfile.TemporaryDirectory(prefix='leyline-bench-') as d:
+        entries, oggfile = make_lecture(d, ns.slides, ns.seconds)
+        print('{0:<10} {1:>10} {2:>12}'.format('preset', 'seconds', 'bytes'))
+        for preset in ns.presets.split(','):
+            wall, size = encode(d, entries, oggfile, preset)
+            print('{0:<10} {1:>10.2f} {2:>12}'.format(preset, wall, size))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
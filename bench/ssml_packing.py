@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Compares the number of AWS Polly requests needed to synthesize lectures
+with and without SSML block packing.
+
+Usage::
+
+    $ python bench/ssml_packing.py lecture1.ley lecture2.ley ...
+"""
+import sys
+from argparse import ArgumentParser
+
+from leyline import parse
+from leyline.audio import SSML
+
+
+def count_requests(filename, max_chars):
+    """Returns the number of requests before and after packing."""
+    with open(filename, 'r') as f:
+        s = f.read()
+    tree = parse(s, filename=filename)
+    # one request per paragraph is what the unpacked renderer made
+    unpacked = SSML()._bodied_visit(tree).split('\n\n')
+    packed = SSML(max_chars=max_chars).visit(tree)
+    return len(unpacked), len(packed)
+
+
+def main(args=None):
+    p = ArgumentParser('ssml_packing')
+    p.add_argument('--max-chars', default=3000, type=int)
+    p.add_argument('filenames', nargs='+')
+    ns = p.parse_args(args=args)
+    total_before = total_after = 0
+    print('{0:<40} {1:>10} {2:>10}'.format('lecture', 'unpacked', 'packed'))
+    for filename in ns.filenames:
+        before, after = count_requests(filename, ns.max_chars)
+        total_before += before
+        total_after += after
+        print('{0:<40} {1:>10} {2:>10}'.format(filename, before, after))
+    print('{0:<40} {1:>10} {2:>10}'.format('total', total_before, total_after))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
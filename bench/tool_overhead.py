@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Measures the orchestration overhead of running external tools through
+leyline.tools and the scheduler, using a no-op binary in place of pdflatex
+and gs so that TeX need not be installed.
+
+Usage::
+
+    $ python bench/tool_overhead.py --frames 200 --jobs 8
+"""
+import sys
+import time
+import shutil
+import tempfile
+from argparse import ArgumentParser
+
+from leyline import tools
+from leyline.scheduler import Scheduler
+
+
+def main(args=None):
+    p = ArgumentParser('tool_overhead')
+    p.add_argument('--frames', default=200, type=int)
+    p.add_argument('--jobs', default=8, type=int)
+    p.add_argument('--binary', default=shutil.which('true'),
+                   help='stand-in for pdflatex and gs')
+    ns = p.parse_args(args=args)
+    tools.set_tool('pdflatex', ns.binary)
+    tools.set_tool('gs', ns.binary)
+    with tempfile.TemporaryDirectory(prefix='leyline-bench-') as d:
+        tools.log_dir = d
+
+        def frame(i):
+            tools.run('pdflatex', ['frame.tex'], name='frame-{0}'.format(i))
+            tools.run('gs', ['frame.pdf'], name='frame-{0}'.format(i))
+
+        sched = Scheduler(limits={'latex': ns.jobs})
+        for i in range(ns.frames):
+            sched.add('frame-{0}'.format(i), lambda i=i: frame(i), tool='latex')
+        t0 = time.monotonic()
+        sched.run()
+        wall = time.monotonic() - t0
+    tool_wall = sum(r.wall for r in tools.RUNS)
+    print('{0} frames, {1} tool runs in {2:.2f} s wall'.format(
+          ns.frames, len(tools.RUNS), wall))
+    print('time inside tools: {0:.2f} s'.format(tool_wall))
+    print('per-run overhead:  {0:.2f} ms'.format(
+          1000.0 * (wall * ns.jobs - tool_wall) / len(tools.RUNS)))
+    print(tools.summary(), end='')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
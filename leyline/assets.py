@@ -1,46 +1,473 @@
 """A cache for indexing static data on the filesystem."""
+import io
 import os
+import errno
 import json
+import time
+import heapq
+import sqlite3
+import tarfile
 import hashlib
+import shutil
+import tempfile
+import functools
+import threading
+import contextlib
+from collections import defaultdict, OrderedDict
 from collections.abc import MutableMapping, Sequence
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
-class AssetsCache(MutableMapping):
-    """A cache for indexing static data on the filesystem."""
 
-    def __init__(self, cachefile, srcfile, *args, **kwargs):
-        """Requires a cache filename and a srcfile that all assests come from.
-        All other args and kwargs are treated as arguments to dict().
+def asset_kind(key):
+    """Returns the kind of asset a key refers to, which is the first element
+    of tuple keys, such as ``'frame'`` or ``'dictation'``. Other keys have
+    an empty kind.
+    """
+    if isinstance(key, (str, bytes)) or not isinstance(key, Sequence):
+        return ''
+    if len(key) < 2 or not isinstance(key[0], str):
+        return ''
+    return key[0]
+
+
+def _still_linked(f, filename):
+    """Returns whether an open file is still the one at filename."""
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(filename))
+    except FileNotFoundError:
+        return False
+
+
+@contextlib.contextmanager
+def file_lock(filename, exclusive=True, remove=False):
+    """Context manager that holds an advisory lock on a file, which is created
+    if needed. If remove is True, the file is removed when the lock is
+    released, so that locks on many different names do not pile up. On
+    platforms without fcntl, this does not lock.
+    """
+    if fcntl is None:
+        yield
+        return
+    while True:
+        f = open(filename, 'a')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            f.close()
+            raise
+        if not remove or _still_linked(f, filename):
+            break
+        # the last holder removed the file while we waited, so lock anew
+        f.close()
+    with f:
+        try:
+            yield
+        finally:
+            if remove:
+                os.remove(filename)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+ASSET_LAYOUTS = ('flat', 'sharded')
+
+
+def asset_path(assets_dir, h, ext, layout='flat'):
+    """Returns the path to an asset with hash h and extension ext. In the
+    flat layout, assets live directly in the assets directory. In the
+    sharded layout, they live in two levels of subdirectories named by
+    the leading characters of the hash, such as ``ab/cd/abcd...jpg``.
+    """
+    if layout == 'flat':
+        return os.path.join(assets_dir, h + ext)
+    elif layout == 'sharded':
+        return os.path.join(assets_dir, h[:2], h[2:4], h + ext)
+    raise ValueError('unknown assets layout {0!r}'.format(layout))
+
+
+def locked(method):
+    """Decorates a cache method so that it holds the cache's lock, which makes
+    a cache safe to share between the threads of a build.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def fingerprint(*parts):
+    """Returns a short hash of a renderer's configuration, for use as the
+    version of the assets it produces.
+    """
+    m = hashlib.md5()
+    for part in parts:
+        m.update(str(part).encode())
+        m.update(b'\0')
+    return m.hexdigest()[:12]
+
+
+def versioned_key(kind, payload, version=None):
+    """Makes the cache key for an asset of a given kind. Producers that
+    declare a version get keys namespaced by it, so that changing the
+    version only invalidates assets of that kind.
+    """
+    if version is None:
+        return (kind, payload)
+    return (kind, version, payload)
+
+
+def key_size(key):
+    """Returns the total length of a key's strings or bytes."""
+    if isinstance(key, (str, bytes)):
+        return len(key)
+    try:
+        return sum(len(k) for k in key)
+    except TypeError:
+        return 0
+
+
+def _update_str(m, s, chunksize=1 << 16):
+    """Updates a hash with the UTF-8 encoding of a string, a chunk at a time,
+    so that large strings are never copied whole.
+    """
+    if len(s) <= chunksize:
+        m.update(s.encode())
+        return
+    for i in range(0, len(s), chunksize):
+        m.update(s[i:i + chunksize].encode())
+
+
+def file_size(filename):
+    """Returns the size of a file, or None if it does not exist."""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+def file_digest(filename, chunksize=1 << 16):
+    """Returns the MD5 hex digest of a file's contents."""
+    m = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def existing_files(filenames):
+    """Returns the subset of filenames that exist as files, using a single
+    os.scandir() pass over each directory rather than a stat per file.
+    """
+    bydir = {}
+    for filename in filenames:
+        d, base = os.path.split(filename)
+        bydir.setdefault(d, set()).add(base)
+    existing = set()
+    for d, bases in bydir.items():
+        try:
+            with os.scandir(d or '.') as it:
+                for entry in it:
+                    if entry.name in bases and entry.is_file():
+                        existing.add(os.path.join(d, entry.name))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return existing
+
+
+def remove_files(filenames, max_workers=8):
+    """Removes files using a pool of threads, ignoring those that are
+    already gone.
+    """
+    def remove(filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+    filenames = [f for f in filenames if f]
+    if len(filenames) < 2 or max_workers < 2:
+        for filename in filenames:
+            remove(filename)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(remove, filenames))
+
+
+class GCReport:
+    """Summary of the assets removed by a garbage collection, including the
+    number of bytes reclaimed per source file. An asset shared by several
+    source files counts toward each of them.
+    """
+
+    def __init__(self, bad):
+        self.removed = set(bad)
+        self.bytes_by_source = {}
+        self.total_bytes = 0
+        for filename, sources in bad.values():
+            try:
+                size = os.path.getsize(filename)
+            except OSError:
+                size = 0
+            self.total_bytes += size
+            for srcfile in sources:
+                self.bytes_by_source[srcfile] = \
+                    self.bytes_by_source.get(srcfile, 0) + size
+
+    def __str__(self):
+        s = '{0} assets, {1} bytes reclaimable\n'.format(len(self.removed),
+                                                        self.total_bytes)
+        for srcfile, nbytes in sorted(self.bytes_by_source.items()):
+            s += '  {0}: {1} bytes\n'.format(srcfile, nbytes)
+        return s
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """Places a copy of src at dst, as a hard link if possible. The copy is
+    made atomically, so dst is never partially written.
+    """
+    d = os.path.dirname(dst) or '.'
+    os.makedirs(d, exist_ok=True)
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return
+        except FileExistsError:
+            os.remove(dst)
+            return link_or_copy(src, dst, hardlink=hardlink)
+        except OSError:
+            # different filesystems, or links not supported
+            pass
+    fd, tmpname = tempfile.mkstemp(prefix='.asset-', dir=d)
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmpname)
+        os.replace(tmpname, dst)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def replace_file(src, dst):
+    """Moves src to dst by replacing dst, rather than writing into it. Asset
+    files may be hard links to blobs that other assets share, so producers
+    must never open an existing asset path for writing. Falls back to an
+    atomic copy if src and dst are on different filesystems.
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        link_or_copy(src, dst, hardlink=False)
+        os.remove(src)
+
+
+class UpstreamStore:
+    """A read-only directory of assets, such as a shared directory on a file
+    server, which may be used to fill local cache misses. Assets are found by
+    their key hash, in either the flat or the sharded layout.
+    """
+
+    def __init__(self, path, hardlink=True):
         """
-        self._dump_mutations = False
-        self.cachefile = cachefile
+        Parameters
+        ----------
+        path : str
+            Path to the upstream assets directory.
+        hardlink : bool, optional
+            Whether to hard link assets into the local cache, rather than
+            copying them. Falls back to copying when linking fails.
+        """
+        self.path = path
+        self.hardlink = hardlink
+        self._flat = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.path)
+
+    def _scan(self, d, h=None):
+        """Maps hashes to filenames for assets in a directory."""
+        names = {}
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    stem, ext = os.path.splitext(entry.name)
+                    if ext and (h is None or stem == h) and entry.is_file():
+                        names[stem] = entry.path
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return names
+
+    def find(self, h):
+        """Returns the path to the asset with hash h, or None."""
+        filename = self._scan(os.path.join(self.path, h[:2], h[2:4]), h).get(h, None)
+        if filename is not None:
+            return filename
+        if self._flat is None:
+            # one listing of the top-level directory serves all lookups
+            self._flat = self._scan(self.path)
+        return self._flat.get(h, None)
+
+    def fetch(self, h, dst):
+        """Copies the asset with hash h to dst. Returns whether the asset
+        was found.
+        """
+        src = self.find(h)
+        if src is None:
+            return False
+        link_or_copy(src, dst, hardlink=self.hardlink)
+        return True
+
+    def publish(self, h, filename, layout='flat'):
+        """Copies an asset from the local cache into this store."""
+        _, ext = os.path.splitext(filename)
+        dst = asset_path(self.path, h, ext, layout)
+        if os.path.exists(dst):
+            return
+        link_or_copy(filename, dst, hardlink=False)
+        if self._flat is not None and layout == 'flat':
+            self._flat[h] = dst
+
+
+class EvictionPolicy:
+    """Describes which assets may be evicted from the cache to bound its
+    size and age. Assets are evicted least recently used first. Assets of
+    pinned kinds, such as human recordings which are expensive to redo, and
+    assets used by the current build are never evicted.
+    """
+
+    def __init__(self, max_bytes=None, max_age=None, pinned=('dictation',),
+                 batch_size=64):
+        """
+        Parameters
+        ----------
+        max_bytes : int or None, optional
+            Maximum total size [bytes] of the assets in the cache.
+        max_age : float or None, optional
+            Maximum time [sec] since an asset was last used.
+        pinned : iterable of str, optional
+            Kinds of assets which are never evicted.
+        batch_size : int, optional
+            Maximum number of assets to evict each time an asset is added,
+            so that eviction is spread out over the build.
+        """
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.pinned = frozenset(pinned)
+        self.batch_size = batch_size
+
+
+class EvictionStats:
+    """Counts of the number and size of the assets evicted, by kind."""
+
+    def __init__(self):
+        self.counts = {}
+        self.bytes = {}
+
+    def add(self, kind, size):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        self.bytes[kind] = self.bytes.get(kind, 0) + size
+
+    @property
+    def count(self):
+        return sum(self.counts.values())
+
+    def __str__(self):
+        s = 'evicted {0} assets, {1} bytes\n'.format(self.count,
+                                                     sum(self.bytes.values()))
+        for kind in sorted(self.counts):
+            s += '  {0}: {1} assets, {2} bytes\n'.format(kind or '(unknown)',
+                                                        self.counts[kind],
+                                                        self.bytes[kind])
+        return s
+
+
+class BaseAssetsCache(MutableMapping):
+    """Base class for caches that index static data on the filesystem.
+    Subclasses provide storage by implementing the entry methods
+    (``_get_entry()``, ``_put_entry()``, ``_del_entry()``, ``_entries()``,
+    ``_len_entries()``, ``_clear_entries()``) and ``_set_source()``.
+
+    Entries are keyed by the MD5 hash of the asset key and are 2-lists of
+    ``['filename', {'srcfile': 'srchash'}]``. Alongside each entry, an info
+    dict records the ``'kind'``, ``'size'`` and last access time
+    (``'atime'``) of the asset, via ``_get_info()``, ``_set_info()``, and
+    ``_infos()``.
+    """
+
+    # minimum time [sec] between recording accesses of the same asset
+    touch_interval = 60.0
+    # maximum number of key hashes to memoize
+    memo_size = 4096
+    # maximum size [chars or bytes] of keys whose hashes are memoized
+    memo_key_size = 1024
+
+    def __init__(self, srcfile, *args, assets_dir=None, layout='flat',
+                 policy=None, upstreams=(), publish=False, **kwargs):
+        if layout not in ASSET_LAYOUTS:
+            raise ValueError('unknown assets layout {0!r}'.format(layout))
+        self._lock = threading.RLock()
+        if assets_dir is None:
+            assets_dir = os.path.dirname(self.cachefile) or '.'
+        self.assets_dir = assets_dir
+        self.layout = layout
+        self.policy = policy
+        self.upstreams = [UpstreamStore(u) if isinstance(u, str) else u
+                          for u in upstreams]
+        self.publish = publish
+        self.eviction_stats = EvictionStats()
+        self._evict_queue = None
+        # hashes of assets used since the cache was opened
+        self._used = set()
         self._srcfile = self.srchash = None
-        # the cache maps md5 sums of keys to a 2-list of ['filename', {'srcfile': 'srchash'}]
-        self.cache = {}
         # maps the sources to the current MD5 hash
         self.sources = {}
+        # maps asset kinds to the current version of their producer
+        self.versions = {}
         # cache keys, not stored
-        self._hashes = {}
+        self._hashes = OrderedDict()
+        self._last_key = self._last_hash = None
         self.load()
         self.srcfile = srcfile
         self.update(*args, **kwargs)
-        self._dump_mutations = True
-        self.dump()
 
     def load(self):
-        """Loads the file into the cache."""
-        if not os.path.isfile(self.cachefile):
-            return
-        with open(self.cachefile, 'r') as f:
-            data = json.load(f)
-        self.cache.update(data.get('cache', ()))
-        self.sources.update(data.get('sources', ()))
+        """Loads the cache from the filesystem."""
 
-    def dump(self):
-        """Writes the cache to the filesystem"""
-        data = {'cache': self.cache, 'sources': self.sources}
-        with open(self.cachefile, 'w') as f:
-            json.dump(data, f, indent=' ', sort_keys=True)
+    def close(self):
+        """Flushes and closes the cache."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager for applying many updates at once."""
+        yield self
+
+    def refresh(self):
+        """Picks up changes written to the cache by other processes."""
+
+    @contextlib.contextmanager
+    def claim(self, key):
+        """Context manager that holds an exclusive, cross-process lock on a
+        key while its asset is produced. Processes that claim a key which is
+        already claimed wait for the first to finish, and then find the asset
+        in the cache rather than producing it again.
+        """
+        lockdir = self.cachefile + '.locks'
+        os.makedirs(lockdir, exist_ok=True)
+        with file_lock(os.path.join(lockdir, self.hash(key)), remove=True):
+            self.refresh()
+            yield self
 
     @property
     def srcfile(self):
@@ -50,31 +477,46 @@ class AssetsCache(MutableMapping):
     @srcfile.setter
     def srcfile(self, value):
         self._srcfile = value
+        if value is None:
+            # maintenance tasks, such as importing, may not have a source
+            self.srchash = None
+            return
         with open(value, 'rb') as f:
             b = f.read()
         m = hashlib.md5(b)
         h = self.srchash = m.hexdigest()
-        self.sources[value] = h
-        if self._dump_mutations:
-            self.dump()
+        if self.sources.get(value, None) != h:
+            self.sources[value] = h
+            self._set_source(value, h)
 
+    @locked
     def hash(self, key):
         """Returns the hash of a particular key. Only strings, bytes,
         and tuples of str or bytes are allowed.
+
+        Hashes are memoized in a bounded LRU, but only for keys that are
+        small. Large keys, such as frames whose key contains an entire
+        LaTeX document, are only remembered by identity for the most recent
+        key, so that the cache never keeps their contents alive.
         """
-        h = self._hashes.get(key, None)
-        if h is not None:
-            return h
+        if key is self._last_key:
+            return self._last_hash
+        small = key_size(key) <= self.memo_key_size
+        if small:
+            h = self._hashes.get(key, None)
+            if h is not None:
+                self._hashes.move_to_end(key)
+                return h
         m = hashlib.md5()
         if isinstance(key, str):
-            m.update(key.encode())
+            _update_str(m, key)
         elif isinstance(key, bytes):
             m.update(key)
         elif isinstance(key, Sequence):
             for k in key:
                 if isinstance(k, str):
-                    m.update(k.encode())
-                elif isinstance(k, str):
+                    _update_str(m, k)
+                elif isinstance(k, bytes):
                     m.update(k)
                 else:
                     msg = 'Assets {0!r} in {1!r} is not a str or bytes'
@@ -82,81 +524,1035 @@ class AssetsCache(MutableMapping):
         else:
             msg = 'Assets key {0!r} is not a str or bytes'
             raise TypeError(msg.format(key))
-        h = self._hashes[key] = m.hexdigest()
+        h = m.hexdigest()
+        if small:
+            self._hashes[key] = h
+            if len(self._hashes) > self.memo_size:
+                self._hashes.popitem(last=False)
+        self._last_key = key
+        self._last_hash = h
         return h
 
-    def gc(self):
-        """Remove elements from the cache that are gone from the file system"""
-        # find the bad entries
-        bad = set()
-        for key, (filename, sources) in self.cache.items():
-            if not os.path.isfile(filename):
-                bad.add(key)
+    @locked
+    def path(self, key, ext, assets_dir=None):
+        """Returns the path where the asset for a key should be stored,
+        according to the layout of the cache. Any needed directories are
+        created.
+        """
+        if assets_dir is None:
+            assets_dir = self.assets_dir
+        filename = asset_path(assets_dir, self.hash(key), ext, self.layout)
+        d = os.path.dirname(filename)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        return filename
+
+    def _migrated_path(self, m, filename):
+        """Returns where an existing asset should move to in order to match
+        the current layout, or None if it should stay put. Only assets in the
+        assets directory that are named after their hash are moved.
+        """
+        d, base = os.path.split(filename)
+        h, ext = os.path.splitext(base)
+        if h != m:
+            return None
+        flat = asset_path(self.assets_dir, m, ext, 'flat')
+        sharded = asset_path(self.assets_dir, m, ext, 'sharded')
+        if filename not in (flat, sharded):
+            return None
+        new = sharded if self.layout == 'sharded' else flat
+        return None if new == filename else new
+
+    def _migrate(self, m, entry):
+        """Moves an entry's file to match the layout, returning the new
+        filename.
+        """
+        filename, sources = entry
+        new = self._migrated_path(m, filename)
+        if new is None or not os.path.isfile(filename):
+            return filename
+        d = os.path.dirname(new)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        os.replace(filename, new)
+        self._put_entry(m, [new, dict(sources)], None)
+        return new
+
+    @locked
+    def migrate(self):
+        """Moves all assets to match the current layout. Returns the number
+        of assets that were moved.
+        """
+        n = 0
+        with self.batch():
+            for m, entry in self._entries():
+                if self._migrate(m, entry) != entry[0]:
+                    n += 1
+        return n
+
+    def keys_for_source(self, srcfile):
+        """Returns the set of key hashes that belong to a source file."""
+        return {m for m, (_, sources) in self._entries() if srcfile in sources}
+
+    def keys_for_kind(self, kind):
+        """Returns the set of key hashes for assets of a given kind."""
+        return {m for m, info in self._infos() if info.get('kind', None) == kind}
+
+    @locked
+    def register_version(self, kind, version):
+        """Declares the current version of the producer of a kind of asset.
+        Assets of that kind made by other versions become stale and are
+        removed by gc(). Returns the number of stale assets of this kind.
+        """
+        if self.versions.get(kind, None) == version:
+            return 0
+        self.versions[kind] = version
+        self._set_version(kind, version)
+        n = len(self.stale_versions().get(kind, ()))
+        if n:
+            print('the {0} renderer has changed; {1} cached {0} assets are '
+                  'stale'.format(kind, n))
+        return n
+
+    @locked
+    def stale_versions(self):
+        """Returns a dict mapping kinds to the set of hashes of assets made
+        by a different version of the producer than the current one.
+        """
+        stale = {}
+        for m, info in self._infos():
+            kind = info.get('kind', None)
+            if kind not in self.versions:
                 continue
-            # remove sources whose hashes no longer match
-            bad_srcs = {s for s, h in sources.items() if h != self.sources.get(s, '')}
-            for s in bad_srcs:
-                del sources[s]
+            if info.get('version', None) != self.versions[kind]:
+                stale.setdefault(kind, set()).add(m)
+        return stale
+
+    def _gc_candidates(self):
+        """Finds entries that should be garbage collected. Returns a dict
+        mapping hashes of bad entries to their entry, and a dict mapping hashes
+        of entries with stale sources to the set of those sources.
+        """
+        entries = dict(self._entries())
+        existing = existing_files(filename for filename, _ in entries.values())
+        bad = {m: entry for m, entry in entries.items()
+               if entry[0] not in existing or not entry[1]}
+        stale = {}
+        for srcfile in self.sources_with_assets():
+            srchash = self.sources.get(srcfile, '')
+            for m in self.keys_for_source(srcfile):
+                if m in bad:
+                    continue
+                entry = entries[m]
+                if entry[1][srcfile] != srchash:
+                    stale.setdefault(m, set()).add(srcfile)
+        for m, srcfiles in list(stale.items()):
             # if there are no sources for this file anymore, remove the entry.
-            if not sources:
-                bad.add(key)
-        # remove bad entries
-        for b in bad:
-            filename, sources = self.cache.pop(b, ['', {}])
-            if os.path.isfile(filename):
-                os.remove(filename)
-        if self._dump_mutations:
-            self.dump()
+            if len(srcfiles) == len(entries[m][1]):
+                bad[m] = entries[m]
+                del stale[m]
+        return bad, stale
+
+    def sources_with_assets(self):
+        """Returns the set of source files that have assets in the cache."""
+        return {s for _, (_, sources) in self._entries() for s in sources}
+
+    @locked
+    def gc(self, dry_run=False, max_workers=8):
+        """Remove elements from the cache that are gone from the file system,
+        or whose source files have changed. Returns a GCReport of what was
+        (or, for a dry run, would be) removed.
+        """
+        bad, stale = self._gc_candidates()
+        # assets from old versions of their producers
+        for kind, ms in self.stale_versions().items():
+            for m in ms:
+                if m not in bad:
+                    entry = self._get_entry(m)
+                    if entry is not None:
+                        bad[m] = entry
+                        stale.pop(m, None)
+        report = GCReport(bad)
+        if dry_run:
+            return report
+        with self.batch():
+            for m, srcfiles in stale.items():
+                self._unlink_entry(m, srcfiles)
+            for m in bad:
+                self._del_entry(m)
+        remove_files([filename for filename, _ in bad.values()],
+                     max_workers=max_workers)
+        report.total_bytes += self.prune_blobs()
+        return report
+
+    def dedupe(self, filename):
+        """Content-addresses a newly made asset file. If an identical file is
+        already in the store, from this or any other lecture, filename is
+        replaced by a hard link to it. Returns True if the file was
+        deduplicated.
+        """
+        ext = os.path.splitext(filename)[1]
+        blob = asset_path(os.path.join(self.assets_dir, 'blobs'),
+                          file_digest(filename), ext, layout='sharded')
+        try:
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.link(filename, blob)
+                return False
+            if os.path.samefile(blob, filename):
+                return False
+            tmpname = filename + '.dedupe'
+            os.link(blob, tmpname)
+            os.replace(tmpname, filename)
+            return True
+        except OSError:
+            # links not supported, or another process won the race
+            return False
+
+    def prune_blobs(self):
+        """Removes content-addressed files that are no longer linked to by
+        any asset. Returns the number of bytes reclaimed.
+        """
+        nbytes = 0
+        for root, dirs, files in os.walk(os.path.join(self.assets_dir, 'blobs')):
+            for name in files:
+                blob = os.path.join(root, name)
+                try:
+                    st = os.stat(blob)
+                    if st.st_nlink == 1:
+                        os.remove(blob)
+                        nbytes += st.st_size
+                except OSError:
+                    pass
+        return nbytes
+
+    def _link_entry(self, m, filename, srcfile, srchash, info):
+        """Sets an entry's filename and info, and adds a source to it."""
+        curr = self._get_entry(m)
+        sources = {} if curr is None else dict(curr[1])
+        sources[srcfile] = srchash
+        self._put_entry(m, [filename, sources], info['kind'])
+        self._set_info(m, info)
+
+    def _touch(self, m, filename, kind):
+        """Records that an asset has been used."""
+        self._used.add(m)
+        info = self._get_info(m) or {}
+        now = time.time()
+        if info.get('kind', None) == kind and 'size' in info and \
+                now - (info.get('atime', None) or 0.0) < self.touch_interval:
+            return
+        size = info['size'] if info.get('size', None) is not None else \
+               file_size(filename)
+        self._set_info(m, {'kind': kind, 'size': size, 'atime': now,
+                           'version': info.get('version', None)})
+
+    def total_bytes(self):
+        """Returns the total size of the assets with known sizes."""
+        return sum(info.get('size', None) or 0 for _, info in self._infos())
+
+    def _evictable(self, m, info):
+        if m in self._used or 'kind' not in info:
+            # assets of unknown kind might be expensive, so leave them be
+            return False
+        return info['kind'] not in self.policy.pinned
+
+    @locked
+    def evict(self, limit=None):
+        """Evicts assets according to the cache's eviction policy, least
+        recently used first. At most limit assets are evicted, if given.
+        Returns the number evicted; running totals are kept in the
+        eviction_stats attribute.
+        """
+        policy = self.policy
+        if policy is None or (policy.max_bytes is None and policy.max_age is None):
+            return 0
+        queue = self._evict_queue
+        if queue is None:
+            queue = self._evict_queue = [(info.get('atime', None) or 0.0, m)
+                                         for m, info in self._infos()
+                                         if self._evictable(m, info)]
+            heapq.heapify(queue)
+        now = time.time()
+        n = 0
+        total = self.total_bytes() if policy.max_bytes is not None else 0
+        with self.batch():
+            while queue and (limit is None or n < limit):
+                atime, m = queue[0]
+                info = self._get_info(m)
+                if info is None or not self._evictable(m, info):
+                    heapq.heappop(queue)
+                    continue
+                curr = info.get('atime', None) or 0.0
+                if curr != atime:
+                    # used since the queue was built
+                    heapq.heapreplace(queue, (curr, m))
+                    continue
+                expired = policy.max_age is not None and now - atime > policy.max_age
+                over = policy.max_bytes is not None and total > policy.max_bytes
+                if not (expired or over):
+                    # everything else in the queue was used more recently
+                    break
+                heapq.heappop(queue)
+                size = info.get('size', None) or 0
+                entry = self._get_entry(m)
+                self._del_entry(m)
+                if entry is not None:
+                    remove_files([entry[0]])
+                self.eviction_stats.add(info['kind'], size)
+                total -= size
+                n += 1
+        return n
+
+    def _unlink_entry(self, m, srcfiles):
+        """Removes sources from an entry."""
+        filename, sources = self._get_entry(m)
+        sources = {s: h for s, h in sources.items() if s not in srcfiles}
+        self._put_entry(m, [filename, sources], None)
 
     #
     # mutable mapping interface
     #
 
     def __len__(self):
-        return len(self.cache)
+        return self._len_entries()
 
     def __iter__(self):
-        yield from self.cache
+        for m, _ in self._entries():
+            yield m
 
+    @locked
     def __contains__(self, key):
         m = self.hash(key)
-        return m in self.cache
+        if self._get_entry(m) is not None:
+            return True
+        # another process may have produced it in the meantime
+        self.refresh()
+        if self._get_entry(m) is not None:
+            return True
+        return self._fetch_upstream(key, m)
+
+    def _fetch_upstream(self, key, m):
+        """Looks for an asset in the upstream stores, in order, bringing it
+        into the local cache if found. Returns whether it was found.
+        """
+        for store in self.upstreams:
+            src = store.find(m)
+            if src is None:
+                continue
+            _, ext = os.path.splitext(src)
+            dst = self.path(key, ext)
+            link_or_copy(src, dst, hardlink=store.hardlink)
+            self[key] = dst
+            return True
+        return False
 
+    @locked
     def __getitem__(self, key):
         m = self.hash(key)
-        return self.cache[m][0]
+        entry = self._get_entry(m)
+        if entry is None and self._fetch_upstream(key, m):
+            entry = self._get_entry(m)
+        if entry is None:
+            raise KeyError(key)
+        # transparently move assets from other layouts as they are used
+        filename = self._migrate(m, entry)
+        self._touch(m, filename, asset_kind(key))
+        return filename
 
+    @locked
     def __setitem__(self, key, value):
         m = self.hash(key)
-        curr = self.cache[m] = self.cache.get(m, ['', {}])
-        curr[0] = value
-        curr[1][self.srcfile] = self.srchash
-        if self._dump_mutations:
-            self.dump()
+        self._used.add(m)
+        curr = self._get_entry(m)
+        if curr is not None and curr[0] == value and \
+                curr[1].get(self.srcfile, None) == self.srchash:
+            # nothing changed, so there is nothing to write
+            return
+        kind = asset_kind(key)
+        info = {'kind': kind, 'size': file_size(value), 'atime': time.time(),
+                'version': self.versions.get(kind, None)}
+        self._link_entry(m, value, self.srcfile, self.srchash, info)
+        if self.publish and self.upstreams and info['size'] is not None:
+            self.upstreams[0].publish(m, value, self.layout)
+        if self.policy is not None:
+            self.evict(limit=self.policy.batch_size)
 
+    @locked
     def __delitem__(self, key):
         m = self.hash(key)
-        del self.cache[m]
-        if self._dump_mutations:
-            self.dump()
-
-    def update(self, *args, **kwargs):
-        """Update that only dumps back to the file at the end"""
-        orig = self._dump_mutations
-        if orig:
-            self._dump_mutations = False
-        d = dict(*args, **kwargs)
-        for k, v in d.items():
-            self[k] = v
-        self._dump_mutations = orig
-        if orig and d:
-            self.dump()
+        if self._get_entry(m) is None:
+            raise KeyError(key)
+        self._del_entry(m)
 
+    @locked
     def clear(self):
         """Removes all elements from the cache"""
+        self._clear_entries()
+
+
+class AssetsCache(BaseAssetsCache):
+    """A cache for indexing static data on the filesystem.
+
+    The cache is stored as a JSON snapshot (the cachefile) plus an
+    append-only journal (the cachefile with a ``.journal`` extension). Each
+    mutation appends a single compact record to the journal, and the
+    journal is folded back into the snapshot when it grows larger than
+    the snapshot itself (or the compact threshold), or when the cache is
+    closed. Loading replays the journal on top of the snapshot.
+
+    Many processes may share the same cache. Writes take an advisory lock
+    on a ``.lock`` file next to the cachefile, replay any records that other
+    processes have appended since the last read, and only then append
+    their own. Snapshots are written to a temporary file and renamed into
+    place, so a crash never leaves a truncated cachefile behind.
+    """
+
+    def __init__(self, cachefile, srcfile, *args, compact_threshold=1 << 20,
+                 **kwargs):
+        """Requires a cache filename and a srcfile that all assests come from.
+        The compact threshold is the minimum size [bytes] the journal may grow
+        to before it is compacted into the snapshot. All other args and kwargs
+        are treated as arguments to dict().
+        """
+        self.cachefile = cachefile
+        self.journalfile = cachefile + '.journal'
+        self.lockfile = cachefile + '.lock'
+        self.compact_threshold = compact_threshold
+        self._journal = None
+        self._journal_pos = self._snapshot_size = 0
+        self._snapshot_id = None
+        # the cache maps md5 sums of keys to a 2-list of ['filename', {'srcfile': 'srchash'}]
+        self.cache = {}
+        # maps md5 sums of keys to dicts of the asset's kind, size, and atime
+        self.info = {}
+        self._total_bytes = 0
+        # reverse index mapping source files to the set of hashes from them
+        self._srckeys = defaultdict(set)
+        super().__init__(srcfile, *args, **kwargs)
+
+    def _stat_snapshot(self):
+        try:
+            st = os.stat(self.cachefile)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self):
+        """Loads the snapshot into the cache and replays the journal."""
+        with file_lock(self.lockfile, exclusive=False):
+            self._load()
+
+    def _load(self):
         self.cache.clear()
-        if self._dump_mutations:
+        self.info.clear()
+        self._total_bytes = 0
+        self._srckeys.clear()
+        self._journal_pos = self._snapshot_size = 0
+        self._snapshot_id = self._stat_snapshot()
+        if self._snapshot_id is not None:
+            with open(self.cachefile, 'r') as f:
+                data = json.load(f)
+            self.cache.update(data.get('cache', ()))
+            self.sources.update(data.get('sources', ()))
+            for m, entry in self.cache.items():
+                self._index(m, entry)
+            for m, info in data.get('info', {}).items():
+                self._update_info(m, info)
+            self.versions.update(data.get('versions', ()))
+            self._snapshot_size = self._snapshot_id[2]
+        self._read_journal()
+
+    def _read_journal(self):
+        """Replays journal records past the current position."""
+        try:
+            f = open(self.journalfile, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self._journal_pos)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # record still being written
+                    break
+                self._journal_pos += len(line)
+                try:
+                    record = json.loads(line.decode())
+                except ValueError:
+                    # partially written record from an interrupted process
+                    continue
+                self._replay(record)
+
+    @locked
+    def refresh(self):
+        """Picks up changes written by other processes. If another process
+        has compacted the cache since it was last read, the snapshot is
+        reloaded, otherwise only new journal records are replayed.
+        """
+        with file_lock(self.lockfile, exclusive=False):
+            self._refresh()
+
+    def _refresh(self):
+        try:
+            journal_size = os.path.getsize(self.journalfile)
+        except FileNotFoundError:
+            journal_size = 0
+        if self._stat_snapshot() != self._snapshot_id or \
+                journal_size < self._journal_pos:
+            self._load()
+            if self.srcfile is not None:
+                self.sources[self.srcfile] = self.srchash
+        elif journal_size > self._journal_pos:
+            self._read_journal()
+
+    def _replay(self, record):
+        """Applies a single journal record to the in-memory cache."""
+        op = record['op']
+        m = record.get('h', None)
+        if op == 'set':
+            self._unindex(m)
+            self.cache[m] = record['v']
+            self._index(m, record['v'])
+        elif op == 'link':
+            self._unindex(m)
+            filename, sources = self.cache.get(m, ('', {}))
+            entry = self.cache[m] = [record['f'], dict(sources)]
+            entry[1][record['s']] = record['sh']
+            self._index(m, entry)
+            if 'i' in record:
+                self._update_info(m, record['i'])
+        elif op == 'info':
+            self._update_info(m, record['i'])
+        elif op == 'unlink':
+            if m not in self.cache:
+                return
+            self._unindex(m)
+            entry = self.cache[m]
+            entry[1] = {s: h for s, h in entry[1].items() if s not in record['s']}
+            self._index(m, entry)
+        elif op == 'del':
+            self._unindex(m)
+            self.cache.pop(m, None)
+            self._update_info(m, None)
+        elif op == 'src':
+            self.sources[record['f']] = m
+        elif op == 'ver':
+            self.versions[record['k']] = record['v']
+        elif op == 'clear':
+            self.cache.clear()
+            self.info.clear()
+            self._total_bytes = 0
+            self._srckeys.clear()
+
+    def _append(self, record):
+        """Appends a record to the journal. The lock must be held."""
+        if self._journal is None:
+            self._journal = open(self.journalfile, 'ab')
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode()
+        self._journal.write(line)
+        self._journal.flush()
+        self._journal_pos += len(line)
+
+    def _log(self, record):
+        """Applies a record and appends it to the journal, after merging in
+        any records from other processes. Compacts the journal if needed.
+        """
+        with file_lock(self.lockfile):
+            self._refresh()
+            self._replay(record)
+            self._append(record)
+            if self._journal_pos > max(self.compact_threshold, self._snapshot_size):
+                self._dump()
+
+    @locked
+    def dump(self):
+        """Writes a snapshot of the cache to the filesystem and truncates
+        the journal.
+        """
+        with file_lock(self.lockfile):
+            self._refresh()
+            self._dump()
+
+    def _update_info(self, m, info):
+        """Sets (or, if info is None, removes) an asset's info, keeping the
+        total size up to date.
+        """
+        old = self.info.pop(m, None)
+        if old is not None:
+            self._total_bytes -= old.get('size', None) or 0
+        if info is not None:
+            self.info[m] = info
+            self._total_bytes += info.get('size', None) or 0
+
+    def _dump(self):
+        data = {'cache': self.cache, 'sources': self.sources, 'info': self.info,
+                'versions': self.versions}
+        d = os.path.dirname(self.cachefile) or '.'
+        fd, tmpname = tempfile.mkstemp(prefix='.assets-', suffix='.json', dir=d)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=' ', sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpname, self.cachefile)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        self._snapshot_id = self._stat_snapshot()
+        self._snapshot_size = self._snapshot_id[2]
+        # truncate in place, so other processes' open handles stay valid
+        if os.path.exists(self.journalfile):
+            with open(self.journalfile, 'r+b') as f:
+                f.truncate(0)
+        self._journal_pos = 0
+
+    @locked
+    def close(self):
+        """Compacts the journal into the snapshot and closes the cache."""
+        if self._journal is not None or self._journal_pos > 0 or \
+                self._snapshot_id is None:
             self.dump()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @locked
+    def gc(self, dry_run=False, max_workers=8):
+        """Remove elements from the cache that are gone from the file system,
+        or whose source files have changed. Returns a GCReport of what was
+        (or, for a dry run, would be) removed.
+        """
+        self.refresh()
+        report = super().gc(dry_run=dry_run, max_workers=max_workers)
+        # collections touch many entries, so write them out in one go
+        if report.removed and not dry_run:
+            self.dump()
+        return report
+
+    def keys_for_source(self, srcfile):
+        """Returns the set of key hashes that belong to a source file."""
+        return set(self._srckeys.get(srcfile, ()))
+
+    def sources_with_assets(self):
+        """Returns the set of source files that have assets in the cache."""
+        return {s for s, keys in self._srckeys.items() if keys}
+
+    def _index(self, m, entry):
+        for srcfile in entry[1]:
+            self._srckeys[srcfile].add(m)
+
+    def _unindex(self, m):
+        entry = self.cache.get(m, None)
+        if entry is None:
+            return
+        for srcfile in entry[1]:
+            self._srckeys[srcfile].discard(m)
+
+    #
+    # entry storage
+    #
+
+    def _get_entry(self, m):
+        return self.cache.get(m, None)
+
+    def _put_entry(self, m, entry, kind):
+        self._log({'op': 'set', 'h': m, 'v': entry})
+
+    def _link_entry(self, m, filename, srcfile, srchash, info):
+        self._log({'op': 'link', 'h': m, 'f': filename, 's': srcfile,
+                   'sh': srchash, 'i': info})
+
+    def _get_info(self, m):
+        return self.info.get(m, None)
+
+    def _set_info(self, m, info):
+        self._log({'op': 'info', 'h': m, 'i': info})
+
+    def _infos(self):
+        return list(self.info.items())
+
+    def total_bytes(self):
+        """Returns the total size of the assets with known sizes."""
+        return self._total_bytes
+
+    def _unlink_entry(self, m, srcfiles):
+        self._log({'op': 'unlink', 'h': m, 's': sorted(srcfiles)})
+
+    def _del_entry(self, m):
+        self._log({'op': 'del', 'h': m})
+
+    def _entries(self):
+        return list(self.cache.items())
+
+    def _len_entries(self):
+        return len(self.cache)
+
+    def _clear_entries(self):
+        self._log({'op': 'clear'})
+
+    def _set_source(self, srcfile, srchash):
+        self._log({'op': 'src', 'f': srcfile, 'h': srchash})
+
+    def _set_version(self, kind, version):
+        self._log({'op': 'ver', 'k': kind, 'v': version})
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS assets (
+    hash TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT '',
+    size INTEGER,
+    atime REAL,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS assets_kind ON assets (kind);
+CREATE INDEX IF NOT EXISTS assets_atime ON assets (atime);
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO totals (id, bytes) VALUES (0, 0);
+CREATE TRIGGER IF NOT EXISTS assets_insert_size AFTER INSERT ON assets BEGIN
+    UPDATE totals SET bytes = bytes + IFNULL(NEW.size, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS assets_update_size AFTER UPDATE OF size ON assets BEGIN
+    UPDATE totals SET bytes = bytes + IFNULL(NEW.size, 0) - IFNULL(OLD.size, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS assets_delete_size AFTER DELETE ON assets BEGIN
+    UPDATE totals SET bytes = bytes - IFNULL(OLD.size, 0);
+END;
+CREATE TABLE IF NOT EXISTS asset_sources (
+    hash TEXT NOT NULL,
+    srcfile TEXT NOT NULL,
+    srchash TEXT NOT NULL,
+    PRIMARY KEY (hash, srcfile)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS asset_sources_srcfile ON asset_sources (srcfile);
+CREATE TABLE IF NOT EXISTS sources (
+    srcfile TEXT PRIMARY KEY,
+    srchash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    kind TEXT PRIMARY KEY,
+    version TEXT
+);
+"""
+
+
+class SqliteAssetsCache(BaseAssetsCache):
+    """An assets cache stored in an SQLite database. Assets are indexed by
+    key hash, source file, and asset kind, so that queries such as "which
+    assets belong to this source" do not need to scan the whole cache.
+    The database runs in WAL mode so that readers are not blocked by
+    writers.
+    """
+
+    def __init__(self, cachefile, srcfile, *args, **kwargs):
+        """Requires a database filename and a srcfile that all assests come
+        from. All other args and kwargs are treated as arguments to dict().
+        """
+        self.cachefile = cachefile
+        # the connection is guarded by the cache's lock, so that the
+        # cache may be shared by threads
+        self.db = sqlite3.connect(cachefile, isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SQLITE_SCHEMA)
+        self._batch_depth = 0
+        super().__init__(srcfile, *args, **kwargs)
+
+    def load(self):
+        """Loads the current source hashes from the database."""
+        self.sources.update(self.db.execute('SELECT srcfile, srchash FROM sources'))
+        self.versions.update(self.db.execute('SELECT kind, version FROM versions'))
+
+    @locked
+    def refresh(self):
+        """Picks up source hashes written by other processes. Entries are
+        always read directly from the database, so are never out of date.
+        """
+        self.load()
+        if self.srcfile is not None:
+            self.sources[self.srcfile] = self.srchash
+
+    @locked
+    def close(self):
+        """Closes the database connection."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Context manager that applies all updates within it in a single
+        transaction. Batches may be nested.
+        """
+        with self._lock:
+            if self._batch_depth == 0:
+                # take the write lock up front, since a deferred transaction
+                # that reads and then writes fails outright if another
+                # process has committed in the meantime
+                self.db.execute('BEGIN IMMEDIATE')
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    self.db.execute('ROLLBACK')
+                raise
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.db.execute('COMMIT')
+
+    def update(self, *args, **kwargs):
+        """Update that applies all items in a single transaction."""
+        with self.batch():
+            super().update(*args, **kwargs)
+
+    def keys_for_source(self, srcfile):
+        """Returns the set of key hashes that belong to a source file."""
+        cur = self.db.execute('SELECT hash FROM asset_sources WHERE srcfile = ?',
+                              (srcfile,))
+        return {m for (m,) in cur}
+
+    def keys_for_kind(self, kind):
+        """Returns the set of key hashes for assets of a given kind."""
+        cur = self.db.execute('SELECT hash FROM assets WHERE kind = ?', (kind,))
+        return {m for (m,) in cur}
+
+    def sources_with_assets(self):
+        """Returns the set of source files that have assets in the cache."""
+        cur = self.db.execute('SELECT DISTINCT srcfile FROM asset_sources')
+        return {s for (s,) in cur}
+
+    def _gc_candidates(self):
+        filenames = dict(self.db.execute('SELECT hash, filename FROM assets'))
+        existing = existing_files(filenames.values())
+        bad = {m for m, filename in filenames.items() if filename not in existing}
+        # entries with no source links that match the current source hashes
+        cur = self.db.execute(
+            'SELECT hash FROM assets WHERE NOT EXISTS ('
+            'SELECT 1 FROM asset_sources JOIN sources '
+            'ON sources.srcfile = asset_sources.srcfile '
+            'AND sources.srchash = asset_sources.srchash '
+            'WHERE asset_sources.hash = assets.hash)')
+        bad.update(m for (m,) in cur)
+        stale = {}
+        cur = self.db.execute(
+            'SELECT asset_sources.hash, asset_sources.srcfile FROM asset_sources '
+            'LEFT JOIN sources ON sources.srcfile = asset_sources.srcfile '
+            'AND sources.srchash = asset_sources.srchash '
+            'WHERE sources.srcfile IS NULL')
+        for m, srcfile in cur:
+            if m not in bad:
+                stale.setdefault(m, set()).add(srcfile)
+        return {m: self._get_entry(m) for m in bad}, stale
+
+    #
+    # entry storage
+    #
+
+    def _get_entry(self, m):
+        row = self.db.execute('SELECT filename FROM assets WHERE hash = ?',
+                              (m,)).fetchone()
+        if row is None:
+            return None
+        cur = self.db.execute('SELECT srcfile, srchash FROM asset_sources '
+                              'WHERE hash = ?', (m,))
+        return [row[0], dict(cur)]
+
+    def _put_entry(self, m, entry, kind):
+        filename, sources = entry
+        with self.batch():
+            if kind is None:
+                self.db.execute('UPDATE assets SET filename = ? WHERE hash = ?',
+                                (filename, m))
+            else:
+                self.db.execute('INSERT INTO assets (hash, filename, kind) '
+                                'VALUES (?, ?, ?) ON CONFLICT (hash) DO UPDATE '
+                                'SET filename = excluded.filename, '
+                                'kind = excluded.kind', (m, filename, kind))
+            self.db.execute('DELETE FROM asset_sources WHERE hash = ?', (m,))
+            self.db.executemany('INSERT INTO asset_sources (hash, srcfile, srchash) '
+                                'VALUES (?, ?, ?)',
+                                [(m, s, h) for s, h in sources.items()])
+
+    def _link_entry(self, m, filename, srcfile, srchash, info):
+        with self.batch():
+            self.db.execute('INSERT INTO assets (hash, filename, kind, size, atime, '
+                            'version) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (hash) '
+                            'DO UPDATE SET filename = excluded.filename, '
+                            'kind = excluded.kind, size = excluded.size, '
+                            'atime = excluded.atime, version = excluded.version',
+                            (m, filename, info['kind'], info['size'], info['atime'],
+                             info.get('version', None)))
+            self.db.execute('INSERT OR REPLACE INTO asset_sources '
+                            '(hash, srcfile, srchash) VALUES (?, ?, ?)',
+                            (m, srcfile, srchash))
+
+    def _unlink_entry(self, m, srcfiles):
+        self.db.executemany('DELETE FROM asset_sources WHERE hash = ? AND srcfile = ?',
+                            [(m, s) for s in srcfiles])
+
+    def _del_entry(self, m):
+        with self.batch():
+            self.db.execute('DELETE FROM asset_sources WHERE hash = ?', (m,))
+            self.db.execute('DELETE FROM assets WHERE hash = ?', (m,))
+
+    def _entries(self):
+        entries = {m: [filename, {}] for m, filename in
+                   self.db.execute('SELECT hash, filename FROM assets')}
+        for m, s, h in self.db.execute('SELECT hash, srcfile, srchash '
+                                       'FROM asset_sources'):
+            if m in entries:
+                entries[m][1][s] = h
+        return list(entries.items())
+
+    def _get_info(self, m):
+        row = self.db.execute('SELECT kind, size, atime, version FROM assets '
+                              'WHERE hash = ?', (m,)).fetchone()
+        if row is None:
+            return None
+        return {'kind': row[0], 'size': row[1], 'atime': row[2], 'version': row[3]}
+
+    def _set_info(self, m, info):
+        self.db.execute('UPDATE assets SET kind = ?, size = ?, atime = ?, '
+                        'version = ? WHERE hash = ?',
+                        (info['kind'], info['size'], info['atime'],
+                         info.get('version', None), m))
+
+    def _infos(self):
+        cur = self.db.execute('SELECT hash, kind, size, atime, version FROM assets')
+        return [(m, {'kind': k, 'size': size, 'atime': atime, 'version': version})
+                for m, k, size, atime, version in cur]
+
+    def total_bytes(self):
+        """Returns the total size of the assets with known sizes, which
+        triggers on the assets table keep up to date.
+        """
+        return self.db.execute('SELECT bytes FROM totals').fetchone()[0]
+
+    def _len_entries(self):
+        return self.db.execute('SELECT COUNT(*) FROM assets').fetchone()[0]
+
+    def _clear_entries(self):
+        with self.batch():
+            self.db.execute('DELETE FROM asset_sources')
+            self.db.execute('DELETE FROM assets')
+
+    def _set_source(self, srcfile, srchash):
+        self.db.execute('INSERT INTO sources (srcfile, srchash) VALUES (?, ?) '
+                        'ON CONFLICT (srcfile) DO UPDATE SET srchash = excluded.srchash',
+                        (srcfile, srchash))
+
+    def _set_version(self, kind, version):
+        self.db.execute('INSERT INTO versions (kind, version) VALUES (?, ?) '
+                        'ON CONFLICT (kind) DO UPDATE SET version = excluded.version',
+                        (kind, version))
+
+
+BUNDLE_MANIFEST = 'manifest.json'
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def _tar_mode(archive, mode):
+    """Picks the tarfile compression from the archive's file extension."""
+    for ext, comp in [('.tar.gz', 'gz'), ('.tgz', 'gz'), ('.tar.bz2', 'bz2'),
+                      ('.tar.xz', 'xz')]:
+        if archive.endswith(ext):
+            return mode + ':' + comp
+    return mode + ':'
+
+
+def export_bundle(assets, archive, srcfiles=None, kinds=None, max_age=None):
+    """Packs assets from a cache into a single tar archive, along with the
+    metadata needed to import them into another cache. Assets may be
+    filtered by source file, by kind, and by the maximum time [sec] since
+    they were last used. Returns the number of assets exported.
+    """
+    if srcfiles is None:
+        selected = {m for m, _ in assets._entries()}
+    else:
+        selected = set()
+        for srcfile in srcfiles:
+            selected |= assets.keys_for_source(srcfile)
+    infos = dict(assets._infos())
+    now = time.time()
+    manifest = {'sources': {}, 'assets': {}}
+    for m in sorted(selected):
+        entry = assets._get_entry(m)
+        if entry is None or not os.path.isfile(entry[0]):
+            continue
+        info = infos.get(m, {})
+        if kinds is not None and info.get('kind', None) not in kinds:
+            continue
+        if max_age is not None and now - (info.get('atime', None) or 0.0) > max_age:
+            continue
+        filename, sources = entry
+        if srcfiles is not None:
+            sources = {s: h for s, h in sources.items() if s in srcfiles}
+        _, ext = os.path.splitext(filename)
+        manifest['assets'][m] = {'name': 'assets/' + m + ext, 'sources': sources,
+                                 'info': info}
+        for srcfile in sources:
+            if srcfile in assets.sources:
+                manifest['sources'][srcfile] = assets.sources[srcfile]
+    with tarfile.open(archive, _tar_mode(archive, 'w')) as tar:
+        b = json.dumps(manifest, sort_keys=True).encode()
+        tarinfo = tarfile.TarInfo(BUNDLE_MANIFEST)
+        tarinfo.size = len(b)
+        tarinfo.mtime = now
+        tar.addfile(tarinfo, io.BytesIO(b))
+        for m, data in manifest['assets'].items():
+            tar.add(assets._get_entry(m)[0], arcname=data['name'])
+    return len(manifest['assets'])
+
+
+def import_bundle(assets, archive):
+    """Merges the assets in an archive made by export_bundle() into a cache.
+    Assets that the cache already has (by key hash) are skipped. Returns the
+    number of assets imported.
+    """
+    records = []
+    with tarfile.open(archive, _tar_mode(archive, 'r')) as tar:
+        manifest = json.load(tar.extractfile(BUNDLE_MANIFEST))
+        # extract outside of any transaction, so that other processes using
+        # the cache are not locked out for the whole import
+        for m, data in sorted(manifest['assets'].items()):
+            if not set(m) <= HEX_DIGITS:
+                raise ValueError('invalid asset hash {0!r} in {1}'.format(m, archive))
+            entry = assets._get_entry(m)
+            if entry is not None and os.path.isfile(entry[0]):
+                continue
+            _, ext = os.path.splitext(data['name'])
+            dst = asset_path(assets.assets_dir, m, ext, assets.layout)
+            os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(prefix='.import-',
+                                           dir=os.path.dirname(dst) or '.')
+            with tar.extractfile(data['name']) as src, os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(src, f)
+            os.replace(tmpname, dst)
+            records.append((m, dst, data))
+    # then record the entries in one short batch
+    with assets.batch():
+        for srcfile, srchash in manifest['sources'].items():
+            if srcfile not in assets.sources:
+                assets.sources[srcfile] = srchash
+                assets._set_source(srcfile, srchash)
+        for m, dst, data in records:
+            entry = assets._get_entry(m)
+            sources = dict(data['sources'])
+            if entry is not None:
+                sources.update(entry[1])
+            info = data.get('info', None) or {}
+            assets._put_entry(m, [dst, sources], info.get('kind', ''))
+            if info:
+                assets._set_info(m, info)
+    return len(records)
 
 
 class GC:
@@ -167,6 +1563,12 @@ class GC:
     def __init__(self, **kwargs):
         pass
 
-    def render(self, assets=None, **kwargs):
-        assets.gc()
+    def render(self, assets=None, dry_run=False, **kwargs):
+        for kind, stale in sorted(assets.stale_versions().items()):
+            print('{0} {1} assets are from an old renderer version'.format(
+                  len(stale), kind))
+        report = assets.gc(dry_run=dry_run)
+        if dry_run:
+            print('Garbage collection dry run:')
+        print(report, end='')
         return True
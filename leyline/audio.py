@@ -1,14 +1,22 @@
 """Tools for rendering audio from a document."""
 import os
+import re
 import sys
+import time
+import hashlib
 import queue
 import shutil
+import tempfile
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from lazyasd import lazyobject
 
 from leyline.ast import indent, Visitor
 from leyline.ansi import AnsiFormatter
 from leyline.context_visitor import ContextVisitor
+from leyline.assets import fingerprint, versioned_key
 
 
 @lazyobject
@@ -29,6 +37,152 @@ def sf():
     return soundfile
 
 
+@lazyobject
+def RE_SENTENCE_END():
+    return re.compile(r'(?<=[.!?])\s+')
+
+
+@lazyobject
+def RE_SSML_TAG():
+    return re.compile(r'<(/?)[^<>]*?(/?)>')
+
+
+@lazyobject
+def RE_ANSI_MARKUP():
+    # markers that AnsiFormatter draws around italics, subscripts, etc.
+    return re.compile('\x1b\\[32;1m([^\x1b]*)\x1b\\[0m')
+
+
+@lazyobject
+def RE_ANSI_ESCAPE():
+    return re.compile('\x1b\\[[0-9;]*[A-Za-z]')
+
+
+@lazyobject
+def RE_SPACE_BEFORE_PUNCT():
+    return re.compile(r'\s+(?=[.,;:!?)\]])|(?<=[(\[])\s+')
+
+
+def _speech_marker(m):
+    """Replaces an AnsiFormatter marker with its speech text. Emphasis stars
+    are dropped, the stars that join struck out words become '~', and list
+    bullets and numbers and sub- and superscript braces are kept.
+    """
+    marker, s = m.group(1), m.string
+    if marker != '*':
+        return marker
+    before = m.start() > 0 and not s[m.start() - 1].isspace()
+    after = m.end() < len(s) and not s[m.end()].isspace()
+    if before and after:
+        return '~'
+    elif before or after:
+        return ''
+    return marker
+
+
+def speech_text(s, casefold=False):
+    """Returns the canonical spoken form of an ANSI formatted block of text,
+    with escape sequences and emphasis removed and whitespace collapsed. Text
+    that would be read aloud the same way has the same speech text.
+    """
+    s = RE_ANSI_MARKUP.sub(_speech_marker, s)
+    s = RE_ANSI_ESCAPE.sub('', s)
+    s = ' '.join(s.split())
+    s = RE_SPACE_BEFORE_PUNCT.sub('', s)
+    if casefold:
+        s = s.casefold()
+    return s
+
+
+PARAGRAPH_BREAK = '<break time="0.3s" />'
+
+
+def _ssml_depth(s, depth=0):
+    """Computes the tag nesting depth at the end of an SSML fragment."""
+    for m in RE_SSML_TAG.finditer(s):
+        closing, selfclosing = m.groups()
+        if closing:
+            depth -= 1
+        elif not selfclosing:
+            depth += 1
+    return depth
+
+
+def _ssml_size(s, max_chars, max_bytes):
+    """Returns True if a string fits within the given budgets."""
+    if max_chars is not None and len(s) > max_chars:
+        return False
+    if max_bytes is not None and len(s.encode()) > max_bytes:
+        return False
+    return True
+
+
+def split_sentences(s, max_chars=None, max_bytes=None):
+    """Splits an SSML fragment at sentence boundaries into pieces which fit
+    within the budget. Splits only occur outside of tags, so that each piece
+    is well-formed on its own. A single sentence larger than the budget is
+    left whole.
+    """
+    sentences = []
+    depth = start = pos = 0
+    for m in RE_SENTENCE_END.finditer(s):
+        depth = _ssml_depth(s[pos:m.start()], depth)
+        pos = m.start()
+        if depth == 0:
+            sentences.append(s[start:m.end()])
+            start = m.end()
+    sentences.append(s[start:])
+    pieces = []
+    curr = ''
+    for sentence in sentences:
+        if curr and not _ssml_size(curr + sentence, max_chars, max_bytes):
+            pieces.append(curr)
+            curr = ''
+        curr += sentence
+    if curr:
+        pieces.append(curr)
+    return pieces
+
+
+def pack_ssml(paragraphs, max_chars=3000, max_bytes=None, period=4):
+    """Packs SSML paragraphs into as few ``<speak>`` documents as possible.
+    Adjacent paragraphs are merged until adding another would exceed the
+    character or byte budget. Paragraphs that are too large on their own are
+    split at sentence boundaries.
+
+    To keep blocks stable across edits (and so reusable from the assets
+    cache), a block is also closed after any paragraph whose content hash is
+    divisible by ``period``. An edit therefore only changes the blocks up to
+    the next such content-defined boundary, rather than shifting every
+    block that comes after it.
+    """
+    wrap_size = len('<speak></speak>')
+    if max_chars is not None:
+        max_chars -= wrap_size
+    if max_bytes is not None:
+        max_bytes -= wrap_size
+    blocks = []
+    curr = ''
+    for p in paragraphs:
+        p += PARAGRAPH_BREAK
+        if not _ssml_size(p, max_chars, max_bytes):
+            if curr:
+                blocks.append(curr)
+                curr = ''
+            blocks.extend(split_sentences(p, max_chars, max_bytes))
+            continue
+        if curr and not _ssml_size(curr + p, max_chars, max_bytes):
+            blocks.append(curr)
+            curr = ''
+        curr += p
+        if period and int(hashlib.md5(p.encode()).hexdigest(), 16) % period == 0:
+            blocks.append(curr)
+            curr = ''
+    if curr:
+        blocks.append(curr)
+    return ['<speak>' + block + '</speak>' for block in blocks]
+
+
 class SSML(ContextVisitor):
     """Renders an AST as Speech Synthesis Markup Language (SSML).
     Visiting this will return a list of SSML strings, broken up by
@@ -37,31 +191,39 @@ class SSML(ContextVisitor):
 
     renders = 'audio'
 
-    def render(self, *, tree=None, filename='', polly_user=None, **kwargs):
+    def __init__(self, *, max_chars=3000, max_bytes=None, **kwargs):
+        """
+        Parameters
+        ----------
+        max_chars : int or None, optional
+            Maximum number of characters in a single SSML block.
+        max_bytes : int or None, optional
+            Maximum number of UTF-8 encoded bytes in a single SSML block.
+        kwargs : optional
+            All additional kwargs are passed to superclass.
+        """
+        super().__init__(**kwargs)
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+
+    def render(self, *, tree=None, filename='', polly_user=None, assets=None,
+               assets_dir='.', polly_workers=4, **kwargs):
         """Performs the actual render, putting the notes file on disk."""
         blocks = self.visit(tree)
         basename, _ = os.path.splitext(filename)
         outfile = basename + '.mp3'
-        self._render_with_polly(blocks, outfile, polly_user)
+        self._render_with_polly(blocks, outfile, polly_user, assets=assets,
+                                assets_dir=assets_dir, max_workers=polly_workers)
         return True
 
-    def _render_with_polly(self, blocks, outfile, user):
-        from boto3 import Session
-        from botocore.exceptions import BotoCoreError, ClientError
-        session = Session(profile_name=user)
-        polly = session.client("polly")
-        nblocks = len(blocks)
-        aud = b''
-        for i, ssml in enumerate(blocks):
-            print('{0}/{1}\r'.format(i, nblocks), end='')
-            sys.stdout.flush()
-            response = polly.synthesize_speech(Text=ssml,
-                                               TextType='ssml',
-                                               VoiceId='Matthew',
-                                               OutputFormat='mp3')
-            aud += response["AudioStream"].read()
-        with open(outfile, 'bw') as f:
-            f.write(aud)
+    def _render_with_polly(self, blocks, outfile, user, assets=None,
+                           assets_dir='.', max_workers=4, client=None):
+        if client is None:
+            from boto3 import Session
+            session = Session(profile_name=user)
+            client = session.client("polly")
+        synth = PollySynthesizer(client, max_workers=max_workers)
+        synth.render(blocks, outfile, assets=assets, assets_dir=assets_dir)
         print('Done... ' + outfile)
 
     def _bodied_visit(self, node):
@@ -75,10 +237,10 @@ class SSML(ContextVisitor):
 
     def visit_document(self, node):
         s = self._bodied_visit(node)
-        # break up by paragraph
-        blocks = s.split('\n\n')
-        for i in range(len(blocks)):
-            blocks[i] = '<speak>' + blocks[i] + '<break time="0.3s" /></speak>'
+        # break up by paragraph, then pack into as few requests as possible
+        paragraphs = s.split('\n\n')
+        blocks = pack_ssml(paragraphs, max_chars=self.max_chars,
+                           max_bytes=self.max_bytes)
         return blocks
 
     def visit_bold(self, node):
@@ -145,6 +307,147 @@ class SSML(ContextVisitor):
         return ''
 
 
+THROTTLING_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    ])
+
+
+def is_throttling_error(e):
+    """Determines whether an exception from an AWS client means that the
+    request was throttled and should be retried.
+    """
+    response = getattr(e, 'response', None)
+    if not isinstance(response, dict):
+        return False
+    code = response.get('Error', {}).get('Code', '')
+    return code in THROTTLING_CODES
+
+
+class PollySynthesizer:
+    """Synthesizes SSML blocks with AWS Polly using a pool of threads.
+    Results are reassembled in order and streamed to the output file. If an
+    assets cache is provided, each block is stored under a key derived from
+    its SSML, so that unchanged blocks are never synthesized twice.
+    """
+
+    def __init__(self, client, voice='Matthew', max_workers=4, retries=5,
+                 backoff=0.5):
+        """
+        Parameters
+        ----------
+        client : Polly client
+            An object with a ``synthesize_speech()`` method, such as a
+            boto3 Polly client.
+        voice : str, optional
+            The Polly voice ID to synthesize with.
+        max_workers : int, optional
+            Maximum number of concurrent synthesis requests.
+        retries : int, optional
+            Number of times to retry a throttled request.
+        backoff : float, optional
+            Initial delay [sec] before retrying a throttled request. The
+            delay doubles after each failed attempt.
+        """
+        self.client = client
+        self.voice = voice
+        self.max_workers = max(1, max_workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.nrequests = 0
+        self._lock = threading.Lock()
+
+    def synthesize(self, ssml):
+        """Synthesizes a single SSML block, returning the mp3 bytes."""
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            with self._lock:
+                self.nrequests += 1
+            try:
+                response = self.client.synthesize_speech(Text=ssml,
+                                                         TextType='ssml',
+                                                         VoiceId=self.voice,
+                                                         OutputFormat='mp3')
+                return response["AudioStream"].read()
+            except Exception as e:
+                if attempt == self.retries or not is_throttling_error(e):
+                    raise
+            time.sleep(delay)
+            delay *= 2
+
+    def _synthesize_to_file(self, ssml, filename):
+        aud = self.synthesize(ssml)
+        fd, tmpname = tempfile.mkstemp(prefix='.polly-', suffix='.part',
+                                       dir=os.path.dirname(filename) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(aud)
+            os.replace(tmpname, filename)
+        except BaseException:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+        return filename
+
+    @property
+    def asset_version(self):
+        """Version of the speech produced, which depends on the voice and the
+        output format.
+        """
+        return fingerprint(self.voice, 'mp3')
+
+    def render(self, blocks, outfile, assets=None, assets_dir='.'):
+        """Synthesizes all blocks and writes them, in order, to outfile."""
+        if assets is not None:
+            assets.register_version('polly', self.asset_version)
+        nblocks = len(blocks)
+        window = 2 * self.max_workers
+        pending = collections.deque()
+        # maps asset keys to the futures of blocks already submitted, so that
+        # repeated blocks are only synthesized once
+        inflight = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool, \
+             open(outfile, 'wb') as out:
+
+            def write_next():
+                i, asset_key, future = pending.popleft()
+                print('{0}/{1}\r'.format(i, nblocks), end='')
+                sys.stdout.flush()
+                result = future.result()
+                if asset_key is None:
+                    out.write(result)
+                    return
+                assets[asset_key] = result
+                with open(result, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+            for i, ssml in enumerate(blocks):
+                if assets is None:
+                    asset_key = None
+                    future = pool.submit(self.synthesize, ssml)
+                else:
+                    asset_key = versioned_key('polly', ssml, self.asset_version)
+                    if asset_key in inflight:
+                        future = inflight[asset_key]
+                    elif asset_key in assets:
+                        future = Future()
+                        future.set_result(assets[asset_key])
+                    else:
+                        filename = assets.path(asset_key, '.mp3', assets_dir)
+                        future = pool.submit(self._synthesize_to_file, ssml,
+                                             filename)
+                    inflight[asset_key] = future
+                pending.append((i, asset_key, future))
+                if len(pending) >= window:
+                    write_next()
+            while pending:
+                write_next()
+
+
 class Dictation(AnsiFormatter):
     """A context visitor that renders the document by recording audio from the
     microphone. Audio is chunked into small blocks and cached for later use.
@@ -152,46 +455,97 @@ class Dictation(AnsiFormatter):
     """
 
     renders = 'audio'
+    casefold = False
     _recorder = None
 
-    def render(self, *, tree=None, assets=None, assets_dir='.', **kwargs):
+    def render(self, *, tree=None, assets=None, assets_dir='.',
+               dictation_casefold=None, cancelled=None, **kwargs):
         """Takes a dictation of the text and returns a list of filenames that
-        represent the text.
+        represent the text. Returns None if the user quits, or if cancelled,
+        a threading.Event, is set before a prompt or a recording.
         """
         if assets is None:
             raise ValueError('assets cannot be None, must be an isnstance '
                              'of AssetsCache')
+        if dictation_casefold is not None:
+            self.casefold = dictation_casefold
         self.blocks = ['']
         self.visit(tree)
         filenames = []
         for block in self.blocks:
-            filename = self.record_block(block, assets, assets_dir)
+            if cancelled is not None and cancelled.is_set():
+                # the rest of the build failed
+                return
+            filename = self.record_block(block, assets, assets_dir,
+                                         cancelled=cancelled)
             if filename is None:
                 # recieved quit
                 return
             filenames.append(filename)
         return filenames
 
-    def record_block(self, block, assets, assets_dir):
-        """Interactively records a block, returns the file name"""
+    def asset_key(self, block):
+        """Returns the cache key for a block, which depends only on the words
+        to be spoken, not on their formatting.
+        """
+        return ('dictation', speech_text(block, casefold=self.casefold))
+
+    def migrate_key(self, block, assets):
+        """Moves a recording cached under an older key for the block, such as
+        the raw ANSI text, to the canonical key. Returns True if an entry
+        was moved.
+        """
+        asset_key = self.asset_key(block)
+        if asset_key in assets:
+            return False
+        for old_key in [('dictation', block),
+                        ('dictation', speech_text(block))]:
+            if old_key == asset_key or old_key not in assets:
+                continue
+            assets[asset_key] = assets[old_key]
+            del assets[old_key]
+            return True
+        return False
+
+    def record_block(self, block, assets, assets_dir, cancelled=None):
+        """Interactively records a block, returns the file name. Returns None
+        if the user quits, or if cancelled is set before a prompt or a
+        recording.
+        """
+        asset_key = self.asset_key(block)
+        # hold the key so that parallel builds do not record it twice
+        with assets.claim(asset_key):
+            self.migrate_key(block, assets)
+            return self._record_block(block, asset_key, assets, assets_dir,
+                                      cancelled=cancelled)
+
+    def _record_block(self, block, asset_key, assets, assets_dir,
+                      cancelled=None):
+        def stopped():
+            return cancelled is not None and cancelled.is_set()
+
         # first check if we already have a recording
-        asset_key = ('dictation', block)
         if asset_key in assets:
             filename = assets[asset_key]
             print('found \x1b[1m' + filename + '\x1b[0m in cache')
             assets[asset_key] = filename  # update src hash
             return filename
         # now make sure we can record
-        h = assets.hash(asset_key)
-        basename = h + '.ogg'
-        filename = os.path.join(assets_dir, basename)
+        filename = assets.path(asset_key, '.ogg', assets_dir)
         done = False
         while not done:
+            if stopped():
+                return
             print('Please speak the following text; '
                   'press Enter to start recording\n\n')
             print(block, '\n\n')
             input()
-            self.recorder.record(filename)
+            if stopped():
+                return
+            tmpname = self.recorder.record(filename)
+            if stopped():
+                self.recorder.discard(tmpname)
+                return
             print('Would you like to \x1b[1m(k)\x1b[0meep, '
                   '\x1b[1m(d)\x1b[0miscard, or '
                   '\x1b[1m(q)\x1b[0muit: ', end='', flush=True)
@@ -199,15 +553,21 @@ class Dictation(AnsiFormatter):
             while not s:
                 if s is not None:
                     print('selection not understood, please input k/d or y/n or q')
-                s = input()[0].lower()
-                if s not in 'kdynq':
+                s = input()[:1].lower()
+                if not s or s not in 'kdynq':
+                    s = ''
                     continue
                 elif s in 'ky':
                     done = True
                 elif s == 'q':
+                    self.recorder.discard(tmpname)
                     return
                 else:
                     done = False
+            if done:
+                self.recorder.keep(tmpname, filename)
+            else:
+                self.recorder.discard(tmpname)
         assets[asset_key] = filename
         return filename
 
@@ -246,7 +606,8 @@ class Recorder:
     """Manages the recording of audio."""
 
     def __init__(self, device=None, columns=None, fft_low=100.0,
-                 fft_high=2000.0, gain=10.0, block_duration=0.05):
+                 fft_high=2000.0, gain=10.0, block_duration=0.05,
+                 pool_size=256):
         """
         Parameters
         ----------
@@ -264,6 +625,9 @@ class Recorder:
             FFT gain factor to apply.
         block_duration : float, optional
             The length of time [sec] that each recorded block should be.
+        pool_size : int, optional
+            Number of preallocated blocks that may be waiting to be written
+            to disk at any one time.
         """
         self._gradient = self._samplerate = self._channels = self.fft_size = None
         if columns is None:
@@ -273,6 +637,7 @@ class Recorder:
         self.fft_high = fft_high
         self.gain = gain
         self.block_duration = block_duration
+        self.pool_size = pool_size
         self.blocks = None
 
         self.delta_f = (fft_high - fft_low) / (columns - 1)
@@ -354,7 +719,7 @@ class Recorder:
             text = ' ' + str(status) + ' '
             print('\x1b[34;40m', text.center(self.columns, '#'),
                   '\x1b[0m', sep='', end='\r', flush=True)
-        self.blocks.put(indata.copy())
+        self.blocks.put(indata)
         if indata.any():
             magnitude = np.abs(np.fft.rfft(indata[:, 0], n=self.fft_size))
             magnitude *= self.gain / self.fft_size
@@ -364,28 +729,140 @@ class Recorder:
         else:
             print('no input', end='\r', flush=True)
 
-    def raw_record(self):
-        """Actually records from the microphone. Returns a queue of numpy arrays."""
-        self.blocks = queue.Queue()
+    def raw_record(self, filename):
+        """Actually records from the microphone, streaming the blocks to
+        filename as they arrive. Returns the number of dropped blocks.
+        """
+        blocksize = int(self.samplerate * self.block_duration)
+        self.blocks = BlockWriter(filename, samplerate=int(self.samplerate),
+                                  channels=self.channels, blocksize=blocksize,
+                                  nblocks=self.pool_size)
         print('Press Enter to stop recording.')
-        with sd.InputStream(device=self.device, channels=self.channels,
-                            callback=self.callback,
-                            blocksize=int(self.samplerate * self.block_duration),
-                            samplerate=self.samplerate):
-            response = True
-            while response:
-                response = input()
-        return self.blocks
+        with self.blocks:
+            with sd.InputStream(device=self.device, channels=self.channels,
+                                callback=self.callback, blocksize=blocksize,
+                                samplerate=self.samplerate):
+                response = True
+                while response:
+                    response = input()
+        if self.blocks.dropped:
+            print('\x1b[1mWarning:\x1b[0m dropped {0} blocks while '
+                  'writing'.format(self.blocks.dropped))
+        return self.blocks.dropped
 
     def record(self, filename):
-        """Records sounds and writes it to the filesystem."""
-        blocks = self.raw_record()
+        """Records sounds, streaming it to a temporary file next to filename.
+        Returns the temporary filename, which should be passed to keep() or
+        discard() when the user has decided what to do with the take.
+        """
+        tmpname = filename + '.part'
         print('Writing file \x1b[1m' + filename + '\x1b[0m')
-        with sf.SoundFile(filename, mode='w', samplerate=int(self.samplerate),
-                          channels=self.channels, subtype='VORBIS') as f:
-            while not blocks.empty():
-                block = blocks.get()
-                f.write(block)
+        self.raw_record(tmpname)
+        return tmpname
+
+    @staticmethod
+    def keep(tmpname, filename):
+        """Atomically moves a recorded take into its final location."""
+        os.replace(tmpname, filename)
+
+    @staticmethod
+    def discard(tmpname):
+        """Removes a recorded take."""
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+class BlockWriter:
+    """Streams audio blocks to an OGG/Vorbis file from a background thread.
+    Blocks are copied into a preallocated pool, so memory use is bounded by
+    the pool size rather than by the length of the recording. If the writer
+    falls behind and the pool is exhausted, incoming blocks are dropped and
+    counted.
+    """
+
+    def __init__(self, filename, samplerate, channels, blocksize, nblocks=256):
+        """
+        Parameters
+        ----------
+        filename : str
+            Path to write the audio to.
+        samplerate : int
+            Sample rate [Hz] of the audio.
+        channels : int
+            Number of audio channels.
+        blocksize : int
+            Maximum number of frames per block.
+        nblocks : int, optional
+            Number of blocks in the preallocated pool.
+        """
+        self.filename = filename
+        self.samplerate = samplerate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.pool = np.empty((nblocks, blocksize, channels), dtype='float32')
+        self.free = queue.Queue()
+        for i in range(nblocks):
+            self.free.put(i)
+        self.filled = queue.Queue()
+        self.dropped = 0
+        self._thread = None
+        self._error = None
+
+    def put(self, indata):
+        """Copies a block into the pool and schedules it for writing. This is
+        safe to call from the audio callback, as it never blocks.
+        """
+        try:
+            i = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return
+        n = len(indata)
+        self.pool[i, :n] = indata
+        self.filled.put((i, n))
+
+    def _write(self):
+        try:
+            with sf.SoundFile(self.filename, mode='w', samplerate=self.samplerate,
+                              channels=self.channels, format='OGG',
+                              subtype='VORBIS') as f:
+                while True:
+                    item = self.filled.get()
+                    if item is None:
+                        break
+                    i, n = item
+                    f.write(self.pool[i, :n])
+                    self.free.put(i)
+        except Exception as e:
+            self._error = e
+            # keep draining so that the producer never runs out of blocks
+            while True:
+                item = self.filled.get()
+                if item is None:
+                    break
+                self.free.put(item[0])
+
+    def start(self):
+        """Starts the writer thread."""
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Flushes all pending blocks and waits for the writer to finish."""
+        if self._thread is None:
+            return
+        self.filled.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 
 def append_to_track(track, filename):
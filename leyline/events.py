@@ -1,4 +1,8 @@
 """Tools for handling events in the documents."""
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+
 from leyline.ast import indent
 from leyline.context_visitor import ContextVisitor
 
@@ -8,9 +12,10 @@ class EventsVisitor(ContextVisitor):
     def __init__(self, *, initial_event=None, **kwargs):
         super().__init__(**kwargs)
         self.events = []
+        self.current_slide = None
         if initial_event is None:
             initial_event = Event()
-        self.events.append(initial_event)
+        self.current_event = initial_event
 
     def __str__(self):
         s = 'Events:\n' + indent('\n'.join(map(str, self.events)), '  ')
@@ -23,6 +28,8 @@ class EventsVisitor(ContextVisitor):
     @current_event.setter
     def current_event(self, val):
         self.events.append(val)
+        if isinstance(val, Slide):
+            self.current_slide = val
 
     def visit_node(self, node):
         """generic vistor just adds node to current event body."""
@@ -137,10 +144,8 @@ class Subslide(Event):
         # this event should not add itself to the visitor
         if not hasattr(visitor, 'events'):
             return ''
-        for event in reversed(visitor.events):
-            if isinstance(event, Slide):
-                break
-        else:
+        event = visitor.current_slide
+        if event is None:
             raise ValueError('subslide before slide')
         idx = event.idx + 1 if self.idx is None else self.idx
         event.idx = idx
@@ -150,6 +155,23 @@ class Subslide(Event):
         pass
 
 
+SHARD_MARKER = '%% leyline shard\n'
+
+
+class Shard(Event):
+    """Marks a place where long notes may be split, so that the parts can
+    be compiled in parallel. Does nothing for other targets.
+    """
+
+    type = 'shard'
+
+    def render_notes(self, visitor):
+        return '\n' + SHARD_MARKER
+
+    def render(self, target, visitor):
+        return ''
+
+
 class Sleep(Event):
     """An event representing pausing for the provided number of seconds."""
 
@@ -159,4 +181,94 @@ class Sleep(Event):
         super().__init__(duration=duration, **kwargs)
 
 
+class Timeline:
+    """The timing of the subslides in a video, flattened into columns of
+    start and end times so that what is on screen at a given time can be
+    found by bisection. Each interval is labeled by the index of its slide
+    and of the subslide within it.
+    """
+
+    def __init__(self, start=(), end=(), slide=(), subslide=()):
+        self.start = array('d', start)
+        self.end = array('d', end)
+        self.slide = array('l', slide)
+        self.subslide = array('l', subslide)
+
+    @classmethod
+    def from_slides(cls, slides):
+        """Makes a timeline from slides whose subslides have been timed,
+        skipping those without a start time.
+        """
+        tl = cls()
+        for j, slide in enumerate(slides):
+            for i, (start, duration) in enumerate(zip(slide.start, slide.duration)):
+                if start is None:
+                    continue
+                tl.append(start, start + (duration or 0.0), j, i)
+        return tl
+
+    def append(self, start, end, slide, subslide):
+        """Adds an interval, which must not begin before the last one ends."""
+        if self.end and start < self.end[-1]:
+            raise ValueError('timeline intervals must be in order')
+        self.start.append(start)
+        self.end.append(end)
+        self.slide.append(slide)
+        self.subslide.append(subslide)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, k):
+        return (self.start[k], self.end[k], self.slide[k], self.subslide[k])
+
+    def __eq__(self, other):
+        return isinstance(other, Timeline) and self.to_dict() == other.to_dict()
+
+    @property
+    def duration(self):
+        return self.end[-1] if self.end else 0.0
+
+    def index(self, t):
+        """Returns the index of the interval playing at time t, or None."""
+        k = bisect_right(self.start, t) - 1
+        if k < 0 or t >= self.end[k]:
+            return None
+        return k
+
+    def at(self, t):
+        """Returns the (slide, subslide) indices on screen at time t, or
+        None if nothing is.
+        """
+        k = self.index(t)
+        return None if k is None else (self.slide[k], self.subslide[k])
+
+    def overlapping(self, t0, t1):
+        """Returns the (slide, subslide) indices of intervals overlapping the
+        window [t0, t1).
+        """
+        lo = bisect_right(self.end, t0)
+        hi = bisect_left(self.start, t1)
+        return [(self.slide[k], self.subslide[k]) for k in range(lo, hi)]
+
+    def to_dict(self):
+        return {'start': self.start.tolist(), 'end': self.end.tolist(),
+                'slide': self.slide.tolist(), 'subslide': self.subslide.tolist()}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['start'], d['end'], d['slide'], d['subslide'])
+
+    def dump(self, filename):
+        """Writes the timeline to a JSON file."""
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a timeline from a JSON file."""
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+
 EVENTS_CTX = {_.type: _ for _ in globals().values() if isinstance(_, type) and issubclass(_, Event)}
@@ -1,12 +1,17 @@
 """Command line interface for leyline"""
 import os
+import sys
 import getpass
 import importlib
 from argparse import ArgumentParser
 
+from leyline import tools
 from leyline.parser import parse
-from leyline.assets import AssetsCache
+from leyline.assets import (AssetsCache, SqliteAssetsCache, EvictionPolicy,
+                            ASSET_LAYOUTS, export_bundle, import_bundle)
 from leyline.events import EVENTS_CTX
+from leyline.video import (ENCODING_PRESETS, parse_slide_range,
+                           parse_time_range)
 
 
 TARGETS = {
@@ -20,14 +25,43 @@ TARGETS = {
     'video': ('leyline.video', 'Video'),
     }
 TARGET_VISITORS = {}
+ASSETS_BACKENDS = {
+    'json': (AssetsCache, 'assets.json'),
+    'sqlite': (SqliteAssetsCache, 'assets.db'),
+    }
+
+
+SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(s):
+    """Parses a size such as '512M' or '10G' into a number of bytes."""
+    s = s.strip().upper().rstrip('B')
+    unit = s[-1:] if s[-1:] in SIZE_UNITS else ''
+    return int(float(s[:len(s) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def make_eviction_policy(ns):
+    """Returns the eviction policy for the namespace, or None."""
+    if ns.max_assets_size is None and ns.max_assets_age is None:
+        return None
+    max_age = None if ns.max_assets_age is None else ns.max_assets_age * 86400.0
+    pinned = [k for k in ns.pinned_kinds.split(',') if k]
+    return EvictionPolicy(max_bytes=ns.max_assets_size, max_age=max_age,
+                          pinned=pinned)
 
 
 def make_assets_cache(ns):
     """Adds an assets cache to the current namespace."""
     os.makedirs(ns.assets_dir, exist_ok=True)
+    cls, default_file = ASSETS_BACKENDS[ns.assets_backend]
+    if ns.assets_file is None:
+        ns.assets_file = default_file
     cachefile = os.path.join(ns.assets_dir, ns.assets_file)
     print("Loading assets cache " + cachefile)
-    ns.assets = AssetsCache(cachefile, ns.filename)
+    ns.assets = cls(cachefile, ns.filename, assets_dir=ns.assets_dir,
+                    layout=ns.assets_layout, policy=make_eviction_policy(ns),
+                    upstreams=ns.assets_upstreams, publish=ns.assets_publish)
 
 
 def render_target(tree, target, ns):
@@ -38,19 +72,81 @@ def render_target(tree, target, ns):
     return visitor.render(tree=tree, **ns.__dict__)
 
 
+def add_assets_arguments(p):
+    """Adds the arguments for locating the assets cache to a parser."""
+    p.add_argument('--assets-dir', '--static-dir', default='_static',
+                   help='Path to assets or static directory, where large '
+                        'unique files will be stored', dest='assets_dir')
+    p.add_argument('--assets-cache', default=None, dest='assets_file',
+                   help='Filename (relative to assets dir) that the assets '
+                        'cache will use to store data. Defaults to assets.json '
+                        'for the json backend and assets.db for sqlite.')
+    p.add_argument('--assets-backend', default='json', choices=ASSETS_BACKENDS,
+                   help='storage backend for the assets cache: '
+                        + ', '.join(sorted(ASSETS_BACKENDS.keys())))
+    p.add_argument('--assets-layout', default='flat', choices=ASSET_LAYOUTS,
+                   help='how assets are arranged in the assets dir: flat, or '
+                        'sharded into subdirectories by hash prefix. Existing '
+                        'assets are moved to the new layout as they are used.')
+
+
 def make_argparser():
     """makes an argparser instance for leyline"""
-    p = ArgumentParser('leyline', description='Leyline Rendering Tool')
+    p = ArgumentParser('leyline', description='Leyline Rendering Tool',
+                       epilog="run 'leyline cache --help' for cache export "
+                              "and import")
     p.add_argument('--pdb', '--debug', default=False, action='store_true',
                    dest='debug', help='Enter into pdb on error.')
     p.add_argument('--polly-user', default=getpass.getuser(),
                    help='username for AWS Polly')
-    p.add_argument('--assets-dir', '--static-dir', default='_static',
-                   help='Path to assets or static directory, where large '
-                        'unique files will be stored', dest='assets_dir')
-    p.add_argument('--assets-cache', default='assets.json', dest='assets_file',
-                   help='Filename (relative to assets dir) that the assets '
-                        'cache will use to store data.')
+    p.add_argument('--polly-workers', default=4, type=int,
+                   help='maximum number of concurrent AWS Polly requests')
+    p.add_argument('--dictation-casefold', default=False, action='store_true',
+                   help='ignore case when matching text to recorded dictation')
+    p.add_argument('--video-preset', default='final',
+                   choices=sorted(ENCODING_PRESETS),
+                   help='video encoding preset: draft encodes quickly, final '
+                        'is smaller and sharper, legacy is constant 24 fps')
+    p.add_argument('--preview', default=False, action='store_true',
+                   help='render a quick, low resolution video for checking '
+                        'timing, reusing recorded audio')
+    p.add_argument('--log-dir', default=None,
+                   help='directory for the logs of pdflatex, gs, and ffmpeg; '
+                        'defaults to logs/ in the assets dir')
+    p.add_argument('--keep-logs', default=False, action='store_true',
+                   help='keep the logs of pdflatex, gs, and ffmpeg runs that '
+                        'succeed, not only of those that fail')
+    p.add_argument('--notes-shards', default=False, action='store_true',
+                   help='compile long notes in parallel, split at {{shard()}} '
+                        'markers or at sections')
+    p.add_argument('-j', '--jobs', default=None, type=int,
+                   help='maximum number of frames or notes shards to compile '
+                        'at once; defaults to the number of CPUs')
+    p.add_argument('--slides', default=None, type=parse_slide_range,
+                   dest='slide_range', metavar='FIRST-LAST',
+                   help='only render these slides of the video, e.g. 12-14')
+    p.add_argument('--time', default=None, type=parse_time_range,
+                   dest='time_range', metavar='START-STOP',
+                   help='only render the subslides of the video that overlap '
+                        'this time window, e.g. 05:00-08:30')
+    add_assets_arguments(p)
+    p.add_argument('--assets-upstream', default=[], action='append',
+                   dest='assets_upstreams', metavar='DIR',
+                   help='read-only assets directory, such as a shared mount, '
+                        'to look in for assets missing from the local cache. '
+                        'May be given many times; searched in order.')
+    p.add_argument('--assets-publish', default=False, action='store_true',
+                   help='copy newly produced assets to the first upstream')
+    p.add_argument('--max-assets-size', default=None, type=parse_size,
+                   help='evict least recently used assets when the assets '
+                        'exceed this size, e.g. 500M or 20G')
+    p.add_argument('--max-assets-age', default=None, type=float,
+                   help='evict assets that have not been used in this many days')
+    p.add_argument('--pinned-kinds', default='dictation',
+                   help='comma-separated kinds of assets that are never evicted')
+    p.add_argument('--dry-run', default=False, action='store_true',
+                   dest='dry_run', help='for the gc target, only report what '
+                                        'would be removed')
     p.add_argument('targets', nargs='+', help='targets to render the file into: '
                    + ', '.join(sorted(TARGETS.keys())),
                    choices=TARGETS)
@@ -58,22 +154,77 @@ def make_argparser():
     return p
 
 
+def make_cache_argparser():
+    """makes an argparser instance for the leyline cache subcommands"""
+    p = ArgumentParser('leyline cache', description='Leyline Assets Cache Tool')
+    p.set_defaults(filename=None, max_assets_size=None, max_assets_age=None,
+                   pinned_kinds='', assets_upstreams=[], assets_publish=False)
+    subp = p.add_subparsers(dest='cmd')
+    subp.required = True
+    exp = subp.add_parser('export', help='pack assets into an archive')
+    add_assets_arguments(exp)
+    exp.add_argument('--source', default=None, action='append', dest='srcfiles',
+                     help='only export assets from this source file. May be '
+                          'given many times.')
+    exp.add_argument('--kind', default=None, action='append', dest='kinds',
+                     help='only export assets of this kind, e.g. frame or '
+                          'dictation. May be given many times.')
+    exp.add_argument('--max-age', default=None, type=float,
+                     help='only export assets used in this many days')
+    exp.add_argument('archive', help='archive file to write, .tar or .tar.gz')
+    imp = subp.add_parser('import', help='merge assets from an archive')
+    add_assets_arguments(imp)
+    imp.add_argument('archive', help='archive file to read')
+    return p
+
+
+def cache_main(args=None):
+    """Entry point for the leyline cache subcommands"""
+    p = make_cache_argparser()
+    ns = p.parse_args(args=args)
+    make_assets_cache(ns)
+    with ns.assets:
+        if ns.cmd == 'export':
+            max_age = None if ns.max_age is None else ns.max_age * 86400.0
+            n = export_bundle(ns.assets, ns.archive, srcfiles=ns.srcfiles,
+                              kinds=ns.kinds, max_age=max_age)
+            print('Exported {0} assets to {1}'.format(n, ns.archive))
+        elif ns.cmd == 'import':
+            n = import_bundle(ns.assets, ns.archive)
+            print('Imported {0} assets from {1}'.format(n, ns.archive))
+
+
 def main(args=None):
     """Main entry point for leyline"""
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ['cache']:
+        return cache_main(args[1:])
     p = make_argparser()
     ns = p.parse_args(args=args)
     with open(ns.filename, 'r') as f:
         s = f.read()
     tree = parse(s, filename=ns.filename)
     make_assets_cache(ns)
+    tools.log_dir = ns.log_dir or os.path.join(ns.assets_dir, 'logs')
+    tools.keep_logs = ns.keep_logs
     ns.contexts = {'ctx': EVENTS_CTX}
+    with ns.assets:
+        render_targets(tree, ns)
+    if ns.assets.eviction_stats.count:
+        print(ns.assets.eviction_stats, end='')
+    if tools.RUNS:
+        print('External tools:\n' + tools.summary(), end='')
+
+
+def render_targets(tree, ns):
+    """Renders each of the targets in turn, stopping if one returns None."""
     for target in ns.targets:
         try:
             rtn = render_target(tree, target, ns)
         except Exception:
             if not ns.debug:
                 raise
-            import sys
             import pdb
             import traceback
             type, value, tb = sys.exc_info()
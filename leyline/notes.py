@@ -1,8 +1,15 @@
 """A leyline visitor for rendering lecture notes (via LaTeX)."""
 import os
-import subprocess
+import re
+import functools
 
+from lazyasd import lazyobject
+
+from leyline import tools, texbuild
 from leyline.latex import Latex
+from leyline.assets import file_digest
+from leyline.events import SHARD_MARKER
+from leyline.scheduler import Scheduler
 
 
 HEADER = r"""\documentclass[12pt]{article}
@@ -60,21 +67,187 @@ HEADER = r"""\documentclass[12pt]{article}
 FOOTER = r"""\end{document}"""
 
 
+@lazyobject
+def RE_TOP_LEVEL():
+    return re.compile(r'^(?=\\section\{)', re.MULTILINE)
+
+
+@lazyobject
+def RE_PAGES_WRITTEN():
+    return re.compile(r'Output written on .*?\((\d+)\s+pages?', re.DOTALL)
+
+
+@lazyobject
+def RE_AUX_COUNTER():
+    return re.compile(r'^\\leylinecounter\{([^{}]+)\}\{(-?\d+)\}\s*$', re.MULTILINE)
+
+
+@lazyobject
+def RE_AUX_REFS():
+    return re.compile(r'^\\(?:newlabel|bibcite)\{.*$', re.MULTILINE)
+
+
+# ends a shard by writing the values of all of its counters to its .aux file,
+# like \include does, so that the next shard can start from them
+SHARD_CHECKPOINT = r"""\clearpage
+\makeatletter
+\immediate\write\@auxout{\string\providecommand\string\leylinecounter[2]{}}
+\begingroup
+\def\@elt#1{\immediate\write\@auxout{\string\leylinecounter{#1}{\the\value{#1}}}}
+\cl@@ckpt
+\endgroup
+\makeatother
+"""
+
+
+def split_shards(body):
+    """Splits the body of the notes into parts that can be compiled on their
+    own. The body is split at shard() markers if there are any, and
+    otherwise before each section.
+    """
+    if SHARD_MARKER in body:
+        parts = body.split(SHARD_MARKER)
+    else:
+        parts = RE_TOP_LEVEL.split(body)
+    return [part for part in parts if part.strip()]
+
+
+def page_count(logfile):
+    """Returns the number of pages pdflatex reports writing in its log, which
+    is zero if it wrote no PDF at all.
+    """
+    with open(logfile, 'r', errors='replace') as f:
+        s = f.read()
+    m = RE_PAGES_WRITTEN.search(s)
+    if m is not None:
+        return int(m.group(1))
+    if 'No pages of output' in s:
+        return 0
+    raise ValueError('no pages written according to ' + logfile)
+
+
+def read_shard_aux(auxname):
+    """Returns the counters that a shard ended with, and the lines that
+    define its labels and citations, from its .aux file.
+    """
+    try:
+        with open(auxname, 'r', errors='replace') as f:
+            s = f.read()
+    except FileNotFoundError:
+        return {}, []
+    counters = {name: int(value) for name, value in RE_AUX_COUNTER.findall(s)}
+    return counters, RE_AUX_REFS.findall(s)
+
+
+def shard_preambles(ends, refs):
+    """Returns the LaTeX that starts each shard. Every counter starts where
+    the previous shard ended, and the labels and citations of the other
+    shards are defined, so that references across shards resolve.
+
+    Parameters
+    ----------
+    ends : list of dict
+        The counters that each shard ended with in its last build.
+    refs : list of list of str
+        The label and citation definitions of each shard in its last build.
+    """
+    preambles = []
+    for k in range(len(ends)):
+        s = ''
+        if k > 0:
+            s += ''.join('\\setcounter{{{0}}}{{{1}}}\n'.format(name, value)
+                         for name, value in ends[k - 1].items())
+        others = [line for j, lines in enumerate(refs) if j != k for line in lines]
+        if others:
+            s += '\\makeatletter\n' + '\n'.join(others) + '\n\\makeatother\n'
+        preambles.append(s)
+    return preambles
+
+
 class Notes(Latex):
     """A leyline visitor for rendering lecture notes (via LaTeX)."""
 
     renders = 'notes'
 
-    def render(self, *, tree=None, filename='', **kwargs):
-        """Performs the actual render, putting the notes file on disk."""
+    def render(self, *, tree=None, filename='', assets=None, assets_dir='.',
+               notes_shards=False, jobs=None, **kwargs):
+        """Performs the actual render, putting the notes file on disk. With
+        notes_shards, the notes are split into parts that are compiled in
+        parallel and merged.
+        """
         s = self.visit(tree)
         basename, _ = os.path.splitext(filename)
         outfile = basename + '.tex'
-        with open(outfile, 'w') as f:
-            f.write(s)
-        subprocess.check_call(['pdflatex', outfile])
+        if notes_shards:
+            self.render_shards(s, basename, assets=assets, assets_dir=assets_dir,
+                               jobs=jobs)
+            return True
+        texbuild.build(outfile, s, name=basename, assets=assets,
+                       assets_dir=assets_dir)
         return True
 
+    def render_shards(self, s, basename, assets=None, assets_dir='.', jobs=None):
+        """Compiles the notes in parallel, one shard at a time, in build
+        directories under <basename>.shards/. Shards that have not changed
+        are not recompiled. Each shard starts all of its counters (pages,
+        sections, equations, figures, footnotes, ...) where the previous one
+        ended, and knows the labels and citations of the others, which may
+        take further rounds once these are known. Shards without any pages
+        are left out of the merged PDF. A table of contents only lists the
+        sections of its own shard. Returns the merged PDF filename.
+        """
+        body = s[len(HEADER):len(s) - len(FOOTER)]
+        parts = split_shards(body)
+        builddir = basename + '.shards'
+        os.makedirs(builddir, exist_ok=True)
+        manifestname = os.path.join(builddir, 'shards.json')
+        last = texbuild.load_manifest(manifestname)
+        texnames = [os.path.join(builddir, 'shard{0:03d}'.format(k), 'shard.tex')
+                    for k in range(len(parts))]
+        auxnames = [texbuild.output_path(t, '.aux', os.path.dirname(t))
+                    for t in texnames]
+
+        def read_auxes():
+            auxes = [read_shard_aux(auxname) for auxname in auxnames]
+            return shard_preambles([ends for ends, _ in auxes],
+                                   [refs for _, refs in auxes])
+
+        # start from where the last build left off
+        preambles = read_auxes()
+        for _ in range(texbuild.MAX_PASSES):
+            sched = Scheduler(limits={'latex': jobs or os.cpu_count() or 1})
+            for texname, preamble, part in zip(texnames, preambles, parts):
+                d = os.path.dirname(texname)
+                os.makedirs(d, exist_ok=True)
+                tex = HEADER + preamble + part + SHARD_CHECKPOINT + FOOTER
+                sched.add(d, functools.partial(texbuild.build, texname, tex,
+                                               cwd=d, name=d.replace(os.sep, '-'),
+                                               assets=assets,
+                                               assets_dir=assets_dir),
+                          tool='latex')
+            sched.run()
+            curr = read_auxes()
+            if curr == preambles:
+                break
+            preambles = curr
+        else:
+            print('counters and references across the shards of \x1b[1m' +
+                  basename + '\x1b[0m did not settle')
+        pages = [page_count(texbuild.output_path(t, '.log', os.path.dirname(t)))
+                 for t in texnames]
+        pdfs = [texbuild.output_path(t, '.pdf', os.path.dirname(t))
+                for t, npages in zip(texnames, pages) if npages > 0]
+        digests = [file_digest(pdf) for pdf in pdfs]
+        pdfname = texbuild.output_path(basename + '.tex', '.pdf')
+        if digests != last.get('pdfs') or not os.path.exists(pdfname):
+            tools.run('gs', ['-dBATCH', '-dNOPAUSE', '-q', '-sDEVICE=pdfwrite',
+                             '-sOutputFile=' + pdfname] + pdfs,
+                      name=basename + '-merge')
+        else:
+            print('\x1b[1m' + pdfname + '\x1b[0m is up to date')
+        texbuild.dump_manifest(manifestname, {'pages': pages, 'pdfs': digests})
+        return pdfname
+
     def _make_title(self):
         if 'meta' not in self.contexts:
             return ''
@@ -0,0 +1,208 @@
+"""An asyncio scheduler for running the stages of a build as a graph of
+dependent tasks.
+"""
+import os
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Abort(Exception):
+    """Raised by a task to stop the build without it being an error, such
+    as when the user quits a dictation.
+    """
+
+
+def _settle(future, result=None, exc=None):
+    if future.done():
+        # the task was cancelled while the thread was running
+        return
+    if exc is None:
+        future.set_result(result)
+    else:
+        future.set_exception(exc)
+
+
+async def _run_in_daemon(func):
+    """Calls a function in a new daemon thread and awaits its result."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def target():
+        try:
+            result = func()
+        except BaseException as e:
+            settle = functools.partial(_settle, future, exc=e)
+        else:
+            settle = functools.partial(_settle, future, result)
+        try:
+            loop.call_soon_threadsafe(settle)
+        except RuntimeError:
+            # the loop has already closed, nobody is waiting
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+
+class Task:
+    """A unit of work in the graph. The function is called with the results
+    of the dependencies, in order, once they have all finished.
+    """
+
+    def __init__(self, name, func, deps=(), tool=None, daemon=False):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.tool = tool
+        self.daemon = daemon
+        self.start = self.end = None
+        self.status = 'pending'
+        self.result = None
+
+    @property
+    def wall(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Scheduler:
+    """Runs a graph of tasks with asyncio. Plain functions are run in a
+    thread pool, coroutine functions on the event loop. Tasks that use an
+    external tool share that tool's concurrency limit. If a task fails, or
+    the build is interrupted, the tasks that have not yet started are
+    cancelled and the error is raised right away. Threads cannot be stopped
+    from the outside, so long running tasks, such as a dictation, should
+    check the cancelled event between steps and stop once it is set. Tasks
+    that may block on the user should also be added as daemons, so that
+    they do not keep the process alive after the build has stopped.
+    """
+
+    def __init__(self, limits=None, max_workers=None):
+        """
+        Parameters
+        ----------
+        limits : dict, optional
+            Maps tool names, such as 'latex' or 'ffmpeg', to the maximum
+            number of tasks that may run that tool at once.
+        max_workers : int, optional
+            Size of the thread pool for plain functions. Defaults to the
+            number of CPUs plus four.
+        """
+        self.limits = dict(limits or {})
+        self.max_workers = max_workers or (os.cpu_count() or 1) + 4
+        self.tasks = {}
+        # set when the build fails or is interrupted
+        self.cancelled = threading.Event()
+
+    def add(self, name, func, deps=(), tool=None, daemon=False):
+        """Adds a task to the graph, returning its name. Dependencies must
+        already have been added. A daemon task is run in its own daemon
+        thread, rather than in the pool, which the interpreter does not wait
+        for on exit.
+        """
+        if name in self.tasks:
+            raise ValueError('duplicate task {0!r}'.format(name))
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('task {0!r} depends on unknown task '
+                                 '{1!r}'.format(name, dep))
+        self.tasks[name] = Task(name, func, deps=deps, tool=tool,
+                                daemon=daemon)
+        return name
+
+    async def _run_task(self, task, futures, semaphores, pool):
+        args = [await futures[dep] for dep in task.deps]
+        sem = semaphores.get(task.tool, None)
+        if sem is not None:
+            await sem.acquire()
+        try:
+            task.status = 'running'
+            task.start = time.monotonic()
+            if asyncio.iscoroutinefunction(task.func):
+                task.result = await task.func(*args)
+            elif task.daemon:
+                task.result = await _run_in_daemon(
+                    functools.partial(task.func, *args))
+            else:
+                loop = asyncio.get_running_loop()
+                task.result = await loop.run_in_executor(
+                    pool, functools.partial(task.func, *args))
+            task.status = 'done'
+        except asyncio.CancelledError:
+            task.status = 'cancelled'
+            raise
+        except Abort:
+            task.status = 'aborted'
+            raise
+        except Exception:
+            task.status = 'failed'
+            raise
+        finally:
+            if task.start is not None:
+                task.end = time.monotonic()
+            if sem is not None:
+                sem.release()
+        return task.result
+
+    async def run_async(self):
+        """Runs all tasks, returning a dict mapping task names to results."""
+        semaphores = {tool: asyncio.Semaphore(n) for tool, n in self.limits.items()}
+        futures = {}
+        self.cancelled.clear()
+        pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        # tasks are added in dependency order
+        for name, task in self.tasks.items():
+            futures[name] = asyncio.ensure_future(
+                self._run_task(task, futures, semaphores, pool))
+        try:
+            await asyncio.gather(*futures.values())
+        except BaseException:
+            self.cancelled.set()
+            for future in futures.values():
+                future.cancel()
+            await asyncio.gather(*futures.values(), return_exceptions=True)
+            for task in self.tasks.values():
+                if task.status == 'pending':
+                    task.status = 'cancelled'
+            # do not wait for tasks still running in threads, which may be
+            # blocked on the user, before reporting the failure
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        pool.shutdown()
+        return {name: task.result for name, task in self.tasks.items()}
+
+    def run(self):
+        """Runs all tasks to completion, from synchronous code."""
+        return asyncio.run(self.run_async())
+
+    def report(self):
+        """Returns a summary of the wall time spent per tool."""
+        totals = {}
+        for task in self.tasks.values():
+            if task.wall is None:
+                continue
+            n, wall = totals.get(task.tool, (0, 0.0))
+            totals[task.tool] = (n + 1, wall + task.wall)
+        s = ''
+        for tool, (n, wall) in sorted(totals.items(), key=lambda x: str(x[0])):
+            s += '  {0}: {1} tasks, {2:.2f} s\n'.format(tool or 'python', n, wall)
+        return s
+
+    def write_log(self, filename):
+        """Writes the timing and status of every task to a tab-separated
+        file.
+        """
+        starts = [t.start for t in self.tasks.values() if t.start is not None]
+        t0 = min(starts) if starts else 0.0
+        with open(filename, 'w') as f:
+            f.write('task\ttool\tstatus\tstart\tend\n')
+            for task in self.tasks.values():
+                start = '' if task.start is None else \
+                        '{0:.3f}'.format(task.start - t0)
+                end = '' if task.end is None else '{0:.3f}'.format(task.end - t0)
+                f.write('\t'.join([task.name, task.tool or '', task.status,
+                                   start, end]) + '\n')
@@ -0,0 +1,128 @@
+"""Incremental builds of LaTeX documents.
+
+A build writes the generated LaTeX only if it has changed, skips pdflatex
+entirely when the LaTeX, the .aux file, and the PDF all match the last
+build, and otherwise reruns pdflatex until the .aux file settles so that
+cross-references are up to date. What was produced is recorded in a build
+manifest next to the outputs.
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+from leyline import texformat
+from leyline.assets import file_digest
+
+
+MAX_PASSES = 4
+
+
+def string_digest(s):
+    return hashlib.md5(s.encode()).hexdigest()
+
+
+def digest_or_none(filename):
+    """Returns the MD5 digest of a file, or None if it does not exist."""
+    try:
+        return file_digest(filename)
+    except FileNotFoundError:
+        return None
+
+
+def write_if_changed(filename, s):
+    """Writes s to filename, unless the file already holds exactly s, in
+    which case it is not touched. Returns whether the file was written.
+    """
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == s:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
+    with open(filename, 'w') as f:
+        f.write(s)
+    return True
+
+
+def load_manifest(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def dump_manifest(filename, manifest):
+    """Atomically writes a build manifest."""
+    d = os.path.dirname(filename) or '.'
+    fd, tmpname = tempfile.mkstemp(prefix='.manifest-', dir=d)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmpname, filename)
+
+
+def output_path(texname, ext, cwd=None):
+    """Returns where pdflatex puts an output for texname, which is in the
+    directory it is run in.
+    """
+    jobname = os.path.splitext(os.path.basename(texname))[0]
+    return os.path.join(cwd or '.', jobname + ext)
+
+
+def build(texname, s, cwd=None, name=None, assets=None, assets_dir='.',
+          max_passes=MAX_PASSES):
+    """Incrementally builds a PDF from LaTeX source.
+
+    Parameters
+    ----------
+    texname : str
+        The LaTeX file to write and compile.
+    s : str
+        The LaTeX source.
+    cwd : str, optional
+        Directory to run pdflatex in, where the outputs are written.
+    name : str, optional
+        Name for the pdflatex logs.
+    assets : AssetsCache, optional
+        Cache of precompiled preamble formats.
+    assets_dir : str, optional
+        Directory to store formats in.
+    max_passes : int, optional
+        Maximum number of times to run pdflatex waiting for the .aux file
+        to settle.
+
+    Returns
+    -------
+    manifest : dict
+        The build manifest, which records the digests of the LaTeX, .aux,
+        and PDF files, the number of passes run, and the outputs.
+    """
+    pdfname = output_path(texname, '.pdf', cwd)
+    auxname = output_path(texname, '.aux', cwd)
+    manifestname = output_path(texname, '.build.json', cwd)
+    last = load_manifest(manifestname)
+    tex = string_digest(s)
+    write_if_changed(texname, s)
+    aux = digest_or_none(auxname)
+    if last.get('tex') == tex and last.get('aux') == aux and \
+            aux is not None and last.get('pdf') == digest_or_none(pdfname):
+        print('\x1b[1m' + pdfname + '\x1b[0m is up to date')
+        return last
+    passes = 0
+    while passes < max_passes:
+        texformat.pdflatex(texname, cwd=cwd, name=name, assets=assets,
+                           assets_dir=assets_dir)
+        passes += 1
+        prev, aux = aux, digest_or_none(auxname)
+        if aux == prev:
+            break
+    else:
+        print('cross-references in \x1b[1m' + pdfname + '\x1b[0m did not '
+              'settle after {0} passes'.format(passes))
+    manifest = {'tex': tex, 'aux': aux, 'pdf': digest_or_none(pdfname),
+                'passes': passes, 'time': time.time(),
+                'outputs': [texname, auxname, pdfname]}
+    dump_manifest(manifestname, manifest)
+    return manifest
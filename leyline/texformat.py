@@ -0,0 +1,135 @@
+"""Precompiled LaTeX formats for leyline's preambles.
+
+Loading beamer and the rest of the preamble is most of the time pdflatex
+spends on a single frame. The preamble is dumped once into a format file
+with the mylatexformat package, cached in the assets store keyed by the
+preamble (and the pdflatex version), and pdflatex is then started from
+that format, skipping the preamble in the document.
+"""
+import os
+import tempfile
+import threading
+
+from leyline import tools
+from leyline.assets import fingerprint, versioned_key, replace_file
+
+
+BEGIN_DOCUMENT = '\\begin{document}'
+
+# hashes of preambles whose formats could not be built or used
+_broken = set()
+_broken_lock = threading.Lock()
+
+
+def split_preamble(s):
+    """Splits LaTeX source into its preamble and the rest, which starts at
+    \\begin{document}. The preamble is '' if there is no document
+    environment.
+    """
+    i = s.find(BEGIN_DOCUMENT)
+    if i < 0:
+        return '', s
+    return s[:i], s[i:]
+
+
+def format_version():
+    """Returns the version of formats, which are specific to the pdflatex
+    that made them.
+    """
+    return fingerprint(tools.version('pdflatex'))
+
+
+def format_for(preamble, assets, assets_dir='.'):
+    """Returns the filename of a format for the preamble, building and
+    caching it if needed. Returns None if the format cannot be built.
+    """
+    version = format_version()
+    assets.register_version('latexfmt', version)
+    asset_key = versioned_key('latexfmt', preamble, version)
+    h = assets.hash(asset_key)
+    if h in _broken:
+        return None
+    # hold the key so that parallel frames only build the format once
+    with assets.claim(asset_key):
+        if asset_key in assets:
+            filename = assets[asset_key]
+            assets[asset_key] = filename  # update src hash
+            return filename
+        if h in _broken:
+            return None
+        filename = assets.path(asset_key, '.fmt', assets_dir)
+        with tempfile.TemporaryDirectory(prefix='fmt-' + h) as d:
+            texname = os.path.join(d, 'preamble.tex')
+            with open(texname, 'w') as f:
+                f.write(preamble + BEGIN_DOCUMENT + '\n\\end{document}\n')
+            try:
+                tools.run('pdflatex', ['-ini', '-jobname=' + h, '&pdflatex',
+                                       'mylatexformat.ltx', texname],
+                          cwd=d, name='fmt-' + h)
+            except tools.ToolError:
+                print('could not build a LaTeX format, compiling the full '
+                      'preamble instead')
+                with _broken_lock:
+                    _broken.add(h)
+                return None
+            replace_file(os.path.join(d, h + '.fmt'), filename)
+        assets[asset_key] = filename
+        return filename
+
+
+def pdflatex(texname, s=None, cwd=None, name=None, assets=None,
+             assets_dir='.', timeout=-1):
+    """Compiles a LaTeX file with pdflatex, starting from a precompiled
+    format of its preamble when an assets cache is available.
+
+    Parameters
+    ----------
+    texname : str
+        The LaTeX file to compile.
+    s : str, optional
+        The contents of texname. If given, the file is written first.
+    cwd : str, optional
+        Directory to run pdflatex in.
+    name : str, optional
+        Name for the pdflatex log.
+    assets : AssetsCache, optional
+        Cache to store formats in. If None, no format is used.
+    assets_dir : str, optional
+        Directory to store formats in.
+    timeout : float or None, optional
+        Seconds after which pdflatex is killed, see tools.run().
+    """
+    if s is not None:
+        with open(texname, 'w') as f:
+            f.write(s)
+    elif assets is not None:
+        with open(texname) as f:
+            s = f.read()
+    if cwd is not None:
+        # pdflatex resolves the file relative to where it runs
+        texname = os.path.abspath(texname)
+    fmt = None
+    if assets is not None:
+        preamble, _ = split_preamble(s)
+        if preamble.strip():
+            fmt = format_for(preamble, assets, assets_dir)
+    if fmt is None:
+        return tools.run('pdflatex', [texname], cwd=cwd, name=name,
+                         timeout=timeout)
+    fmtdir, fmtname = os.path.split(os.path.abspath(fmt))
+    # the trailing separator keeps the default format search path
+    env = {'TEXFORMATS': fmtdir + os.pathsep}
+    try:
+        return tools.run('pdflatex', ['-fmt=' + os.path.splitext(fmtname)[0],
+                                      texname], cwd=cwd, name=name, env=env,
+                         timeout=timeout)
+    except tools.ToolError:
+        pass
+    # the document may fail for its own reasons, so only blame the format
+    # if the full preamble works
+    run = tools.run('pdflatex', [texname], cwd=cwd, name=name, timeout=timeout)
+    print('the LaTeX format for this preamble did not work, no longer '
+          'using it')
+    with _broken_lock:
+        _broken.add(os.path.splitext(fmtname)[0])
+    return run
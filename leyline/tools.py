@@ -0,0 +1,246 @@
+"""Runs the external tools (pdflatex, gs, ffmpeg) that leyline renders with.
+
+Every invocation has its output captured to a log file, which is kept if
+the tool fails, may be subject to a timeout, and has its wall time and exit
+status recorded in ``RUNS``. The
+binary used for a tool may be swapped out, e.g. for a fake in tests or
+benchmarks, with ``set_tool()`` or a ``LEYLINE_<TOOL>`` environment variable,
+such as ``LEYLINE_PDFLATEX=/path/to/fake``.
+"""
+import os
+import time
+import asyncio
+import threading
+import subprocess
+
+
+TOOLS = {'pdflatex': 'pdflatex', 'gs': 'gs', 'ffmpeg': 'ffmpeg'}
+# default timeouts [sec], None for never, since whole documents, such as a
+# semester of notes, may take many minutes to compile
+TIMEOUTS = {'pdflatex': None, 'gs': None, 'ffmpeg': None}
+# timeouts [sec] for the runs that make a single video frame, which are quick
+# unless something is stuck
+FRAME_TIMEOUTS = {'pdflatex': 300.0, 'gs': 120.0}
+LOG_TAIL = 20  # number of log lines shown when a tool fails
+
+# directory that tool logs are written to, None for the current directory
+log_dir = None
+# whether to keep the logs of runs that succeed
+keep_logs = False
+RUNS = []
+_runs_lock = threading.Lock()
+_counter = 0
+
+
+class ToolError(subprocess.CalledProcessError):
+    """A tool exited with a non-zero status, or timed out."""
+
+    def __init__(self, returncode, cmd, logfile=None, timed_out=False):
+        super().__init__(returncode, cmd)
+        self.logfile = logfile
+        self.timed_out = timed_out
+
+    def __str__(self):
+        if self.timed_out:
+            s = 'Command {0!r} timed out'.format(self.cmd)
+        else:
+            s = super().__str__()
+        if self.logfile is not None:
+            s += '; see ' + self.logfile
+        return s
+
+
+class ToolRun:
+    """The record of a single invocation of a tool. The logfile is None if
+    the run succeeded and its log was removed.
+    """
+
+    def __init__(self, tool, cmd, logfile, wall, returncode, timed_out=False):
+        self.tool = tool
+        self.cmd = cmd
+        self.logfile = logfile
+        self.wall = wall
+        self.returncode = returncode
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return ('ToolRun({0!r}, returncode={1!r}, wall={2:.3f}, '
+                'timed_out={3!r})').format(self.tool, self.returncode, self.wall,
+                                           self.timed_out)
+
+
+def set_tool(tool, binary):
+    """Sets the binary that is run for a tool."""
+    TOOLS[tool] = binary
+
+
+def binary(tool):
+    """Returns the binary that is run for a tool."""
+    return os.environ.get('LEYLINE_' + tool.upper(), TOOLS.get(tool, tool))
+
+
+def _logfile(tool, name):
+    global _counter
+    with _runs_lock:
+        _counter += 1
+        n = _counter
+    d = log_dir or '.'
+    os.makedirs(d, exist_ok=True)
+    name = os.path.basename(name) if name else str(n)
+    return os.path.join(d, '{0}.{1}.log'.format(name, tool))
+
+
+def _record(tool, cmd, logfile, wall, returncode, timed_out):
+    failed = returncode != 0 or timed_out
+    if not failed and not keep_logs:
+        # only the logs of failures are worth keeping around
+        os.remove(logfile)
+        logfile = None
+    run = ToolRun(tool, cmd, logfile, wall, returncode, timed_out=timed_out)
+    with _runs_lock:
+        RUNS.append(run)
+    if failed:
+        print_log_tail(logfile)
+        raise ToolError(returncode, cmd, logfile=logfile, timed_out=timed_out)
+    return run
+
+
+def print_log_tail(logfile, n=LOG_TAIL):
+    """Prints the last lines of a log, to show why a tool failed."""
+    try:
+        with open(logfile, 'r', errors='replace') as f:
+            lines = f.readlines()[-n:]
+    except OSError:
+        return
+    print('\x1b[1m' + logfile + '\x1b[0m:')
+    print(''.join(lines), end='')
+
+
+def _environ(env):
+    if not env:
+        return None
+    environ = dict(os.environ)
+    environ.update(env)
+    return environ
+
+
+def run(tool, args, cwd=None, name=None, timeout=-1, retries=0, env=None):
+    """Runs a tool to completion, with its output captured to a log file.
+
+    Parameters
+    ----------
+    tool : str
+        Name of the tool, such as 'pdflatex'.
+    args : list of str
+        Arguments to the tool.
+    cwd : str, optional
+        Directory to run the tool in.
+    name : str, optional
+        Name for the log file, which is ``<log_dir>/<name>.<tool>.log``. The
+        log is removed if the tool succeeds, unless keep_logs is set.
+    timeout : float or None, optional
+        Seconds after which the tool is killed. Defaults to the tool's
+        entry in TIMEOUTS; None means never.
+    retries : int, optional
+        Number of times to retry a failing or timed out tool.
+    env : dict, optional
+        Environment variables to set for the tool.
+
+    Returns
+    -------
+    run : ToolRun
+        The record of the successful invocation.
+    """
+    if timeout == -1:
+        timeout = TIMEOUTS.get(tool, None)
+    cmd = [binary(tool)] + list(args)
+    logfile = _logfile(tool, name)
+    for attempt in range(retries + 1):
+        t0 = time.monotonic()
+        timed_out = False
+        with open(logfile, 'wb') as log:
+            try:
+                returncode = subprocess.run(cmd, cwd=cwd, stdout=log,
+                                            stderr=subprocess.STDOUT,
+                                            stdin=subprocess.DEVNULL,
+                                            env=_environ(env),
+                                            timeout=timeout).returncode
+            except subprocess.TimeoutExpired:
+                returncode = -9
+                timed_out = True
+        try:
+            return _record(tool, cmd, logfile, time.monotonic() - t0,
+                           returncode, timed_out)
+        except ToolError:
+            if attempt == retries:
+                raise
+
+
+async def run_async(tool, args, cwd=None, name=None, timeout=-1, retries=0,
+                    env=None):
+    """Runs a tool as an asyncio subprocess. Takes the same arguments as
+    run().
+    """
+    if timeout == -1:
+        timeout = TIMEOUTS.get(tool, None)
+    cmd = [binary(tool)] + list(args)
+    logfile = _logfile(tool, name)
+    for attempt in range(retries + 1):
+        t0 = time.monotonic()
+        timed_out = False
+        with open(logfile, 'wb') as log:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+                stdin=subprocess.DEVNULL, env=_environ(env))
+            try:
+                returncode = await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                returncode = -9
+                timed_out = True
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+        try:
+            return _record(tool, cmd, logfile, time.monotonic() - t0,
+                           returncode, timed_out)
+        except ToolError:
+            if attempt == retries:
+                raise
+
+
+_versions = {}
+
+
+def version(tool):
+    """Returns the first line that a tool prints for --version, or '' if
+    the tool cannot be run.
+    """
+    b = binary(tool)
+    if b not in _versions:
+        try:
+            out = subprocess.run([b, '--version'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 stdin=subprocess.DEVNULL, timeout=30).stdout
+            _versions[b] = out.decode(errors='replace').partition('\n')[0]
+        except (OSError, subprocess.SubprocessError):
+            _versions[b] = ''
+    return _versions[b]
+
+
+def summary():
+    """Returns the number of runs, failures, and wall time per tool."""
+    totals = {}
+    with _runs_lock:
+        runs = list(RUNS)
+    for r in runs:
+        n, failed, wall = totals.get(r.tool, (0, 0, 0.0))
+        failed += r.returncode != 0 or r.timed_out
+        totals[r.tool] = (n + 1, failed, wall + r.wall)
+    s = ''
+    for tool, (n, failed, wall) in sorted(totals.items()):
+        s += '  {0}: {1} runs, {2} failed, {3:.2f} s\n'.format(tool, n, failed,
+                                                               wall)
+    return s
@@ -1,16 +1,21 @@
 """Tools for rendering leyline ASTs as video"""
 import os
 import re
+import shutil
 import tempfile
+import functools
+import threading
 import itertools
-import subprocess
 
 from lazyasd import lazyobject
 
+from leyline import tools, texbuild, texformat
 from leyline.ast import Document
 from leyline.latex import Latex
+from leyline.assets import fingerprint, versioned_key, replace_file
 from leyline.audio import Dictation, append_to_track
-from leyline.events import EventsVisitor, Slide
+from leyline.events import EventsVisitor, Slide, Timeline
+from leyline.scheduler import Scheduler, Abort
 
 
 @lazyobject
@@ -124,45 +129,142 @@ def linkpath(path):
     return p
 
 
+GS_FRAME_ARGS = ('-dNOPAUSE', '-sDEVICE=jpeg', '-dFirstPage=1', '-dLastPage=1',
+                 '-dJPEGQ=100', '-dFIXEDMEDIA', '-dPDFFitPage', '-g1920x1080',
+                 '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', '-q')
+# quarter size, lower quality frames for checking timing
+GS_PREVIEW_ARGS = ('-dNOPAUSE', '-sDEVICE=jpeg', '-dFirstPage=1', '-dLastPage=1',
+                   '-dJPEGQ=60', '-dFIXEDMEDIA', '-dPDFFitPage', '-g960x540',
+                   '-dTextAlphaBits=2', '-dGraphicsAlphaBits=2', '-q')
+
+
+class FrameBuildDir:
+    """A directory that all of the frames of a lecture are compiled in. Links
+    to figures are made once and shared by every frame, and each frame's
+    scratch files are named by its hash so that frames may be compiled in
+    parallel, even by several builds of the same lecture at once. A build
+    dir without a path is a temporary directory.
+    """
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        if path is None:
+            path = tempfile.mkdtemp(prefix='leyline-frames-')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._links = set()
+        self._jobs = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+    def link(self, path):
+        """Links a figure path into the build dir, if it is not already."""
+        with self._lock:
+            if path in self._links:
+                return
+            dst = os.path.join(self.path, path)
+            target = os.path.abspath(path)
+            if not (os.path.islink(dst) and os.readlink(dst) == target):
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                os.symlink(target, dst, target_is_directory=os.path.isdir(path))
+            self._links.add(path)
+
+    def job(self, name):
+        """Returns the path that a frame's scratch files, name.tex, name.pdf,
+        and so on, start with, and notes them for removal by cleanup().
+        """
+        with self._lock:
+            self._jobs.add(name)
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        """Removes the scratch files of all of this build's frames at once.
+        Files of other builds that share the directory are left alone, as are
+        links to figures, which are kept for the next build, unless the build
+        dir is temporary.
+        """
+        if self.temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        with self._lock:
+            jobs, self._jobs = self._jobs, set()
+        with os.scandir(self.path) as it:
+            scratch = [entry.path for entry in it
+                       if entry.name.partition('.')[0] in jobs and
+                       not entry.is_symlink() and entry.is_file()]
+        for filename in scratch:
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+
 class Frame(Latex):
     """Renders a video frame via the LaTeX Beamer package."""
 
     renders = 'video'
+    preview = False
+    # changes to the template or to the rasterization invalidate all frames
+    asset_version = fingerprint(HEADER, FOOTER, *GS_FRAME_ARGS)
+    preview_version = fingerprint(HEADER, FOOTER, *GS_PREVIEW_ARGS)
 
     def render(self, *, tree=None, assets=None, assets_dir='.', title=None,
-               **kwargs):
+               preview=False, builddir=None, **kwargs):
         """Renders a single 1080p frame of video as a jpg via LaTeX.
-        Returns the filename.
+        Preview frames are rendered at 540p and cached separately, under the
+        'preview' kind. Frames are compiled in builddir, a FrameBuildDir, or
+        in a temporary one if it is None. Returns the filename.
         """
         self.title = title
+        self.preview = preview
         self.linkpaths = []
         s = self.visit(tree)
-        asset_key = ('frame', s)
+        if preview:
+            kind, version = 'preview', self.preview_version
+        else:
+            kind, version = 'frame', self.asset_version
+        assets.register_version(kind, version)
+        asset_key = versioned_key(kind, s, version)
+        # hold the key so that parallel builds do not render it twice
+        with assets.claim(asset_key):
+            if builddir is not None:
+                return self._render_frame(s, asset_key, assets, assets_dir,
+                                          builddir)
+            with FrameBuildDir() as builddir:
+                return self._render_frame(s, asset_key, assets, assets_dir,
+                                          builddir)
+
+    def _render_frame(self, s, asset_key, assets, assets_dir, builddir):
         if asset_key in assets:
             filename = assets[asset_key]
             print('found \x1b[1m' + filename + '\x1b[0m in cache')
             assets[asset_key] = filename  # update src hash
             return filename
         h = assets.hash(asset_key)
-        basename = h + '.jpg'
-        filename = os.path.join(assets_dir, basename)
-        with tempfile.TemporaryDirectory(prefix='frame-' + h) as d:
-            # create symlinks
-            for linkpath in self.linkpaths:
-                os.symlink(os.path.abspath(linkpath), os.path.join(d, linkpath),
-                           target_is_directory=os.path.isdir(linkpath))
-            # write tex
-            texname = os.path.join(d, h + '.tex')
-            with open(texname, 'w') as f:
-                f.write(s)
-            subprocess.check_call(['pdflatex', texname], cwd=d)
-            pdfname = os.path.join(d, h + '.pdf')
-            subprocess.check_call([
-                'gs', '-dNOPAUSE', '-sDEVICE=jpeg', '-dFirstPage=1',
-                '-dLastPage=1', '-sOutputFile=' + filename,
-                '-dJPEGQ=100', '-dFIXEDMEDIA', '-dPDFFitPage', '-g1920x1080',
-                '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4',
-                '-q', pdfname, '-c', 'quit'])
+        filename = assets.path(asset_key, '.jpg', assets_dir)
+        for linkpath in self.linkpaths:
+            builddir.link(linkpath)
+        job = builddir.job(h)
+        texname = job + '.tex'
+        texformat.pdflatex(texname, s, cwd=builddir.path, name='frame-' + h,
+                           assets=assets, assets_dir=assets_dir,
+                           timeout=tools.FRAME_TIMEOUTS['pdflatex'])
+        pdfname = job + '.pdf'
+        jpgname = job + '.jpg'
+        gs_args = GS_PREVIEW_ARGS if self.preview else GS_FRAME_ARGS
+        tools.run('gs', ['-sOutputFile=' + jpgname] + list(gs_args) +
+                  [pdfname, '-c', 'quit'], name='frame-' + h,
+                  timeout=tools.FRAME_TIMEOUTS['gs'])
+        # the old file may be a link to a blob that other frames share
+        replace_file(jpgname, filename)
+        if assets.dedupe(filename):
+            print('\x1b[1m' + filename + '\x1b[0m is identical to an existing frame')
         assets[asset_key] = filename
         return filename
 
@@ -193,16 +295,16 @@ class Slides(Latex):
 
     renders = 'slides'
 
-    def render(self, *, tree=None, filename=None, **kwargs):
+    def render(self, *, tree=None, filename=None, assets=None, assets_dir='.',
+               **kwargs):
         """Renders the slide deck and returns the filename.
         """
         s = self.visit(tree)
         basename, _ = os.path.splitext(filename)
         texfile = basename + '-slides.tex'
         pdffile = basename + '-slides.pdf'
-        with open(texfile, 'w') as f:
-            f.write(s)
-        subprocess.check_call(['pdflatex', texfile])
+        texbuild.build(texfile, s, name=basename + '-slides', assets=assets,
+                       assets_dir=assets_dir)
         return pdffile
 
     def visit_document(self, node):
@@ -212,31 +314,255 @@ class Slides(Latex):
         return s
 
 
+def parse_slide_range(s):
+    """Parses a 1-based, inclusive slide range such as '12-14' or '7' into
+    a (first, last) tuple.
+    """
+    first, _, last = s.partition('-')
+    first = int(first)
+    last = int(last) if last else first
+    if first < 1 or last < first:
+        raise ValueError('invalid slide range {0!r}'.format(s))
+    return first, last
+
+
+def parse_timestamp(s):
+    """Parses a time such as '1:05:00', '05:00', or '300.5' into seconds."""
+    t = 0.0
+    for part in s.split(':'):
+        t = 60.0 * t + float(part)
+    return t
+
+
+def parse_time_range(s):
+    """Parses a time window such as '05:00-08:30' into a (start, stop) tuple
+    of seconds.
+    """
+    start, _, stop = s.partition('-')
+    start, stop = parse_timestamp(start), parse_timestamp(stop)
+    if stop <= start:
+        raise ValueError('invalid time range {0!r}'.format(s))
+    return start, stop
+
+
+def ffconcat_entries(slides, frames):
+    """Returns a list of [frame, duration] pairs for the subslides. Runs of
+    subslides that share a frame are merged into a single entry with the
+    combined duration, so that the encoder sees one long still.
+    """
+    entries = []
+    for slide, framelist in zip(slides, frames):
+        itr = zip(slide.body, slide.duration, framelist)
+        for subslide, duration, frame in itr:
+            if not subslide or frame is None:
+                continue
+            if entries and entries[-1][0] == frame:
+                entries[-1][1] += duration
+            else:
+                entries.append([frame, duration])
+    return entries
+
+
+# x264 settings for slide videos. The concat demuxer already gives each
+# still its duration, so frames are passed through at a variable rate
+# instead of being duplicated 24 times a second.
+ENCODING_PRESETS = {
+    'draft': ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'stillimage',
+              '-crf', '30'],
+    'final': ['-c:v', 'libx264', '-preset', 'slow', '-tune', 'stillimage',
+              '-crf', '18'],
+    # the original constant 24 fps encoding, kept for comparison
+    'legacy': ['-vf', 'fps=24'],
+    }
+STILL_GOP = 600  # frames between forced keyframes within a long still run
+
+
+def encoding_args(entries, preset='final'):
+    """Returns the ffmpeg output arguments for encoding [frame, duration]
+    pairs with a preset. Slide video presets use a variable frame rate, a
+    long GOP, and keyframes at each slide boundary so that seeking lands on
+    a slide change.
+    """
+    args = list(ENCODING_PRESETS[preset])
+    if preset == 'legacy':
+        return args
+    t = 0.0
+    times = []
+    for frame, duration in entries:
+        times.append('{0:.3f}'.format(t))
+        t += duration or 0.0
+    args += ['-vsync', 'vfr', '-g', str(STILL_GOP), '-pix_fmt', 'yuv420p',
+             '-force_key_frames', ','.join(times)]
+    return args
+
+
+def make_ffconcat(entries):
+    """Returns the ffmpeg concat demuxer script for [frame, duration] pairs."""
+    s = 'ffconcat version 1.0\n'
+    t = 'file {0}\nduration {1}\n'
+    for frame, duration in entries:
+        s += t.format(frame, duration)
+    # need to copy last frame to prevent cutoff
+    if entries:
+        s += t.format(entries[-1][0], 0.0)
+    return s
+
+
 class Video(EventsVisitor):
     """Renders a movie for a tree."""
 
     renders = 'video'
 
     def render(self, *, tree=None, filename='', assets=None, assets_dir='.',
-               **kwargs):
-        """Renders a movie, with synced up audio!"""
+               dictation_casefold=False, video_preset='final', preview=False,
+               slide_range=None, time_range=None, jobs=None, **kwargs):
+        """Renders a movie, with synced up audio! A preview uses low
+        resolution frames and the draft encoding, and is written next to the
+        full movie with a .preview.mp4 extension. Giving a slide_range
+        (1-based and inclusive) or a time_range (in seconds) renders only
+        those subslides, as a standalone .clip.mp4.
+
+        Frames are rendered, up to jobs at a time, while the audio is being
+        recorded. The movie is encoded once both are done.
+        """
+        self.dictation_casefold = dictation_casefold
+        self.video_preset = 'draft' if preview else video_preset
+        self.preview = preview
         self.visit(tree)  # fill events
         slides = [event for event in self.events if isinstance(event, Slide)]
         basename, _ = os.path.splitext(filename)
-        oggfile = self.render_audio(slides, basename, assets, assets_dir)
-        if oggfile is None:
+        self.selected = None
+        if slide_range is not None or time_range is not None:
+            self.selected = self.select(slides, assets, slide_range=slide_range,
+                                        time_range=time_range)
+            print('rendering {0} subslides'.format(len(self.selected)))
+            basename += '.clip'
+        if preview:
+            basename += '.preview'
+        sched = Scheduler(limits={'latex': jobs or os.cpu_count() or 1,
+                                  'ffmpeg': 1})
+        # the dictation may be blocked on the user, so it must not keep the
+        # process alive once the build has failed or been interrupted
+        sched.add('audio', functools.partial(self._audio_stage, slides, basename,
+                                             assets, assets_dir, sched.cancelled),
+                  daemon=True)
+        positions = []
+        for j, i, subdoc, title in self.frame_jobs(slides):
+            positions.append((j, i))
+            sched.add('frame-{0}-{1}'.format(j + 1, i),
+                      functools.partial(self._frame_stage, subdoc, title, assets,
+                                        assets_dir), tool='latex')
+
+        self.builddir = FrameBuildDir(basename + '.build')
+
+        def encode(oggfile, *fnames):
+            frames = [[None] * len(slide.body) for slide in slides]
+            for (j, i), fname in zip(positions, fnames):
+                frames[j][i] = fname
+            return self.render_video(slides, basename, oggfile, frames)
+
+        sched.add('encode', encode, deps=list(sched.tasks), tool='ffmpeg')
+        try:
+            results = sched.run()
+        except Abort:
             return
-        frames = self.render_frames(slides, assets, assets_dir)
-        mp4file = self.render_video(slides, basename, oggfile, frames)
-        return mp4file
+        finally:
+            self.builddir.cleanup()
+            sched.write_log(basename + '.tasks.tsv')
+            print('Task timings:\n' + sched.report(), end='')
+        return results['encode']
+
+    def _audio_stage(self, slides, basename, assets, assets_dir, cancelled=None):
+        oggfile = self.render_audio(slides, basename, assets, assets_dir,
+                                    cancelled=cancelled)
+        if oggfile is None:
+            raise Abort('dictation quit')
+        self.timeline = Timeline.from_slides(slides)
+        self.timeline.dump(basename + '.timeline.json')
+        return oggfile
 
-    def render_audio(self, slides, basename, assets, assets_dir):
-        """Renders the audio track for a slide. Returns the path
-        to the audio file.
-        """
+    def _frame_stage(self, subdoc, title, assets, assets_dir):
+        # frames keep state while rendering, so each task gets its own
+        framer = Frame(contexts=self.contexts)
+        return framer.render(tree=subdoc, assets=assets, assets_dir=assets_dir,
+                             title=title, preview=getattr(self, 'preview', False),
+                             builddir=self.builddir)
+
+    def _dictation(self):
         dictation = getattr(self, 'dictation', None)
         if dictation is None:
             dictation = self.dictation = Dictation(contexts=self.contexts)
+        return dictation
+
+    def _is_selected(self, j, i):
+        selected = getattr(self, 'selected', None)
+        return selected is None or (j, i) in selected
+
+    def measure_timeline(self, slides, assets):
+        """Fills in the start times and durations of the subslides from
+        already recorded dictation, without recording anything. Blocks that
+        have not been recorded yet count as taking no time. Returns the
+        number of such blocks.
+        """
+        dictation = self._dictation()
+        parbreakdur = 0.75
+        missing = 0
+        clock = 0.0
+        for slide in slides:
+            for i, subslide in enumerate(slide.body):
+                if not subslide:
+                    continue
+                n0 = subslide[0]
+                subdoc = Document(body=subslide, lineno=n0.lineno,
+                                  column=n0.column)
+                dictation.casefold = self.dictation_casefold
+                dur = 0.0
+                for block in dictation.visit(subdoc):
+                    asset_key = dictation.asset_key(block)
+                    if asset_key in assets:
+                        dur += sf.info(assets[asset_key]).duration + parbreakdur
+                    else:
+                        missing += 1
+                slide.start[i] = clock
+                slide.duration[i] = dur
+                clock += dur
+        return missing
+
+    def select(self, slides, assets, slide_range=None, time_range=None):
+        """Returns the set of (slide index, subslide index) pairs in the
+        slide range and overlapping the time window. Raises a ValueError if
+        there are none, since there would be nothing to render.
+        """
+        selected = set()
+        for j, slide in enumerate(slides):
+            if slide_range is not None and \
+                    not (slide_range[0] <= j + 1 <= slide_range[1]):
+                continue
+            selected.update((j, i) for i, subslide in enumerate(slide.body)
+                            if subslide)
+        if time_range is not None:
+            missing = self.measure_timeline(slides, assets)
+            if missing:
+                print('{0} blocks have not been dictated, so times are '
+                      'approximate'.format(missing))
+            timeline = Timeline.from_slides(slides)
+            selected.intersection_update(timeline.overlapping(*time_range))
+        if not selected:
+            where = []
+            if slide_range is not None:
+                where.append('slides {0}-{1}'.format(*slide_range))
+            if time_range is not None:
+                where.append('times {0:g}-{1:g} s'.format(*time_range))
+            raise ValueError('nothing to render in {0}, the lecture has {1} '
+                             'slides'.format(' and '.join(where), len(slides)))
+        return selected
+
+    def render_audio(self, slides, basename, assets, assets_dir, cancelled=None):
+        """Renders the audio track for a slide. Returns the path
+        to the audio file, or None if the dictation was quit or the
+        cancelled event was set.
+        """
+        dictation = self._dictation()
         samplerate = int(dictation.recorder.samplerate)
         channels = 2
         parbreakdur = 0.75  # number of seconds to break between paragraphs
@@ -246,18 +572,28 @@ class Video(EventsVisitor):
                              channels=channels, format='OGG', subtype='VORBIS')
         clock = 0.0
         # record audio for slides by recording audio for subslides
-        for slide in slides:
+        for j, slide in enumerate(slides):
             for i, subslide in enumerate(slide.body):
                 dur = 0.0
                 if not subslide:
                     continue
+                if not self._is_selected(j, i):
+                    # not in this clip
+                    slide.start[i] = slide.duration[i] = None
+                    continue
+                if cancelled is not None and cancelled.is_set():
+                    track.close()
+                    return
                 slide.start[i] = clock
                 n0 = subslide[0]
                 subdoc = Document(body=subslide, lineno=n0.lineno,
                                   column=n0.column)
                 files = dictation.render(tree=subdoc, assets=assets,
-                                         assets_dir=assets_dir)
+                                         assets_dir=assets_dir,
+                                         dictation_casefold=self.dictation_casefold,
+                                         cancelled=cancelled)
                 if files is None:
+                    track.close()
                     return
                 for fname in files:
                     dur += append_to_track(track, fname)
@@ -270,50 +606,53 @@ class Video(EventsVisitor):
         track.close()
         return oggfile
 
-    def render_frames(self, slides, assets, assets_dir):
-        """Render each frame and return a list of list of filename
-        matching the slide/subslide arrangement.
+    def frame_jobs(self, slides):
+        """Yields (slide index, subslide index, document, title) for each
+        frame that should be rendered. A subslide's frame shows all of the
+        subslides on its slide up to and including it.
         """
-        framer = getattr(self, 'framer', None)
-        if framer is None:
-            framer = self.framer = Frame(contexts=self.contexts)
-        # render the actual frames
-        slidesframes = []
-        for slide in slides:
-            slideframes = []
-            slidesframes.append(slideframes)
+        for j, slide in enumerate(slides):
             body = []
             for i, subslide in enumerate(slide.body):
                 if not subslide:
-                    slideframes.append(None)
                     continue
                 body.extend(subslide)
+                if not self._is_selected(j, i):
+                    # earlier subslides still build up the frame's body
+                    continue
                 n0 = body[0]
-                subdoc = Document(body=body, lineno=n0.lineno,
+                subdoc = Document(body=list(body), lineno=n0.lineno,
                                   column=n0.column)
-                fname = framer.render(tree=subdoc, assets=assets,
-                                      assets_dir=assets_dir, title=slide.title)
-                slideframes.append(fname)
+                yield j, i, subdoc, slide.title
+
+    def render_frames(self, slides, assets, assets_dir):
+        """Render each frame and return a list of list of filename
+        matching the slide/subslide arrangement.
+        """
+        framer = getattr(self, 'framer', None)
+        if framer is None:
+            framer = self.framer = Frame(contexts=self.contexts)
+        # render the actual frames
+        slidesframes = [[None] * len(slide.body) for slide in slides]
+        for j, i, subdoc, title in self.frame_jobs(slides):
+            slidesframes[j][i] = framer.render(
+                tree=subdoc, assets=assets, assets_dir=assets_dir, title=title,
+                preview=getattr(self, 'preview', False),
+                builddir=getattr(self, 'builddir', None))
         return slidesframes
 
     def render_video(self, slides, basename, oggfile, frames):
         """Renders video from slide timings, an audio file, and frame files."""
-        s = 'ffconcat version 1.0\n'
-        t = 'file {0}\nduration {1}\n'
-        for slide, framelist in zip(slides, frames):
-            itr = zip(slide.body, slide.start, slide.duration, framelist)
-            for subslide, start, duration, frame in itr:
-                if not subslide:
-                    continue
-                s += t.format(frame, duration)
-        # need to copy last frame to prevent cutoff
-        s += t.format(frame, 0.0)
+        entries = ffconcat_entries(slides, frames)
+        s = make_ffconcat(entries)
         # write the ffmpeg concat demuxer file
         ffconcat = basename + '.ffconcat'
         with open(ffconcat, 'w') as f:
             f.write(s)
         # render the video with ffmpeg
         mp4file = basename + '.mp4'
-        subprocess.check_call(['ffmpeg', '-y', '-i', ffconcat, '-i', oggfile,
-                               '-vf', 'fps=24', '-shortest', mp4file])
+        preset = getattr(self, 'video_preset', 'final')
+        tools.run('ffmpeg', ['-y', '-i', ffconcat, '-i', oggfile] +
+                  encoding_args(entries, preset) + ['-shortest', mp4file],
+                  name=basename)
         return mp4file
@@ -0,0 +1,30 @@
+"""Shared test fixtures"""
+import os
+import sys
+
+import pytest
+
+from leyline import tools
+
+
+@pytest.fixture
+def fake_tool(tmpdir, monkeypatch):
+    """Returns a function that installs a Python script as a fake binary for
+    a tool, such as 'pdflatex' or 'gs', and returns the binary's path. Tool
+    logs are written to the test's temporary directory.
+    """
+    monkeypatch.setattr(tools, 'log_dir', str(tmpdir.join('logs')))
+
+    def make(tool, script):
+        filename = str(tmpdir.join(tool + '.py'))
+        with open(filename, 'w') as f:
+            f.write(script)
+        exe = str(tmpdir.join(tool))
+        with open(exe, 'w') as f:
+            f.write('#!/bin/sh\nexec {0} {1} "$@"\n'.format(sys.executable,
+                                                          filename))
+        os.chmod(exe, 0o755)
+        monkeypatch.setenv('LEYLINE_' + tool.upper(), exe)
+        return exe
+
+    return make
@@ -0,0 +1,498 @@
+"""Assets cache tests"""
+import os
+import time
+import hashlib
+
+import pytest
+
+from leyline.assets import (AssetsCache, SqliteAssetsCache, EvictionPolicy,
+                            UpstreamStore, export_bundle, import_bundle,
+                            versioned_key)
+
+
+@pytest.fixture
+def srcfile(tmpdir):
+    filename = os.path.join(str(tmpdir), 'lecture.ley')
+    with open(filename, 'w') as f:
+        f.write('my lecture')
+    return filename
+
+
+@pytest.fixture(params=[(AssetsCache, 'assets.json'),
+                        (SqliteAssetsCache, 'assets.db')],
+                ids=['json', 'sqlite'])
+def backend(request, tmpdir):
+    """Returns the class and a cachefile for each cache backend."""
+    cls, name = request.param
+    return cls, os.path.join(str(tmpdir), name)
+
+
+def make_asset(tmpdir, name):
+    filename = os.path.join(str(tmpdir), name)
+    with open(filename, 'w') as f:
+        f.write(name)
+    return filename
+
+
+def test_journal_replay(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    assets = AssetsCache(cachefile, srcfile)
+    for i in range(10):
+        assets[('frame', str(i))] = make_asset(tmpdir, str(i) + '.jpg')
+    del assets[('frame', '0')]
+    assert os.path.isfile(assets.journalfile)
+    # reload without closing, so that only the journal has the entries
+    loaded = AssetsCache(cachefile, srcfile)
+    assert len(loaded) == 9
+    assert ('frame', '0') not in loaded
+    assert loaded[('frame', '5')] == os.path.join(str(tmpdir), '5.jpg')
+
+
+def test_journal_compaction(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    with AssetsCache(cachefile, srcfile) as assets:
+        assets[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+    assert os.path.getsize(assets.journalfile) == 0
+    assert os.path.isfile(cachefile)
+    assert len(AssetsCache(cachefile, srcfile)) == 1
+
+
+def test_journal_truncated_record(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    assets = AssetsCache(cachefile, srcfile)
+    assets[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+    with open(assets.journalfile, 'a') as f:
+        f.write('{"op":"set","h":"abc')
+    loaded = AssetsCache(cachefile, srcfile)
+    assert len(loaded) == 1
+
+
+def test_unchanged_set_not_journaled(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    assets = AssetsCache(cachefile, srcfile)
+    filename = make_asset(tmpdir, 'x.jpg')
+    assets[('frame', 'x')] = filename
+    size = os.path.getsize(assets.journalfile)
+    assets[('frame', 'x')] = filename
+    assert os.path.getsize(assets.journalfile) == size
+
+
+def test_backend_api(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    with cls(cachefile, srcfile) as assets:
+        with assets.batch():
+            for i in range(5):
+                assets[('frame', str(i))] = make_asset(tmpdir, str(i) + '.jpg')
+            assets[('dictation', 'hi')] = make_asset(tmpdir, 'hi.ogg')
+        del assets[('frame', '4')]
+        assert len(assets) == 5
+        assert assets.keys_for_source(srcfile) == set(assets)
+    with cls(cachefile, srcfile) as assets:
+        assert len(assets) == 5
+        assert ('frame', '4') not in assets
+        assert assets[('dictation', 'hi')] == os.path.join(str(tmpdir), 'hi.ogg')
+        with pytest.raises(KeyError):
+            assets[('frame', '4')]
+
+
+def test_sqlite_kinds(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.db')
+    assets = SqliteAssetsCache(cachefile, srcfile)
+    assets[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+    assets[('dictation', 'y')] = make_asset(tmpdir, 'y.ogg')
+    assert assets.keys_for_kind('dictation') == {assets.hash(('dictation', 'y'))}
+
+
+def test_sqlite_total_bytes(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.db')
+    assets = SqliteAssetsCache(cachefile, srcfile)
+    for name in ('a.jpg', 'bb.jpg', 'ccc.jpg'):
+        assets[('frame', name)] = make_asset(tmpdir, name)
+    assert assets.total_bytes() == 5 + 6 + 7
+    del assets[('frame', 'bb.jpg')]
+    # another process sees the same total
+    assert SqliteAssetsCache(cachefile, srcfile).total_bytes() == 12
+    assets.clear()
+    assert assets.total_bytes() == 0
+
+
+def test_sqlite_batch_waits_for_other_writers(tmpdir, srcfile):
+    import threading
+    cachefile = os.path.join(str(tmpdir), 'assets.db')
+    first = SqliteAssetsCache(cachefile, srcfile)
+    second = SqliteAssetsCache(cachefile, srcfile)
+    started = threading.Event()
+
+    def read_then_write():
+        with first.batch():
+            ('frame', 'x') in first
+            started.set()
+            time.sleep(0.2)
+            first[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+
+    t = threading.Thread(target=read_then_write)
+    t.start()
+    started.wait()
+    # waits for the batch, rather than invalidating it
+    second[('frame', 'y')] = make_asset(tmpdir, 'y.jpg')
+    t.join()
+    assert len(SqliteAssetsCache(cachefile, srcfile)) == 2
+
+
+def test_gc(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    assets = cls(cachefile, srcfile)
+    old = make_asset(tmpdir, 'old.jpg')
+    assets[('frame', 'old')] = old
+    missing = make_asset(tmpdir, 'missing.jpg')
+    assets[('frame', 'missing')] = missing
+    os.remove(missing)
+    # change the source, and keep only the new frame
+    with open(srcfile, 'w') as f:
+        f.write('my edited lecture')
+    assets.srcfile = srcfile
+    assets[('frame', 'new')] = make_asset(tmpdir, 'new.jpg')
+    assets.gc()
+    assert list(assets) == [assets.hash(('frame', 'new'))]
+    assert not os.path.exists(old)
+    assets.close()
+
+
+def test_gc_dry_run(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    assets = cls(cachefile, srcfile)
+    old = make_asset(tmpdir, 'old.jpg')
+    assets[('frame', 'old')] = old
+    with open(srcfile, 'w') as f:
+        f.write('my edited lecture')
+    assets.srcfile = srcfile
+    report = assets.gc(dry_run=True)
+    assert report.removed == {assets.hash(('frame', 'old'))}
+    assert report.bytes_by_source == {srcfile: os.path.getsize(old)}
+    assert os.path.isfile(old)
+    assert ('frame', 'old') in assets
+    report = assets.gc()
+    assert not os.path.isfile(old)
+    assert len(assets) == 0
+
+
+def test_gc_shared_asset(tmpdir, srcfile):
+    # an asset used by two sources survives when only one of them changes
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    other = os.path.join(str(tmpdir), 'other.ley')
+    with open(other, 'w') as f:
+        f.write('other lecture')
+    assets = AssetsCache(cachefile, srcfile)
+    shared = make_asset(tmpdir, 'shared.jpg')
+    assets[('frame', 'shared')] = shared
+    assets.srcfile = other
+    assets[('frame', 'shared')] = shared
+    with open(srcfile, 'w') as f:
+        f.write('my edited lecture')
+    assets.srcfile = srcfile
+    assets.gc()
+    assert os.path.isfile(shared)
+    assert assets.keys_for_source(other) == {assets.hash(('frame', 'shared'))}
+    assert assets.keys_for_source(srcfile) == set()
+
+
+def test_concurrent_writers(tmpdir, srcfile):
+    # two caches on the same file stand in for two processes
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    a = AssetsCache(cachefile, srcfile, compact_threshold=0)
+    b = AssetsCache(cachefile, srcfile, compact_threshold=0)
+    for i in range(5):
+        a[('frame', 'a' + str(i))] = make_asset(tmpdir, 'a{0}.jpg'.format(i))
+        b[('frame', 'b' + str(i))] = make_asset(tmpdir, 'b{0}.jpg'.format(i))
+    # each sees the other's entries, without reloading
+    assert ('frame', 'b4') in a
+    assert ('frame', 'a4') in b
+    a.close()
+    b.close()
+    assert len(AssetsCache(cachefile, srcfile)) == 10
+    # no temporary snapshot files are left behind
+    assert not [f for f in os.listdir(str(tmpdir)) if f.startswith('.assets-')]
+
+
+def test_concurrent_sources(tmpdir, srcfile):
+    # links from different sources are merged rather than overwritten
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    other = os.path.join(str(tmpdir), 'other.ley')
+    with open(other, 'w') as f:
+        f.write('other lecture')
+    a = AssetsCache(cachefile, srcfile)
+    b = AssetsCache(cachefile, other)
+    shared = make_asset(tmpdir, 'shared.jpg')
+    a[('frame', 'shared')] = shared
+    b[('frame', 'shared')] = shared
+    a.refresh()
+    assert a.keys_for_source(other) == {a.hash(('frame', 'shared'))}
+    assert set(a.cache[a.hash(('frame', 'shared'))][1]) == {srcfile, other}
+
+
+def test_claim(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    a = AssetsCache(cachefile, srcfile)
+    b = AssetsCache(cachefile, srcfile)
+    with a.claim(('frame', 'x')):
+        a[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+    with b.claim(('frame', 'x')):
+        assert ('frame', 'x') in b
+    # claims do not leave lock files behind
+    assert os.listdir(cachefile + '.locks') == []
+
+
+def test_claim_serializes_threads(tmpdir, srcfile):
+    from concurrent.futures import ThreadPoolExecutor
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    caches = [AssetsCache(cachefile, srcfile) for _ in range(4)]
+    produced = []
+
+    def produce(assets):
+        with assets.claim(('frame', 'x')):
+            if ('frame', 'x') not in assets:
+                produced.append(assets)
+                time.sleep(0.05)
+                assets[('frame', 'x')] = make_asset(tmpdir, 'x.jpg')
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(produce, caches * 5))
+    assert len(produced) == 1
+    assert os.listdir(cachefile + '.locks') == []
+
+
+def test_sharded_layout(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    d = str(tmpdir)
+    assets = cls(cachefile, srcfile)
+    key = ('frame', 'x')
+    flat = assets.path(key, '.jpg')
+    assert flat == os.path.join(d, assets.hash(key) + '.jpg')
+    with open(flat, 'w') as f:
+        f.write('x')
+    assets[key] = flat
+    assets.close()
+    # reopening with the sharded layout moves the asset when it is used
+    assets = cls(cachefile, srcfile, layout='sharded')
+    h = assets.hash(key)
+    sharded = os.path.join(d, h[:2], h[2:4], h + '.jpg')
+    assert assets.path(key, '.jpg') == sharded
+    assert assets[key] == sharded
+    assert os.path.isfile(sharded)
+    assert not os.path.exists(flat)
+    assert assets.migrate() == 0
+    assets.close()
+    # and back again, in bulk
+    assets = cls(cachefile, srcfile)
+    assert assets.migrate() == 1
+    assert os.path.isfile(flat)
+    assert assets[key] == flat
+
+
+def test_eviction_lru_bytes(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    assets = cls(cachefile, srcfile)
+    for i in range(5):
+        assets[('frame', str(i))] = make_asset(tmpdir, 'frame{0}.jpg'.format(i))
+    recording = make_asset(tmpdir, 'recording.ogg')
+    assets[('dictation', 'hi')] = recording
+    assets.close()
+    # a new build, with a budget that only fits a couple of assets
+    size = os.path.getsize(recording)
+    policy = EvictionPolicy(max_bytes=2 * size + 20)
+    assets = cls(cachefile, srcfile, policy=policy)
+    assets[('frame', '4')]  # used by this build
+    assets[('frame', 'new')] = make_asset(tmpdir, 'new.jpg')
+    # 10-byte frames are evicted oldest first until the total fits
+    assert ('frame', '0') not in assets
+    assert ('frame', '2') not in assets
+    assert ('frame', '3') in assets
+    assert ('frame', '4') in assets
+    assert ('frame', 'new') in assets
+    assert ('dictation', 'hi') in assets
+    assert os.path.isfile(recording)
+    assert assets.eviction_stats.counts == {'frame': 3}
+    assert not os.path.exists(os.path.join(str(tmpdir), 'frame0.jpg'))
+
+
+def test_eviction_max_age(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    assets = AssetsCache(cachefile, srcfile)
+    assets[('frame', 'old')] = make_asset(tmpdir, 'old.jpg')
+    assets[('frame', 'recent')] = make_asset(tmpdir, 'recent.jpg')
+    m = assets.hash(('frame', 'old'))
+    info = dict(assets.info[m], atime=0.0)
+    assets._set_info(m, info)
+    assets.close()
+    assets = AssetsCache(cachefile, srcfile,
+                         policy=EvictionPolicy(max_age=86400.0))
+    assert assets.evict() == 1
+    assert ('frame', 'old') not in assets
+    assert ('frame', 'recent') in assets
+
+
+def test_hash_memo_bounded(tmpdir, srcfile):
+    cachefile = os.path.join(str(tmpdir), 'assets.json')
+    assets = AssetsCache(cachefile, srcfile)
+    assets.memo_size = 10
+    for i in range(100):
+        assets.hash(('dictation', str(i)))
+    assert len(assets._hashes) == 10
+    big = ('frame', 'x' * 200000)
+    h = assets.hash(big)
+    assert h == hashlib.md5(b'frame' + b'x' * 200000).hexdigest()
+    assert big not in assets._hashes
+    assert assets.hash(big) == h
+    assets.hash('small')
+    assert assets._last_key == 'small'
+    assert assets.hash(('frame', b'bytes')) == hashlib.md5(b'framebytes').hexdigest()
+
+
+@pytest.mark.parametrize('layout', ['flat', 'sharded'])
+def test_upstream_read_through(tmpdir, srcfile, layout):
+    shared = os.path.join(str(tmpdir), 'shared')
+    os.makedirs(shared)
+    # a colleague renders a frame and publishes it
+    alice_dir = os.path.join(str(tmpdir), 'alice')
+    os.makedirs(alice_dir)
+    alice = AssetsCache(os.path.join(alice_dir, 'assets.json'), srcfile,
+                        upstreams=[shared], publish=True, layout=layout)
+    key = ('frame', 'x')
+    filename = alice.path(key, '.jpg')
+    with open(filename, 'w') as f:
+        f.write('pixels')
+    alice[key] = filename
+    # which is then found on another machine, without rendering it
+    bob_dir = os.path.join(str(tmpdir), 'bob')
+    os.makedirs(bob_dir)
+    bob = AssetsCache(os.path.join(bob_dir, 'assets.json'), srcfile,
+                      upstreams=[UpstreamStore(shared)])
+    assert ('frame', 'y') not in bob
+    assert key in bob
+    local = bob[key]
+    assert local == os.path.join(bob_dir, alice.hash(key) + '.jpg')
+    with open(local) as f:
+        assert f.read() == 'pixels'
+
+
+def test_export_import_bundle(tmpdir, srcfile):
+    d = str(tmpdir)
+    warm_dir = os.path.join(d, 'warm')
+    os.makedirs(warm_dir)
+    warm = AssetsCache(os.path.join(warm_dir, 'assets.json'), srcfile)
+    for kind in ('frame', 'dictation'):
+        key = (kind, 'x')
+        ext = '.jpg' if kind == 'frame' else '.ogg'
+        filename = warm.path(key, ext)
+        with open(filename, 'w') as f:
+            f.write(kind)
+        warm[key] = filename
+    archive = os.path.join(d, 'bundle.tar.gz')
+    assert export_bundle(warm, archive, kinds=['frame']) == 1
+    # import into a fresh, sharded cache
+    cold_dir = os.path.join(d, 'cold')
+    os.makedirs(cold_dir)
+    cold = AssetsCache(os.path.join(cold_dir, 'assets.json'), srcfile,
+                       layout='sharded')
+    assert import_bundle(cold, archive) == 1
+    assert ('frame', 'x') in cold
+    assert ('dictation', 'x') not in cold
+    with open(cold[('frame', 'x')]) as f:
+        assert f.read() == 'frame'
+    assert cold.keys_for_kind('frame') == {cold.hash(('frame', 'x'))}
+    # importing again is deduplicated, and the entries survive gc
+    assert import_bundle(cold, archive) == 0
+    cold.gc()
+    assert ('frame', 'x') in cold
+
+
+def test_import_bundle_extracts_outside_transaction(tmpdir, srcfile):
+    import contextlib
+    d = str(tmpdir)
+    warm = AssetsCache(os.path.join(d, 'warm.json'), srcfile)
+    for i in range(3):
+        key = ('frame', str(i))
+        filename = warm.path(key, '.jpg')
+        with open(filename, 'w') as f:
+            f.write(str(i))
+        warm[key] = filename
+    archive = os.path.join(d, 'bundle.tar')
+    export_bundle(warm, archive)
+    cold_dir = os.path.join(d, 'cold')
+    os.makedirs(cold_dir)
+    cold = SqliteAssetsCache(os.path.join(cold_dir, 'assets.db'), srcfile)
+    batch = cold.batch
+    extracted = []
+
+    @contextlib.contextmanager
+    def watched_batch():
+        names = os.listdir(cold_dir)
+        extracted.append(len([n for n in names if n.endswith('.jpg')]))
+        with batch():
+            yield cold
+
+    cold.batch = watched_batch
+    assert import_bundle(cold, archive) == 3
+    # every file was in place before the write lock was taken
+    assert extracted[0] == 3
+    assert ('frame', '2') in cold
+
+
+def test_renderer_versions(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    assets = cls(cachefile, srcfile)
+    assert assets.register_version('frame', 'v1') == 0
+    old_frame = versioned_key('frame', 'x', 'v1')
+    assets[old_frame] = make_asset(tmpdir, 'x1.jpg')
+    assets[('dictation', 'x')] = make_asset(tmpdir, 'x.ogg')
+    assets.close()
+    # a new frame renderer only invalidates the frames
+    assets = cls(cachefile, srcfile)
+    assert assets.versions == {'frame': 'v1'}
+    assert assets.register_version('frame', 'v2') == 1
+    new_frame = versioned_key('frame', 'x', 'v2')
+    assert new_frame not in assets
+    assets[new_frame] = make_asset(tmpdir, 'x2.jpg')
+    assert assets.stale_versions() == {'frame': {assets.hash(old_frame)}}
+    report = assets.gc()
+    assert report.removed == {assets.hash(old_frame)}
+    assert not os.path.exists(os.path.join(str(tmpdir), 'x1.jpg'))
+    assert new_frame in assets
+    assert ('dictation', 'x') in assets
+    assert assets.stale_versions() == {}
+
+
+def test_dedupe_frames_across_lectures(tmpdir, srcfile):
+    d = str(tmpdir)
+    assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+    first = make_asset(tmpdir, 'first.jpg')
+    assert not assets.dedupe(first)
+    second = os.path.join(d, 'second.jpg')
+    with open(second, 'w') as f:
+        f.write('first.jpg')
+    assert assets.dedupe(second)
+    assert os.path.samefile(first, second)
+    assets[('frame', 'first')] = first
+    assets[('frame', 'second')] = second
+    # the blob stays until no asset links to it
+    os.remove(first)
+    assets.gc()
+    assert os.path.isfile(second)
+    os.remove(second)
+    assets.gc()
+    assert not any(files for _, _, files in os.walk(os.path.join(d, 'blobs')))
+
+
+def test_shared_between_threads(tmpdir, srcfile, backend):
+    cls, cachefile = backend
+    from concurrent.futures import ThreadPoolExecutor
+    assets = cls(cachefile, srcfile)
+
+    def put(i):
+        key = ('frame', str(i))
+        assets[key] = make_asset(tmpdir, '{0}.jpg'.format(i))
+        return key in assets
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert all(pool.map(put, range(64)))
+    assert len(assets) == 64
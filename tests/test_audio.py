@@ -0,0 +1,203 @@
+"""Audio rendering tests"""
+import io
+import os
+import threading
+
+import pytest
+
+from leyline.assets import AssetsCache
+from leyline.audio import (BlockWriter, PollySynthesizer, PARAGRAPH_BREAK,
+                           Dictation, pack_ssml, speech_text)
+
+
+def test_block_writer(tmpdir):
+    np = pytest.importorskip('numpy')
+    sf = pytest.importorskip('soundfile')
+    filename = os.path.join(str(tmpdir), 'take.ogg.part')
+    nblocks, blocksize = 10, 441
+    with BlockWriter(filename, samplerate=44100, channels=1,
+                     blocksize=blocksize, nblocks=nblocks) as writer:
+        for i in range(nblocks):
+            writer.put(np.zeros((blocksize, 1), dtype='float32'))
+    assert writer.dropped == 0
+    with sf.SoundFile(filename) as f:
+        assert f.frames == nblocks * blocksize
+
+
+class FakePolly:
+    """Local stand-in for the AWS Polly client."""
+
+    def __init__(self, throttle=0):
+        self.throttle = throttle
+        self.calls = []
+
+    def synthesize_speech(self, Text, TextType, VoiceId, OutputFormat):
+        self.calls.append(Text)
+        if self.throttle > 0:
+            self.throttle -= 1
+            e = RuntimeError('slow down')
+            e.response = {'Error': {'Code': 'ThrottlingException'}}
+            raise e
+        return {'AudioStream': io.BytesIO(Text.encode())}
+
+
+BLOCKS = ['<speak>block {0}</speak>'.format(i) for i in range(10)]
+
+
+def test_polly_ordered(tmpdir):
+    outfile = os.path.join(str(tmpdir), 'out.mp3')
+    client = FakePolly()
+    synth = PollySynthesizer(client, max_workers=3)
+    synth.render(BLOCKS, outfile)
+    with open(outfile, 'rb') as f:
+        assert f.read() == ''.join(BLOCKS).encode()
+    assert len(client.calls) == len(BLOCKS)
+
+
+def test_polly_throttling(tmpdir):
+    client = FakePolly(throttle=2)
+    synth = PollySynthesizer(client, backoff=0.0)
+    assert synth.synthesize(BLOCKS[0]) == BLOCKS[0].encode()
+    assert synth.nrequests == 3
+    client = FakePolly(throttle=3)
+    synth = PollySynthesizer(client, retries=2, backoff=0.0)
+    with pytest.raises(RuntimeError):
+        synth.synthesize(BLOCKS[0])
+
+
+def test_polly_cached(tmpdir):
+    d = str(tmpdir)
+    srcfile = os.path.join(d, 'lecture.ley')
+    with open(srcfile, 'w') as f:
+        f.write('lecture')
+    assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+    outfile = os.path.join(d, 'out.mp3')
+    client = FakePolly()
+    synth = PollySynthesizer(client, max_workers=2)
+    synth.render(BLOCKS, outfile, assets=assets, assets_dir=d)
+    assert len(client.calls) == len(BLOCKS)
+    # second render only synthesizes the changed block
+    blocks = BLOCKS[:]
+    blocks[4] = '<speak>changed</speak>'
+    synth.render(blocks, outfile, assets=assets, assets_dir=d)
+    assert client.calls[len(BLOCKS):] == ['<speak>changed</speak>']
+    with open(outfile, 'rb') as f:
+        assert f.read() == ''.join(blocks).encode()
+
+
+def test_polly_repeated_blocks(tmpdir):
+    d = str(tmpdir)
+    srcfile = os.path.join(d, 'lecture.ley')
+    with open(srcfile, 'w') as f:
+        f.write('lecture')
+    assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+    outfile = os.path.join(d, 'out.mp3')
+    client = FakePolly()
+    synth = PollySynthesizer(client, max_workers=4)
+    blocks = [BLOCKS[0], BLOCKS[1], BLOCKS[0], BLOCKS[0]]
+    synth.render(blocks, outfile, assets=assets, assets_dir=d)
+    assert sorted(client.calls) == [BLOCKS[0], BLOCKS[1]]
+    with open(outfile, 'rb') as f:
+        assert f.read() == ''.join(blocks).encode()
+    assert not [name for name in os.listdir(d) if name.endswith('.part')]
+
+
+def test_pack_ssml_merges():
+    paragraphs = ['paragraph {0}.'.format(i) for i in range(20)]
+    blocks = pack_ssml(paragraphs, max_chars=200)
+    assert len(blocks) < len(paragraphs)
+    for block in blocks:
+        assert len(block) <= 200
+        assert block.startswith('<speak>') and block.endswith('</speak>')
+    s = ''.join(blocks).replace('<speak>', '').replace('</speak>', '')
+    assert s == ''.join(p + PARAGRAPH_BREAK for p in paragraphs)
+
+
+def test_pack_ssml_stable():
+    paragraphs = ['paragraph {0}.'.format(i) for i in range(50)]
+    blocks = pack_ssml(paragraphs, max_chars=200)
+    edited = paragraphs[:]
+    edited[25] = 'an edited paragraph.'
+    new_blocks = pack_ssml(edited, max_chars=200)
+    # only the blocks around the edit should change
+    assert len(set(blocks) - set(new_blocks)) <= 2
+
+
+def test_pack_ssml_splits():
+    p = 'One two. <emphasis>Three. Four.</emphasis> Five six! Seven?'
+    blocks = pack_ssml([p], max_chars=60)
+    assert len(blocks) > 1
+    assert '<emphasis>Three. Four.</emphasis>' in ''.join(blocks)
+    for block in blocks:
+        assert block.count('<emphasis>') == block.count('</emphasis>')
+
+
+def test_speech_text():
+    plain = speech_text('Hello world, this is really fine.')
+    formatted = speech_text('Hello\n  \x1b[1mworld\x1b[0m,  this is '
+                            '\x1b[32;1m*\x1b[0mreally\x1b[32;1m*\x1b[0m fine.')
+    assert formatted == plain == 'Hello world, this is really fine.'
+    assert speech_text('Hello World', casefold=True) == 'hello world'
+
+
+def test_speech_text_keeps_markers():
+    mark = '\x1b[32;1m{0}\x1b[0m'.format
+    first = speech_text(mark('1.') + ' Go\n' + mark('2.') + ' Stop\n')
+    second = speech_text(mark('1.') + ' Stop\n' + mark('2.') + ' Go\n')
+    assert first == '1. Go 2. Stop'
+    assert first != second
+    sub = speech_text('x' + mark('{_') + '2' + mark('_}'))
+    sup = speech_text('x' + mark('{^') + '2' + mark('^}'))
+    assert sub == 'x{_2_}'
+    assert sup == 'x{^2^}'
+    struck = speech_text('a ' + mark('*') + 'b' + mark('*') + 'c' + mark('*'))
+    italic = speech_text('a ' + mark('*') + 'b c' + mark('*'))
+    assert struck == 'a b~c'
+    assert italic == 'a b c'
+    bullet = speech_text(mark('*') + ' item\n')
+    assert bullet == '* item'
+
+
+def test_dictation_migrate_key(tmpdir):
+    d = str(tmpdir)
+    srcfile = os.path.join(d, 'lecture.ley')
+    with open(srcfile, 'w') as f:
+        f.write('lecture')
+    assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+    block = 'Say \x1b[1mhello\x1b[0m'
+    recording = os.path.join(d, 'rec.ogg')
+    with open(recording, 'w') as f:
+        f.write('audio')
+    assets[('dictation', block)] = recording
+    dictation = Dictation()
+    assert dictation.migrate_key(block, assets)
+    assert ('dictation', block) not in assets
+    assert assets[('dictation', 'Say hello')] == recording
+    # reformatting the block finds the same recording
+    assert dictation.asset_key('Say  hello') in assets
+    assert not dictation.migrate_key(block, assets)
+
+
+def test_dictation_cancelled_at_prompt(tmpdir, monkeypatch):
+    d = str(tmpdir)
+    srcfile = os.path.join(d, 'lecture.ley')
+    with open(srcfile, 'w') as f:
+        f.write('lecture')
+    assets = AssetsCache(os.path.join(d, 'assets.json'), srcfile)
+    cancelled = threading.Event()
+    recorded = []
+
+    class FakeRecorder:
+        def record(self, filename):
+            recorded.append(filename)
+            return filename + '.part'
+
+    # the rest of the build fails while the user is at the prompt
+    monkeypatch.setattr('builtins.input', lambda *args: cancelled.set())
+    dictation = Dictation()
+    dictation._recorder = FakeRecorder()
+    filename = dictation.record_block('Say hello', assets, d,
+                                      cancelled=cancelled)
+    assert filename is None
+    assert recorded == []
+    assert dictation.asset_key('Say hello') not in assets
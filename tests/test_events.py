@@ -3,7 +3,7 @@ import pytest
 
 from leyline import parse, EVENTS_CTX, EventsVisitor
 from leyline.ast import PlainText
-from leyline.events import Event, Slide, Sleep
+from leyline.events import Event, Slide, Sleep, Subslide, Timeline
 
 
 EVENTS_CASES = {
@@ -37,3 +37,32 @@ def test_events(doc, exp):
     visitor = EventsVisitor(contexts=contexts)
     visitor.visit(tree)
     assert exp == visitor.events
+
+
+def test_timeline():
+    slides = [Slide(body=[[1], [2]], start=[0.0, 10.0], duration=[10.0, 5.0]),
+              Slide(body=[[3], [], [4]], start=[15.0, None, 20.0],
+                    duration=[5.0, None, 30.0])]
+    tl = Timeline.from_slides(slides)
+    assert len(tl) == 4
+    assert tl.duration == 50.0
+    assert tl.at(0.0) == (0, 0)
+    assert tl.at(12.5) == (0, 1)
+    assert tl.at(20.0) == (1, 2)
+    assert tl.at(50.0) is None
+    assert tl.overlapping(12.0, 21.0) == [(0, 1), (1, 0), (1, 2)]
+    assert Timeline.from_dict(tl.to_dict()) == tl
+
+
+def test_current_slide():
+    visitor = EventsVisitor()
+    assert visitor.current_slide is None
+    first, second = Slide(title='A'), Slide(title='B')
+    first.render('video', visitor)
+    Subslide().render('video', visitor)
+    visitor.visit_node(PlainText(text='two'))
+    assert first.idx == 1
+    second.render('video', visitor)
+    Sleep().render('video', visitor)
+    assert visitor.current_slide is second
+    assert len(first.body) == 2
@@ -1,10 +1,14 @@
 """LaTeX notes tester"""
+import os
+import json
 import difflib
 
 import pytest
 
 from leyline import parse
-from leyline.notes import Notes, HEADER, FOOTER
+from leyline.events import SHARD_MARKER
+from leyline.notes import (Notes, HEADER, FOOTER, split_shards, page_count,
+                           shard_preambles)
 
 
 def difftex(x, y, xname='expected', yname='observed'):
@@ -110,3 +114,109 @@ def test_parse(doc, exp):
     obs = visitor.visit()
     exp = HEADER + exp + FOOTER
     assert exp == obs
+
+
+def test_split_shards():
+    body = 'title\n\\section{A}\na\n\\section{B}\nb\n'
+    assert split_shards(body) == ['title\n', '\\section{A}\na\n',
+                                  '\\section{B}\nb\n']
+    body = 'one\n\\section{A}\n' + SHARD_MARKER + 'two\n'
+    assert split_shards(body) == ['one\n\\section{A}\n', 'two\n']
+    ends = [{'page': 4, 'section': 2}, {'page': 6, 'equation': 3}, {}]
+    refs = [['\\newlabel{a}{{1}{1}}'], [], ['\\bibcite{b}{1}']]
+    preambles = shard_preambles(ends, refs)
+    assert preambles[0] == '\\makeatletter\n\\bibcite{b}{1}\n\\makeatother\n'
+    assert preambles[1].startswith('\\setcounter{page}{4}\n'
+                                   '\\setcounter{section}{2}\n\\makeatletter\n')
+    assert preambles[2] == ('\\setcounter{page}{6}\n\\setcounter{equation}{3}\n'
+                            '\\makeatletter\n\\newlabel{a}{{1}{1}}\n'
+                            '\\makeatother\n')
+
+
+# pretends each 'PAGE' in the source is a page, and writes the counters and
+# labels to the .aux like the shard checkpoint does
+FAKE_PDFLATEX = r"""import os, re, sys
+texname = sys.argv[-1]
+job = os.path.splitext(os.path.basename(texname))[0]
+s = open(texname).read()
+with open(os.environ['FAKE_CALLS'], 'a') as f:
+    f.write(texname + '\n')
+counters = {'page': 1, 'section': 0, 'equation': 0}
+for name, value in re.findall(r'\\setcounter\{(\w+)\}\{(\d+)\}', s):
+    counters[name] = int(value)
+pages = s.count('PAGE')
+labels = ['\\newlabel{{{0}}}{{{{{1}}}{{{2}}}}}'.format(label, counters['equation'] + 1,
+                                                  counters['page'])
+          for label in re.findall(r'\\label\{(\w+)\}', s)]
+counters['page'] += pages
+counters['section'] += s.count('\\section{')
+counters['equation'] += s.count('\\begin{equation}')
+with open(job + '.aux', 'w') as f:
+    f.write('\\providecommand\\leylinecounter[2]{}\n')
+    for name, value in counters.items():
+        f.write('\\leylinecounter{{{0}}}{{{1}}}\n'.format(name, value))
+    f.write(''.join(label + '\n' for label in labels))
+with open(job + '.log', 'w') as f:
+    if pages:
+        f.write('Output written on {0}.pdf\n({1} pages, 10 bytes).'.format(
+                job, pages))
+    else:
+        f.write('No pages of output.')
+if pages:
+    with open(job + '.pdf', 'w') as f:
+        f.write(s)
+"""
+FAKE_GS = """import sys
+out = [a[13:] for a in sys.argv if a.startswith('-sOutputFile=')][0]
+with open(out, 'w') as f:
+    for a in sys.argv[1:]:
+        if a.endswith('.pdf') and not a.startswith('-'):
+            f.write(open(a).read())
+"""
+
+
+def test_render_shards(tmpdir, fake_tool, monkeypatch):
+    calls = str(tmpdir.join('calls'))
+    fake_tool('pdflatex', FAKE_PDFLATEX)
+    fake_tool('gs', FAKE_GS)
+    monkeypatch.setenv('FAKE_CALLS', calls)
+    monkeypatch.chdir(str(tmpdir))
+    body = ('\\section{A}\nPAGE PAGE\n\\begin{equation}\\label{one}\n'
+            '\\section{B}\nPAGE\n\\section{C}\nPAGE\\label{three}\n'
+            '\\section{D}\n')
+    notes = Notes()
+    notes.render_shards(HEADER + body + FOOTER, 'lecture', jobs=2)
+
+    def shard_tex(k):
+        with open(os.path.join('lecture.shards', 'shard{0:03d}'.format(k),
+                               'shard.tex')) as f:
+            return f.read()
+
+    # the third shard starts on the page after the first two shards' pages,
+    # and carries on their other counters too
+    assert ('\\setcounter{page}{4}\n\\setcounter{section}{2}\n'
+            '\\setcounter{equation}{1}\n') in shard_tex(2)
+    # labels are known in the other shards
+    assert '\\newlabel{three}{{2}{4}}' in shard_tex(0)
+    assert '\\newlabel{one}{{1}{1}}' in shard_tex(2)
+    assert '\\newlabel{one}' not in shard_tex(0)
+    # the last shard has no pages, so is left out of the merged PDF
+    with open(os.path.join('lecture.shards', 'shards.json')) as f:
+        manifest = json.load(f)
+    assert manifest['pages'] == [2, 1, 1, 0]
+    assert len(manifest['pdfs']) == 3
+    with open(calls) as f:
+        ncalls = len(f.read().splitlines())
+    # rebuilding unchanged notes compiles nothing
+    notes.render_shards(HEADER + body + FOOTER, 'lecture', jobs=2)
+    with open(calls) as f:
+        assert len(f.read().splitlines()) == ncalls
+
+
+def test_page_count_without_pages(tmpdir):
+    logfile = tmpdir.join('shard.log')
+    logfile.write('No pages of output.\nTranscript written on shard.log.')
+    assert page_count(str(logfile)) == 0
+    logfile.write('')
+    with pytest.raises(ValueError):
+        page_count(str(logfile))
@@ -0,0 +1,114 @@
+"""Scheduler tests"""
+import time
+import threading
+
+import pytest
+
+from leyline.scheduler import Scheduler, Abort
+
+
+def test_dependencies():
+    sched = Scheduler()
+    sched.add('a', lambda: 1)
+    sched.add('b', lambda: 2)
+    sched.add('sum', lambda a, b: a + b, deps=['a', 'b'])
+    assert sched.run()['sum'] == 3
+    assert all(t.status == 'done' for t in sched.tasks.values())
+    with pytest.raises(ValueError):
+        sched.add('c', lambda x: x, deps=['missing'])
+
+
+def test_tool_limits():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def work():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    sched = Scheduler(limits={'latex': 2}, max_workers=8)
+    for i in range(8):
+        sched.add('frame-{0}'.format(i), work, tool='latex')
+    sched.run()
+    assert max(peak) == 2
+    assert 'latex: 8 tasks' in sched.report()
+
+
+def test_failure_cancels_dependents(tmpdir):
+    def fail():
+        raise RuntimeError('boom')
+
+    sched = Scheduler()
+    sched.add('audio', fail)
+    sched.add('frame', lambda: 'frame.jpg')
+    sched.add('encode', lambda a, f: 'out.mp4', deps=['audio', 'frame'])
+    with pytest.raises(RuntimeError):
+        sched.run()
+    assert sched.tasks['audio'].status == 'failed'
+    assert sched.tasks['encode'].status == 'cancelled'
+    log = str(tmpdir.join('tasks.tsv'))
+    sched.write_log(log)
+    with open(log) as f:
+        lines = f.read().splitlines()
+    assert lines[0].split('\t') == ['task', 'tool', 'status', 'start', 'end']
+    assert len(lines) == 4
+
+
+def test_abort():
+    def quit():
+        raise Abort('user quit')
+
+    sched = Scheduler()
+    sched.add('audio', quit)
+    sched.add('encode', lambda a: a, deps=['audio'])
+    with pytest.raises(Abort):
+        sched.run()
+    assert sched.tasks['audio'].status == 'aborted'
+
+
+def test_failure_does_not_wait_for_running_tasks():
+    stopped = threading.Event()
+
+    def dictate(cancelled):
+        # like a dictation, checks for cancellation between blocks
+        for block in range(100):
+            if cancelled.is_set():
+                stopped.set()
+                return
+            time.sleep(0.03)
+
+    def fail():
+        time.sleep(0.05)
+        raise RuntimeError('boom')
+
+    sched = Scheduler()
+    sched.add('audio', lambda: dictate(sched.cancelled), daemon=True)
+    sched.add('frame', fail)
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError):
+        sched.run()
+    assert time.monotonic() - t0 < 1.0
+    assert sched.cancelled.is_set()
+    assert stopped.wait(1.0)
+
+
+def test_daemon_tasks():
+    def quit():
+        raise Abort('user quit')
+
+    sched = Scheduler()
+    sched.add('audio', lambda: threading.current_thread().daemon, daemon=True)
+    sched.add('frame', lambda: threading.current_thread().daemon)
+    results = sched.run()
+    assert results['audio']
+    assert not results['frame']
+    sched = Scheduler()
+    sched.add('audio', quit, daemon=True)
+    with pytest.raises(Abort):
+        sched.run()
+    assert sched.tasks['audio'].status == 'aborted'
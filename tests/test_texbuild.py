@@ -0,0 +1,52 @@
+"""Incremental LaTeX build tests, using a fake pdflatex"""
+import os
+
+import pytest
+
+from leyline import texbuild
+
+# writes an .aux file that changes on the first two passes, like one with
+# cross-references
+FAKE = '''import os, sys
+texname = sys.argv[-1]
+job = os.path.splitext(os.path.basename(texname))[0]
+with open(os.environ['FAKE_CALLS'], 'a') as f:
+    f.write(texname + '\\n')
+with open(texname) as f:
+    s = f.read()
+aux = job + '.aux'
+prev = open(aux).read() if os.path.exists(aux) else ''
+with open(aux, 'w') as f:
+    f.write('refs ' + s if prev.startswith('labels') or prev.startswith('refs')
+            else 'labels ' + s)
+with open(job + '.pdf', 'w') as f:
+    f.write('pdf ' + s)
+'''
+
+
+@pytest.fixture
+def fake(tmpdir, fake_tool, monkeypatch):
+    fake_tool('pdflatex', FAKE)
+    calls = str(tmpdir.join('calls'))
+    monkeypatch.setenv('FAKE_CALLS', calls)
+    return calls
+
+
+def test_incremental_build(tmpdir, fake):
+    d = str(tmpdir)
+    texname = os.path.join(d, 'notes.tex')
+    manifest = texbuild.build(texname, 'v1', cwd=d)
+    # passes are run until the .aux stops changing
+    assert manifest['passes'] == 3
+    assert os.path.isfile(os.path.join(d, 'notes.build.json'))
+    mtime = os.stat(texname).st_mtime_ns
+    # nothing changed, so nothing is written or compiled
+    manifest = texbuild.build(texname, 'v1', cwd=d)
+    assert manifest['passes'] == 3
+    assert os.stat(texname).st_mtime_ns == mtime
+    with open(fake) as f:
+        assert len(f.read().splitlines()) == 3
+    # a deleted PDF is rebuilt
+    os.remove(os.path.join(d, 'notes.pdf'))
+    assert texbuild.build(texname, 'v1', cwd=d)['passes'] == 1
+    assert texbuild.build(texname, 'v2', cwd=d)['passes'] == 2
@@ -0,0 +1,90 @@
+"""LaTeX format tests, using a fake pdflatex"""
+import os
+
+import pytest
+
+from leyline import texformat
+from leyline.assets import AssetsCache
+
+FAKE = '''import os, sys
+args = sys.argv[1:]
+with open(os.environ['FAKE_CALLS'], 'a') as f:
+    f.write(' '.join(args) + ' TEXFORMATS=' + os.environ.get('TEXFORMATS', '') + '\\n')
+if '--version' in args:
+    print('pdfTeX 3.14 (fake)')
+elif '-ini' in args:
+    if os.environ.get('FAKE_INI_FAILS'):
+        sys.exit(1)
+    job = [a for a in args if a.startswith('-jobname=')][0][9:]
+    with open(job + '.fmt', 'w') as f:
+        f.write('format')
+'''
+
+DOC = '\\documentclass{beamer}\n\\usetheme{Warsaw}\n\\begin{document}\nhi\n\\end{document}\n'
+
+
+@pytest.fixture
+def fake(tmpdir, fake_tool, monkeypatch):
+    fake_tool('pdflatex', FAKE)
+    calls = str(tmpdir.join('calls'))
+    monkeypatch.setenv('FAKE_CALLS', calls)
+    monkeypatch.setattr(texformat, '_broken', set())
+    return calls
+
+
+@pytest.fixture
+def assets(tmpdir):
+    srcfile = str(tmpdir.join('lecture.ley'))
+    with open(srcfile, 'w') as f:
+        f.write('lecture')
+    return AssetsCache(str(tmpdir.join('assets.json')), srcfile)
+
+
+def compile_lines(calls):
+    with open(calls) as f:
+        return [l for l in f.read().splitlines() if '--version' not in l]
+
+
+def test_split_preamble():
+    preamble, rest = texformat.split_preamble(DOC)
+    assert preamble == '\\documentclass{beamer}\n\\usetheme{Warsaw}\n'
+    assert rest.startswith('\\begin{document}')
+    assert texformat.split_preamble('no doc') == ('', 'no doc')
+
+
+def test_format_built_once(tmpdir, fake, assets):
+    for i in range(3):
+        texname = str(tmpdir.join('frame{0}.tex'.format(i)))
+        texformat.pdflatex(texname, DOC, cwd=str(tmpdir), assets=assets,
+                           assets_dir=str(tmpdir))
+    lines = compile_lines(fake)
+    assert sum('-ini' in l for l in lines) == 1
+    uses = [l for l in lines if '-fmt=' in l]
+    assert len(uses) == 3
+    assert 'TEXFORMATS=' + str(tmpdir) + os.pathsep in uses[0]
+    assert assets.keys_for_kind('latexfmt')
+
+
+def test_format_survives_gc_after_edit(tmpdir, fake, assets):
+    texname = str(tmpdir.join('frame.tex'))
+    texformat.pdflatex(texname, DOC, cwd=str(tmpdir), assets=assets,
+                       assets_dir=str(tmpdir))
+    with open(assets.srcfile, 'w') as f:
+        f.write('edited lecture')
+    assets.srcfile = assets.srcfile
+    texformat.pdflatex(texname, DOC, cwd=str(tmpdir), assets=assets,
+                       assets_dir=str(tmpdir))
+    assets.gc()
+    assert len(assets.keys_for_kind('latexfmt')) == 1
+    assert sum('-ini' in l for l in compile_lines(fake)) == 1
+
+
+def test_format_falls_back(tmpdir, fake, assets, monkeypatch):
+    monkeypatch.setenv('FAKE_INI_FAILS', '1')
+    texname = str(tmpdir.join('notes.tex'))
+    texformat.pdflatex(texname, DOC, cwd=str(tmpdir), assets=assets)
+    texformat.pdflatex(texname, DOC, cwd=str(tmpdir), assets=assets)
+    lines = compile_lines(fake)
+    # the format is only attempted once
+    assert sum('-ini' in l for l in lines) == 1
+    assert sum(l.startswith(texname) for l in lines) == 2
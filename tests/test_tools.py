@@ -0,0 +1,64 @@
+"""External tool runner tests"""
+import os
+import asyncio
+
+import pytest
+
+from leyline import tools
+
+
+@pytest.fixture
+def fake(fake_tool, monkeypatch):
+    """Makes a fake tool that echoes its args, and exits with the status
+    and after the delay given in its environment.
+    """
+    monkeypatch.setattr(tools, 'RUNS', [])
+    return fake_tool('pdflatex',
+                     'import os, sys, time\n'
+                     'print("fake", *sys.argv[1:])\n'
+                     'time.sleep(float(os.environ.get("FAKE_DELAY", 0)))\n'
+                     'sys.exit(int(os.environ.get("FAKE_STATUS", 0)))\n')
+
+
+def test_run_captures_log(fake, monkeypatch):
+    monkeypatch.setattr(tools, 'keep_logs', True)
+    run = tools.run('pdflatex', ['deck.tex'], name='deck')
+    assert run.returncode == 0
+    assert run.logfile.endswith('deck.pdflatex.log')
+    with open(run.logfile) as f:
+        assert f.read() == 'fake deck.tex\n'
+    assert tools.RUNS == [run]
+    assert 'pdflatex: 1 runs, 0 failed' in tools.summary()
+
+
+def test_logs_kept_only_for_failures(fake, monkeypatch):
+    assert tools.run('pdflatex', ['deck.tex'], name='deck').logfile is None
+    assert os.listdir(tools.log_dir) == []
+    monkeypatch.setenv('FAKE_STATUS', '1')
+    with pytest.raises(tools.ToolError) as exc:
+        tools.run('pdflatex', ['deck.tex'], name='deck')
+    assert os.path.isfile(exc.value.logfile)
+
+
+def test_run_failure_and_timeout(fake, monkeypatch):
+    monkeypatch.setenv('FAKE_STATUS', '3')
+    with pytest.raises(tools.ToolError) as exc:
+        tools.run('pdflatex', ['bad.tex'], retries=1)
+    assert exc.value.returncode == 3
+    assert len(tools.RUNS) == 2
+    monkeypatch.setenv('FAKE_STATUS', '0')
+    monkeypatch.setenv('FAKE_DELAY', '5')
+    with pytest.raises(tools.ToolError) as exc:
+        tools.run('pdflatex', ['slow.tex'], timeout=0.2)
+    assert exc.value.timed_out
+
+
+def test_run_async(fake, monkeypatch):
+    async def main():
+        return await asyncio.gather(*[tools.run_async('pdflatex', [str(i)])
+                                      for i in range(4)])
+    runs = asyncio.run(main())
+    assert [r.returncode for r in runs] == [0] * 4
+    monkeypatch.setenv('FAKE_DELAY', '5')
+    with pytest.raises(tools.ToolError):
+        asyncio.run(tools.run_async('pdflatex', ['slow'], timeout=0.2))
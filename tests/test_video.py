@@ -0,0 +1,132 @@
+"""Video testing"""
+import os
+
+import pytest
+
+from leyline.ast import PlainText
+from leyline.assets import AssetsCache
+from leyline.events import Slide
+from leyline.video import (Frame, FrameBuildDir, Video, GS_PREVIEW_ARGS,
+                           ffconcat_entries, make_ffconcat, encoding_args,
+                           parse_slide_range, parse_time_range)
+
+
+def test_ffconcat_merges_shared_frames():
+    text = [PlainText(text='x')]
+    slides = [Slide(body=[text, text, [], text], duration=[1.0, 2.0, None, 3.0]),
+              Slide(body=[text], duration=[4.0])]
+    frames = [['a.jpg', 'a.jpg', None, 'b.jpg'], ['b.jpg']]
+    entries = ffconcat_entries(slides, frames)
+    assert entries == [['a.jpg', 3.0], ['b.jpg', 7.0]]
+    s = make_ffconcat(entries)
+    assert s == ('ffconcat version 1.0\n'
+                 'file a.jpg\nduration 3.0\n'
+                 'file b.jpg\nduration 7.0\n'
+                 'file b.jpg\nduration 0.0\n')
+
+
+def test_encoding_args_keyframes_at_slides():
+    entries = [['a.jpg', 3.0], ['b.jpg', 7.0], ['c.jpg', 2.5]]
+    args = encoding_args(entries, 'draft')
+    assert 'fps=24' not in args
+    assert args[args.index('-tune') + 1] == 'stillimage'
+    assert args[args.index('-force_key_frames') + 1] == '0.000,3.000,10.000'
+    assert encoding_args(entries, 'legacy') == ['-vf', 'fps=24']
+
+
+def test_preview_frames_are_versioned_separately():
+    assert Frame.preview_version != Frame.asset_version
+    assert '-g960x540' in GS_PREVIEW_ARGS
+
+
+def test_parse_ranges():
+    assert parse_slide_range('12-14') == (12, 14)
+    assert parse_slide_range('7') == (7, 7)
+    assert parse_time_range('05:00-08:30') == (300.0, 510.0)
+    assert parse_time_range('1:00:00-1:00:30.5') == (3600.0, 3630.5)
+    with pytest.raises(ValueError):
+        parse_time_range('08:30-05:00')
+
+
+def test_select_slides_and_times():
+    text = [PlainText(text='x')]
+    slides = [Slide(body=[text, text], start=[0.0, 10.0], duration=[10.0, 5.0]),
+              Slide(body=[text, [], text], start=[15.0, None, 20.0],
+                    duration=[5.0, None, 30.0]),
+              Slide(body=[text], start=[50.0], duration=[10.0])]
+    video = Video()
+    assert video.select(slides, None, slide_range=(2, 3)) == {(1, 0), (1, 2),
+                                                               (2, 0)}
+    video.measure_timeline = lambda slides, assets: 0
+    assert video.select(slides, None, time_range=(12.0, 21.0)) == {(0, 1), (1, 0),
+                                                                   (1, 2)}
+    with pytest.raises(ValueError, match='the lecture has 3 slides'):
+        video.select(slides, None, slide_range=(50, 60))
+    with pytest.raises(ValueError, match='times 100-200 s'):
+        video.select(slides, None, time_range=(100.0, 200.0))
+
+
+def test_frame_build_dir_links_once_and_keeps_links(tmpdir):
+    with tmpdir.as_cwd():
+        tmpdir.mkdir('figs').join('a.png').write('png')
+        builddir = FrameBuildDir('lecture.build')
+        builddir.link('figs')
+        builddir.link('figs')
+        link = tmpdir.join('lecture.build', 'figs')
+        assert link.islink()
+        job = builddir.job('abc')
+        for ext in ('.tex', '.pdf'):
+            with open(job + ext, 'w') as f:
+                f.write(ext)
+        # another build of the lecture, compiling at the same time
+        tmpdir.join('lecture.build', 'def.pdf').write('pdf')
+        builddir.cleanup()
+        assert sorted(os.listdir('lecture.build')) == ['def.pdf', 'figs']
+        # a second build reuses the existing link
+        FrameBuildDir('lecture.build').link('figs')
+        assert link.join('a.png').read() == 'png'
+
+
+def test_temporary_frame_build_dir_is_removed():
+    with FrameBuildDir() as builddir:
+        path = builddir.path
+        assert os.path.isdir(path)
+    assert not os.path.exists(path)
+
+
+FAKE_PDFLATEX = """import os, sys
+job = os.path.splitext(os.path.basename(sys.argv[-1]))[0]
+with open(job + '.pdf', 'w') as f:
+    f.write(open(sys.argv[-1]).read())
+"""
+FAKE_GS = """import sys
+out = [a[13:] for a in sys.argv if a.startswith('-sOutputFile=')][0]
+pdf = [a for a in sys.argv if a.endswith('.pdf')][0]
+with open(out, 'w') as f:
+    f.write('jpeg ' + open(pdf).read())
+"""
+
+
+def test_rerendered_frame_does_not_change_shared_blob(tmpdir, fake_tool):
+    fake_tool('pdflatex', FAKE_PDFLATEX)
+    fake_tool('gs', FAKE_GS)
+    d = str(tmpdir)
+    srcfile = tmpdir.join('lecture.ley')
+    srcfile.write('lecture')
+    assets = AssetsCache(os.path.join(d, 'assets.json'), str(srcfile))
+    other = tmpdir.join('other.jpg')
+    other.write('jpeg old')
+    assets.dedupe(str(other))
+    # a frame file left behind without a cache entry, linked to the blob
+    key = ('frame', 'new')
+    filename = assets.path(key, '.jpg', d)
+    with open(filename, 'w') as f:
+        f.write('jpeg old')
+    assert assets.dedupe(filename)
+    frame = Frame()
+    frame.linkpaths = []
+    with FrameBuildDir() as builddir:
+        frame._render_frame('new', key, assets, d, builddir)
+    with open(filename) as f:
+        assert f.read() == 'jpeg new'
+    assert other.read() == 'jpeg old'